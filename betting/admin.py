@@ -1,13 +1,32 @@
+from collections import defaultdict
 from django.contrib import admin
+from django.db import transaction
+from django.db.models import F
 from django.utils import timezone
-from .models import UserProfile, Race, Horse, Bet
+from .caching import invalidate_races
+from .cancellation import cancel_races
+from .models import UserProfile, Race, RaceResult, Horse, Bet, Notification, ApiToken
 from .parsers import RaceDataParser
+from .settlement import settle_race
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
     list_display = ['user', 'balance', 'created_at', 'updated_at']
     search_fields = ['user__username']
     list_filter = ['created_at']
+    # Баланс меняется только операциями журнала (betting/ledger.py)
+    readonly_fields = ['balance', 'ledger_entries']
+
+class RaceResultInline(admin.TabularInline):
+    model = RaceResult
+    extra = 0
+    ordering = ['position']
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == 'horse':
+            race_id = request.resolver_match.kwargs.get('object_id')
+            kwargs['queryset'] = Horse.objects.filter(race_id=race_id) if race_id else Horse.objects.none()
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
 @admin.register(Race)
 class RaceAdmin(admin.ModelAdmin):
@@ -15,6 +34,16 @@ class RaceAdmin(admin.ModelAdmin):
     list_filter = ['status', 'start_time']
     search_fields = ['name']
     actions = ['mark_as_finished', 'cancel_race', 'update_races_data']
+    inlines = [RaceResultInline]
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Победитель - лошадь на первом месте порядка прихода
+        race = form.instance
+        first = race.results.filter(position=1).values_list('horse_id', flat=True).first()
+        if first is not None and first != race.winner_id:
+            Race.objects.filter(pk=race.pk).update(winner_id=first)
+            invalidate_races()
     
     # Ограничиваем выбор победителя только лошадьми этого забега
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
@@ -28,32 +57,29 @@ class RaceAdmin(admin.ModelAdmin):
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
     
     def mark_as_finished(self, request, queryset):
-        for race in queryset:
-            race.status = 'finished'
-            race.save()
-            # Автоматически рассчитываем выигрыши
-            race.settle_bets()
-        self.message_user(request, "Выбранные забеги завершены")
+        settled_bets = 0
+        for race in queryset.select_related('winner'):
+            with transaction.atomic():
+                race.status = 'finished'
+                race.save()
+                # Автоматически рассчитываем выигрыши
+                result = settle_race(race)
+            settled_bets += result['won'] + result['lost']
+        self.message_user(request, f"Выбранные забеги завершены, рассчитано ставок: {settled_bets}")
     mark_as_finished.short_description = "Завершить выбранные забеги"
     
     def cancel_race(self, request, queryset):
-        updated = queryset.update(status='cancelled')
-        # Возвращаем ставки при отмене забега
-        for race in queryset:
-            bets = Bet.objects.filter(race=race, is_settled=False)
-            for bet in bets:
-                user_profile = bet.user.betting_profile
-                user_profile.balance += bet.amount
-                user_profile.save()
-                bet.is_settled = True
-                bet.save()
-        self.message_user(request, f"{updated} забегов отменено")
+        result = cancel_races(queryset.values_list('id', flat=True))
+        self.message_user(
+            request,
+            f"{result['races']} забегов отменено, возвращено ставок: {result['bets']} на {result['refunded']} ₽",
+        )
     cancel_race.short_description = "Отменить выбранные забеги"
     
     def update_races_data(self, request, queryset):
         try:
-            RaceDataParser.update_races_from_real_sources()
-            self.message_user(request, "Данные о забегах обновлены")
+            counts = RaceDataParser.update_races_from_real_sources()
+            self.message_user(request, f"Данные о забегах обновлены, новых забегов: {counts['races']}")
         except Exception as e:
             self.message_user(request, f"Ошибка при обновлении: {str(e)}")
     update_races_data.short_description = "Обновить данные о забегах"
@@ -65,6 +91,13 @@ class HorseAdmin(admin.ModelAdmin):
     search_fields = ['name']
     list_editable = ['odds']
 
+    def save_model(self, request, obj, form, change):
+        if change and 'odds' in form.changed_data:
+            obj.odds_version = F('odds_version') + 1
+        super().save_model(request, obj, form, change)
+        if change and 'odds' in form.changed_data:
+            obj.refresh_from_db(fields=['odds_version'])
+
 @admin.register(Bet)
 class BetAdmin(admin.ModelAdmin):
     list_display = ['user', 'race', 'horse', 'bet_type', 'amount', 'odds', 'potential_win', 'is_winner', 'is_settled', 'created_at']
@@ -74,14 +107,39 @@ class BetAdmin(admin.ModelAdmin):
     actions = ['settle_bets']
     
     def settle_bets(self, request, queryset):
-        for bet in queryset:
-            if not bet.is_settled:
-                bet.is_settled = True
-                bet.settled_at = timezone.now()
-                bet.save()
-                if bet.is_winner:
-                    user_profile = bet.user.betting_profile
-                    user_profile.balance += bet.potential_win
-                    user_profile.save()
-        self.message_user(request, "Выбранные ставки рассчитаны")
-    settle_bets.short_description = "Рассчитать выбранные ставки"
\ No newline at end of file
+        # Ставки завершенных забегов рассчитываются по порядку прихода
+        by_race = defaultdict(list)
+        for race_id, bet_id in queryset.filter(is_settled=False, race__status='finished').values_list('race_id', 'id'):
+            by_race[race_id].append(bet_id)
+        settled = 0
+        for race in Race.objects.filter(id__in=list(by_race)):
+            result = settle_race(race, by_race[race.id])
+            settled += result['won'] + result['lost']
+        self.message_user(request, f"Рассчитано ставок: {settled}")
+    settle_bets.short_description = "Рассчитать выбранные ставки"
+
+@admin.register(Notification)
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ['recipient', 'kind', 'subject', 'status', 'attempts', 'next_attempt_at', 'created_at', 'sent_at']
+    list_filter = ['status', 'kind']
+    search_fields = ['recipient', 'user__username']
+    readonly_fields = ['claim', 'last_error', 'created_at', 'sent_at']
+    actions = ['retry_notifications']
+
+    def retry_notifications(self, request, queryset):
+        updated = queryset.filter(status='dead').update(
+            status='retry', attempts=0, next_attempt_at=timezone.now(), last_error='',
+        )
+        self.message_user(request, f"Поставлено на повторную отправку: {updated}")
+    retry_notifications.short_description = "Повторить отправку недоставленных"
+
+@admin.register(ApiToken)
+class ApiTokenAdmin(admin.ModelAdmin):
+    list_display = ['user', 'name', 'created_at']
+    search_fields = ['user__username', 'name']
+    # Ключ показывается только при выпуске (manage.py create_api_token);
+    # в админке токены можно отозвать удалением
+    readonly_fields = ['user', 'name', 'key_hash', 'created_at']
+
+    def has_add_permission(self, request):
+        return False
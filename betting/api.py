@@ -0,0 +1,176 @@
+import json
+from functools import wraps
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from . import live, tokens
+from .caching import cache_stats as get_cache_stats
+from .models import Race, Horse, UserProfile
+from .placement import BetError, place_bet_slip
+
+# Сколько ближайших забегов отдает /api/races/ по умолчанию и максимум
+RACES_LIMIT = 20
+RACES_MAX_LIMIT = 100
+
+
+def api_login_required(view):
+    """
+    Как login_required, но вместо редиректа возвращает 401 в JSON.
+
+    Клиенты API (мобильные приложения, внешние системы) передают
+    заголовок Authorization: Token <ключ> (betting/tokens.py): такой
+    запрос не зависит от cookie и не проходит проверку CSRF. Запрос
+    браузера с cookie сессии проверяется на CSRF как обычная форма.
+    """
+    @csrf_exempt
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        header = request.headers.get('Authorization')
+        if header:
+            user = tokens.authenticate_header(header)
+            if user is None:
+                return JsonResponse({'error': 'Недействительный токен'}, status=401)
+            request.user = user
+        elif not request.user.is_authenticated:
+            return JsonResponse({'error': 'Требуется авторизация'}, status=401)
+        else:
+            reason = tokens.csrf_failure(request)
+            if reason:
+                return JsonResponse({'error': f'Ошибка проверки CSRF: {reason}'}, status=403)
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+@require_POST
+@api_login_required
+def bet_slip(request):
+    """
+    Разместить купон из нескольких ставок.
+
+    Тело запроса: {"bets": [{"race_id": 1, "horse_id": 2, "amount": "100",
+    "bet_type": "win"}, ...]}. Заголовок Idempotency-Key (или поле
+    "idempotency_key") делает повтор запроса безопасным.
+    """
+    try:
+        payload = json.loads(request.body)
+    except (ValueError, UnicodeDecodeError):
+        return JsonResponse({'error': 'Некорректный JSON'}, status=400)
+    if not isinstance(payload, dict) or not isinstance(payload.get('bets'), list):
+        return JsonResponse({'error': 'Ожидается объект с полем "bets"'}, status=400)
+
+    idempotency_key = request.headers.get('Idempotency-Key') or payload.get('idempotency_key') or ''
+    if not isinstance(idempotency_key, str) or len(idempotency_key) > 64:
+        return JsonResponse({'error': 'Ключ идемпотентности - строка до 64 символов'}, status=400)
+
+    try:
+        slip, replayed = place_bet_slip(request.user, payload['bets'], idempotency_key)
+    except BetError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    response = JsonResponse(slip.response, status=200 if replayed else 201)
+    if replayed:
+        response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+# Асинхронные эндпоинты чтения. Под ASGI они не занимают поток на время
+# ожидания клиента или базы; пишущие представления остаются синхронными.
+
+def _horse_json(horse):
+    return {
+        'id': horse.id,
+        'name': horse.name,
+        'odds': horse.odds,
+        'odds_version': horse.odds_version,
+        'tote_odds': horse.tote_odds,
+        'color': horse.color,
+        'jockey': horse.jockey,
+    }
+
+
+def _race_json(race, horses):
+    return {
+        'id': race.id,
+        'name': race.name,
+        'start_time': race.start_time,
+        'status': race.status,
+        'winner_id': race.winner_id,
+        'horses': [_horse_json(horse) for horse in horses],
+    }
+
+
+@require_GET
+async def races(request):
+    """Ближайшие запланированные забеги с лошадьми и коэффициентами"""
+    try:
+        limit = min(int(request.GET.get('limit', RACES_LIMIT)), RACES_MAX_LIMIT)
+    except ValueError:
+        return JsonResponse({'error': 'limit должен быть числом'}, status=400)
+
+    upcoming = Race.objects.filter(
+        status='scheduled',
+        start_time__gte=timezone.now(),
+    ).prefetch_related('horses').order_by('start_time')[:max(limit, 0)]
+
+    data = [_race_json(race, race.horses.all()) async for race in upcoming]
+    return JsonResponse({'races': data})
+
+
+@require_GET
+async def race_card(request, race_id):
+    """Карточка забега: статус, лошади и текущие коэффициенты"""
+    try:
+        race = await Race.objects.aget(pk=race_id)
+    except Race.DoesNotExist:
+        raise Http404('Забег не найден')
+    horses = [horse async for horse in Horse.objects.filter(race_id=race.id).order_by('id')]
+    return JsonResponse(_race_json(race, horses))
+
+
+@require_GET
+async def balance(request):
+    """Баланс текущего пользователя"""
+    user = await request.auser()
+    if not user.is_authenticated:
+        return JsonResponse({'error': 'Требуется авторизация'}, status=401)
+    try:
+        value = await UserProfile.objects.filter(user_id=user.pk).values_list('balance', flat=True).aget()
+    except UserProfile.DoesNotExist:
+        raise Http404('Профиль не найден')
+    return JsonResponse({'balance': value})
+
+
+@require_GET
+async def race_events(request):
+    """
+    Поток Server-Sent Events с изменениями коэффициентов, статусов и
+    победителей. ?race=<id> (можно несколько) ограничивает забеги.
+    Требует ASGI (uvicorn ippodrom.asgi:application): под WSGI Django
+    собирает асинхронный поток в список целиком, бесконечный поток
+    занял бы рабочий поток навсегда, не отправив ни одного события
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'error': 'Поток событий доступен только через ASGI-сервер'}, status=501)
+    try:
+        race_ids = [int(race_id) for race_id in request.GET.getlist('race')]
+    except ValueError:
+        return JsonResponse({'error': 'race должен быть числом'}, status=400)
+
+    subscription = await live.hub.subscribe(race_ids)
+    response = StreamingHttpResponse(
+        live.stream_events(subscription, live.hub), content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    # Отключаем буферизацию ответа в nginx
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@require_GET
+def cache_stats(request):
+    """Счетчики попаданий и промахов кэша страниц и фрагментов (для персонала)"""
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Доступ запрещен'}, status=403)
+    return JsonResponse({'caches': get_cache_stats()})
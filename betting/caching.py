@@ -0,0 +1,175 @@
+"""
+Кэш страниц и фрагментов с забегами и пользователей с профилями.
+
+Страницы и фрагменты хранятся в локальном кэше процесса (default), но
+их ключи включают версию данных о забегах. Версия лежит в кэше,
+общем для всех процессов (BETTING_RACES_VERSION_CACHE: файловый кэш
+или Redis), поэтому изменение забегов в race_daemon или в другом
+веб-процессе сразу делает устаревшими записи всех процессов. Если
+общий кэш не настроен, версия локальна, и устаревание в других
+процессах ограничено только BETTING_CACHE_TIMEOUT.
+"""
+import time
+from functools import wraps
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache, caches
+from django.db import transaction
+from django.http import HttpResponse
+
+# Версия данных о забегах и лошадях: входит во все ключи кэша,
+# поэтому увеличение версии разом делает устаревшими все записи
+RACES_VERSION_KEY = 'betting:races:version'
+STATS_KEY = 'betting:cache:{}:{}'
+USER_KEY = 'betting:user:{}'
+
+# Кэшируемые страницы и фрагменты, для которых ведутся счетчики
+CACHE_NAMES = ('home', 'upcoming_races', 'recent_results', 'race_cards')
+
+# Время жизни записей по умолчанию, секунд. Ограничивает устаревание
+# данных, зависящих от текущего времени (забег начался без сохранения)
+DEFAULT_TIMEOUT = 60
+
+
+def get_timeout():
+    return getattr(settings, 'BETTING_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def version_cache():
+    """Кэш версии данных о забегах: общий для процессов, если настроен"""
+    alias = getattr(settings, 'BETTING_RACES_VERSION_CACHE', None)
+    return caches[alias] if alias in settings.CACHES else cache
+
+
+def races_version():
+    versions = version_cache()
+    version = versions.get(RACES_VERSION_KEY)
+    if version is None:
+        # Ключ мог быть вытеснен: новая версия от текущего времени
+        # не совпадет ни с одной из прежних
+        versions.add(RACES_VERSION_KEY, int(time.time() * 1000), timeout=None)
+        version = versions.get(RACES_VERSION_KEY)
+    return version
+
+
+def _bump_races_version():
+    try:
+        version_cache().incr(RACES_VERSION_KEY)
+    except ValueError:
+        # Ключа нет - следующий races_version() начнет новую версию
+        pass
+
+
+def invalidate_races():
+    """
+    Сбросить кэш страниц и фрагментов с забегами. Внутри транзакции
+    срабатывает после фиксации, иначе параллельный запрос мог бы
+    закэшировать еще не обновленные данные под новой версией
+    """
+    transaction.on_commit(_bump_races_version)
+
+
+def user_cache_key(user_id):
+    """Ключ пользователя вместе с профилем (см. betting/profiles.py)"""
+    return USER_KEY.format(user_id)
+
+
+def user_cache():
+    """
+    Кэш пользователей с профилями (BETTING_USER_CACHE) или None.
+    Активность, пароль и баланс пользователя меняются в любом процессе,
+    поэтому кэш должен быть общим для всех процессов: сброс записи
+    в локальном кэше процесса остальные процессы не видят
+    """
+    alias = getattr(settings, 'BETTING_USER_CACHE', None)
+    return caches[alias] if alias in settings.CACHES else None
+
+
+def invalidate_users(user_ids):
+    """
+    Сбросить закэшированных пользователей с профилями: сразу и еще раз
+    после фиксации транзакции, чтобы параллельный запрос не вернул в
+    кэш незафиксированное состояние
+    """
+    users = user_cache()
+    keys = [user_cache_key(user_id) for user_id in user_ids]
+    if users is None or not keys:
+        return
+    users.delete_many(keys)
+    transaction.on_commit(lambda: users.delete_many(keys))
+
+
+def _count(name, outcome):
+    key = STATS_KEY.format(name, outcome)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, timeout=None)
+
+
+def cache_stats(names=CACHE_NAMES):
+    """Счетчики попаданий и промахов: {имя: {'hits', 'misses'}}"""
+    values = cache.get_many([STATS_KEY.format(name, outcome) for name in names for outcome in ('hits', 'misses')])
+    return {
+        name: {
+            'hits': values.get(STATS_KEY.format(name, 'hits'), 0),
+            'misses': values.get(STATS_KEY.format(name, 'misses'), 0),
+        }
+        for name in names
+    }
+
+
+def cached_fragment(name, render, *vary_on):
+    """
+    HTML-фрагмент с забегами из кэша; при промахе render() строит его
+    заново. Ключ включает версию данных о забегах и vary_on
+    """
+    key = ':'.join(['betting:fragment', name, str(races_version()), *map(str, vary_on)])
+    html = cache.get(key)
+    if html is not None:
+        _count(name, 'hits')
+        return html
+    _count(name, 'misses')
+    html = render()
+    cache.set(key, html, get_timeout())
+    return html
+
+
+def cache_anonymous_page(name):
+    """
+    Кэшировать страницу целиком для анонимных посетителей.
+
+    Страница не должна содержать форм с CSRF-токеном. Авторизованные
+    пользователи, запросы с непоказанными сообщениями и ответы кроме 200
+    в кэш не попадают.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if (
+                request.method not in ('GET', 'HEAD')
+                or request.user.is_authenticated
+                or len(get_messages(request))
+            ):
+                return view(request, *args, **kwargs)
+
+            key = f'betting:page:{name}:{races_version()}:{request.get_full_path()}'
+            cached = cache.get(key)
+            if cached is not None:
+                _count(name, 'hits')
+                content, content_type = cached
+                return HttpResponse(content, content_type=content_type)
+
+            _count(name, 'misses')
+            response = view(request, *args, **kwargs)
+            # Ответ с cookie или выданным CSRF-токеном персональный
+            if (
+                response.status_code == 200
+                and not response.streaming
+                and not response.cookies
+                and not request.META.get('CSRF_COOKIE_NEEDS_UPDATE')
+            ):
+                cache.set(key, (response.content, response['Content-Type']), get_timeout())
+            return response
+        return wrapper
+    return decorator
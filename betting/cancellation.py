@@ -0,0 +1,110 @@
+from collections import defaultdict
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+from .caching import invalidate_races
+from .ledger import post_many
+from .models import Race, Bet, Transaction
+from .stats import ensure_user_stats, record_refunds
+
+# Забеги в этих статусах можно отменить; у завершенного забега
+# ставки рассчитываются по результату
+CANCELLABLE_STATUSES = ('scheduled', 'in_progress')
+
+# Ставок в одном UPDATE и чтении по id: укладывается в лимит
+# параметров запроса SQLite
+REFUND_BATCH_SIZE = 900
+
+
+def cancel_races(race_ids, reason=''):
+    """
+    Отменить забеги race_ids и вернуть все их нерассчитанные ставки.
+    reason попадает в описание операций возврата.
+
+    Массовые запросы в одной транзакции; число запросов зависит только
+    от числа пачек по REFUND_BATCH_SIZE ставок:
+      1. UPDATE статуса забегов;
+      2. чтение отмененных забегов из race_ids (в том числе отмененных
+         раньше - так же возвращаются ставки, принятые во время отмены)
+         и проверка строк статистики их участников;
+      3. чтение id нерассчитанных ставок этих забегов с блокировкой
+         строк (SELECT ... FOR UPDATE);
+      4. на пачку id - UPDATE ставок (они помечаются рассчитанными, это
+         и есть захват: параллельный расчет не вернет и не оплатит их
+         второй раз) и сгруппированное по (пользователь, забег, тип
+         ставки) чтение тех же ставок по id;
+      5. статистика пользователей (stats.record_refunds - возвращенные
+         ставки вычитаются из нее, возврат не считается проигрышем)
+         и запись в журнал операций "refund", по одной на пользователя
+         и забег (ledger.post_many: начисления одним UPDATE ... CASE на
+         пачку пользователей и bulk_create операций).
+
+    Возвращает {'races': отменено забегов, 'bets': возвращено ставок,
+    'users': пользователей, 'refunded': сумма возврата}.
+    """
+    race_ids = list(race_ids)
+    result = {'races': 0, 'bets': 0, 'users': 0, 'refunded': 0}
+    if not race_ids:
+        return result
+
+    now = timezone.now()
+    with transaction.atomic():
+        result['races'] = Race.objects.filter(id__in=race_ids, status__in=CANCELLABLE_STATUSES).update(
+            status='cancelled'
+        )
+        if result['races']:
+            invalidate_races()
+
+        names = dict(Race.objects.filter(id__in=race_ids, status='cancelled').values_list('id', 'name'))
+        pending = Bet.objects.filter(race_id__in=list(names), is_settled=False)
+        # Строки статистики собираются по истории до захвата ставок:
+        # пересчет после захвата не увидел бы возвращаемые ставки
+        ensure_user_stats(pending.values_list('user_id', flat=True).distinct())
+        bet_ids = list(pending.select_for_update().values_list('id', flat=True))
+        if not bet_ids:
+            return result
+
+        by_type = defaultdict(lambda: {'bets': 0, 'amount': 0})
+        refunds = defaultdict(int)
+        for start in range(0, len(bet_ids), REFUND_BATCH_SIZE):
+            chunk = bet_ids[start:start + REFUND_BATCH_SIZE]
+            result['bets'] += Bet.objects.filter(id__in=chunk).update(
+                is_winner=False, is_settled=True, settled_at=now
+            )
+            rows = (
+                Bet.objects.filter(id__in=chunk)
+                .values('user_id', 'race_id', 'bet_type')
+                .annotate(bets=Count('id'), total=Sum('amount'))
+                .order_by()
+            )
+            for row in rows:
+                user_type = by_type[row['user_id'], row['bet_type']]
+                user_type['bets'] += row['bets']
+                user_type['amount'] += row['total']
+                refunds[row['user_id'], row['race_id']] += row['total']
+
+        record_refunds(
+            {'user_id': user_id, 'bet_type': bet_type, **values}
+            for (user_id, bet_type), values in by_type.items()
+        )
+        post_many(
+            [
+                Transaction(
+                    user_id=user_id, transaction_type='refund', amount=amount,
+                    description=f'Возврат ставок - забег "{names[race_id]}" отменен{": " + reason if reason else ""}'[:200],
+                )
+                for (user_id, race_id), amount in sorted(refunds.items())
+            ],
+            now,
+        )
+
+    result['users'] = len({user_id for user_id, _ in refunds})
+    result['refunded'] = sum(refunds.values())
+    return result
+
+
+def refund_cancelled_races():
+    """Вернуть ставки, оставшиеся нерассчитанными на уже отмененных забегах"""
+    return cancel_races(
+        Bet.objects.filter(is_settled=False, race__status='cancelled').values_list('race_id', flat=True).distinct()
+    )
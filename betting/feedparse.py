@@ -0,0 +1,159 @@
+import gzip
+import io
+import json
+import logging
+import re
+from datetime import datetime
+from decimal import Decimal
+from lxml import etree
+from django.utils.dateparse import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+# Сколько символов JSON читать за раз
+JSON_CHUNK_SIZE = 64 * 1024
+
+JSON_RACES_KEY = re.compile(r'"races"\s*:\s*\[')
+
+# Статусы забега в ленте, означающие отмену (снятие) забега
+CANCELLED_STATUSES = {'cancelled', 'canceled', 'scratched', 'abandoned'}
+
+
+def normalize_race(raw):
+    """
+    Привести запись о забеге из ленты к виду
+    {'name', 'start_time', 'cancelled', 'horses': [{'name', 'odds', 'color', 'jockey'}]}.
+    cancelled - лента сообщает, что забег отменен (поле status).
+    Для некорректной записи бросает ValueError
+    """
+    try:
+        name = raw['name']
+        start_time = raw['start_time']
+        if not isinstance(start_time, datetime):
+            start_time = parse_datetime(start_time)
+        if start_time is None:
+            raise ValueError(f'некорректное время старта: {raw["start_time"]}')
+        horses = [
+            {
+                'name': horse['name'],
+                'odds': Decimal(str(horse['odds'])),
+                'color': horse.get('color') or '',
+                'jockey': horse.get('jockey') or '',
+            }
+            for horse in raw.get('horses') or []
+        ]
+    except (KeyError, TypeError, AttributeError, ArithmeticError) as e:
+        raise ValueError(f'некорректный забег: {e!r}')
+    if not name or any(not horse['odds'].is_finite() for horse in horses):
+        raise ValueError('некорректный забег')
+    cancelled = str(raw.get('status') or '').strip().lower() in CANCELLED_STATUSES
+    return {'name': name, 'start_time': start_time, 'cancelled': cancelled, 'horses': horses}
+
+
+def iter_json_races(stream, chunk_size=JSON_CHUNK_SIZE):
+    """
+    Выдавать забеги из JSON-документа по одному, не читая его целиком.
+    Документ - массив забегов или объект с массивом "races".
+    stream - бинарный файловый объект
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig')
+    decoder = json.JSONDecoder()
+    buffer = ''
+    eof = False
+
+    def read_more():
+        nonlocal buffer, eof
+        chunk = text.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer += chunk
+
+    # Ищем начало массива забегов
+    while True:
+        stripped = buffer.lstrip()
+        if stripped.startswith('['):
+            buffer = stripped[1:]
+            break
+        match = JSON_RACES_KEY.search(buffer) if stripped.startswith('{') else None
+        if match:
+            buffer = buffer[match.end():]
+            break
+        if eof:
+            if stripped and not stripped.startswith('{'):
+                raise ValueError('ожидался JSON-массив забегов')
+            return
+        read_more()
+
+    while True:
+        buffer = buffer.lstrip().lstrip(',').lstrip()
+        if buffer.startswith(']'):
+            return
+        try:
+            raw, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            # Объект оборван на границе блока - дочитываем
+            if eof:
+                raise ValueError('JSON-документ оборван')
+            read_more()
+            continue
+        buffer = buffer[end:]
+        yield raw
+
+
+def _element_fields(element, skip=()):
+    """Поля элемента из атрибутов и текстов дочерних элементов"""
+    fields = dict(element.attrib)
+    for child in element:
+        if child.tag not in skip and len(child) == 0:
+            fields[child.tag] = (child.text or '').strip()
+    return fields
+
+
+def iter_xml_races(stream):
+    """
+    Выдавать забеги из XML-документа по одному через iterparse:
+    <races><race name=".." start_time=".."><horse name=".." odds=".."/></race></races>.
+    Поля можно задавать и атрибутами, и дочерними элементами.
+    Обработанные элементы удаляются из дерева, поэтому память не растет
+    с размером файла.
+    """
+    for _, element in etree.iterparse(
+        stream, events=('end',), tag='race', resolve_entities=False, no_network=True
+    ):
+        race = _element_fields(element, skip=('horse', 'horses'))
+        race['horses'] = [_element_fields(horse) for horse in element.iter('horse')]
+        yield race
+
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+def open_feed(path):
+    """Открыть архивный файл ленты, в том числе сжатый gzip"""
+    if str(path).endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def detect_format(stream):
+    """Определить формат по первым байтам: 'xml' или 'json'"""
+    head = stream.peek(64)[:64].lstrip(b'\xef\xbb\xbf \t\r\n')
+    return 'xml' if head.startswith(b'<') else 'json'
+
+
+def iter_races(stream, fmt=None, source_name=''):
+    """
+    Выдавать нормализованные забеги из бинарного потока ленты.
+    Формат определяется по содержимому, если не задан.
+    Некорректные забеги пропускаются с предупреждением в логе
+    """
+    if not hasattr(stream, 'peek'):
+        stream = io.BufferedReader(stream)
+    fmt = fmt or detect_format(stream)
+    records = iter_xml_races(stream) if fmt == 'xml' else iter_json_races(stream)
+    for raw in records:
+        try:
+            yield normalize_race(raw)
+        except ValueError as e:
+            logger.warning('Источник %s: пропущен забег (%s)', source_name, e)
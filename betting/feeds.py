@@ -0,0 +1,287 @@
+import io
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.utils import timezone
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as TransportError
+
+logger = logging.getLogger(__name__)
+
+# Значения по умолчанию для источника из настроек
+DEFAULT_TIMEOUT = 10
+DEFAULT_RETRIES = 3
+# Базовая пауза перед повтором, удваивается с каждой попыткой
+DEFAULT_BACKOFF = 0.5
+DEFAULT_WORKERS = 8
+
+# Ответы, после которых имеет смысл повторить запрос
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Состояния источника
+OK = 'ok'
+NOT_MODIFIED = 'not_modified'
+ERROR = 'error'
+
+
+class FeedError(Exception):
+    """Источник не отдал данные после всех попыток"""
+
+
+class FeedSource:
+    """Источник данных о забегах по HTTP. format - 'json', 'xml' или None (по содержимому)"""
+
+    def __init__(self, name, url, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, format=None):
+        self.name = name
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.format = format
+
+    def __repr__(self):
+        return f'FeedSource({self.name!r}, {self.url!r})'
+
+
+class FeedBody(io.RawIOBase):
+    """
+    Тело ответа источника как бинарный поток: читается по мере разбора,
+    сжатие (gzip, deflate) снимается на лету. Соединение занято, пока
+    поток не закрыт; при закрытии прочитанный объем учитывается в health.
+    Обрыв соединения при чтении превращается в FeedError.
+    """
+
+    def __init__(self, response, on_close):
+        super().__init__()
+        self.response = response
+        self.response.raw.decode_content = True
+        self.on_close = on_close
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            data = self.response.raw.read(len(buffer))
+        except (TransportError, OSError) as e:
+            raise FeedError(f'обрыв при чтении ответа: {e}')
+        size = len(data)
+        buffer[:size] = data
+        self.size += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.response.close()
+            self.on_close(self.size)
+        super().close()
+
+
+class SourceHealth:
+    """
+    Состояние источника: результат последнего опроса, число ошибок подряд
+    и валидаторы (ETag, Last-Modified) для условного GET.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.status = None
+        self.etag = None
+        self.last_modified = None
+        self.last_success = None
+        self.last_error = None
+        self.failures = 0
+        self.requests = 0
+        self.fetched = 0
+        self.not_modified = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'status': self.status,
+            'last_success': self.last_success,
+            'last_error': self.last_error,
+            'failures': self.failures,
+            'requests': self.requests,
+            'fetched': self.fetched,
+            'not_modified': self.not_modified,
+            'bytes': self.bytes,
+            'elapsed': round(self.elapsed, 3),
+        }
+
+
+class FeedFetcher:
+    """
+    Параллельный опрос нескольких источников.
+
+    Все запросы идут через один requests.Session с пулом соединений,
+    поэтому повторные опросы переиспользуют TCP-соединения. Ответы
+    читаются потоком (FeedBody), а не целиком в память. Источник,
+    данные которого не изменились, отвечает 304 на условный GET и не
+    передает тело. Сетевые ошибки и ответы 429/5xx повторяются не более
+    source.retries раз с экспоненциальной паузой; ошибка одного источника
+    не мешает остальным и отражается в health.
+    """
+
+    def __init__(self, sources, max_workers=DEFAULT_WORKERS, backoff=DEFAULT_BACKOFF, session=None):
+        self.sources = list(sources)
+        self.max_workers = max(1, min(max_workers, len(self.sources) or 1))
+        self.backoff = backoff
+        self.session = session or self._make_session()
+        self.health = {source.name: SourceHealth(source.name) for source in self.sources}
+        self.lock = threading.Lock()
+
+    def _make_session(self):
+        session = requests.Session()
+        # Повторы делаем сами, чтобы учитывать их в health
+        # Непрочитанный ответ держит соединение, поэтому соединений не
+        # меньше, чем источников
+        size = len(self.sources) or 1
+        adapter = HTTPAdapter(pool_connections=size, pool_maxsize=max(size, self.max_workers), max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['Accept'] = 'application/json, application/xml'
+        return session
+
+    def close(self):
+        self.session.close()
+
+    def fetch_all(self):
+        """
+        Опросить все источники: запросы уходят параллельно, а ответы
+        выдаются по одному в порядке sources парами (источник, тело).
+        Тело - FeedBody или None, если источник не изменился или
+        недоступен. Следующий ответ выдается после того, как потребитель
+        закончил с предыдущим, и тело закрывается автоматически, поэтому
+        в памяти не держится ни одна лента целиком.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [pool.submit(self._fetch_quietly, source) for source in self.sources]
+            try:
+                for source, future in zip(self.sources, futures):
+                    body = future.result()
+                    try:
+                        yield source, body
+                    finally:
+                        if body is not None:
+                            body.close()
+            finally:
+                # Потребитель остановился раньше - закрываем оставшиеся ответы
+                for future in futures:
+                    if future.cancel() or future.exception() is not None:
+                        continue
+                    if future.result() is not None:
+                        future.result().close()
+
+    def _fetch_quietly(self, source):
+        try:
+            return self.fetch(source)
+        except FeedError as e:
+            logger.warning('Источник %s недоступен: %s', source.name, e)
+            return None
+
+    def fetch(self, source):
+        """
+        Опросить один источник. Возвращает тело ответа (FeedBody, его
+        нужно закрыть) или None, если данные не изменились
+        """
+        health = self.health[source.name]
+        headers = {}
+        if health.etag:
+            headers['If-None-Match'] = health.etag
+        if health.last_modified:
+            headers['If-Modified-Since'] = health.last_modified
+
+        error = None
+        for attempt in range(source.retries + 1):
+            if attempt:
+                # Пауза с разбросом, чтобы повторы к одному источнику не совпадали
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            started = time.perf_counter()
+            try:
+                response = self.session.get(source.url, headers=headers, timeout=source.timeout, stream=True)
+            except requests.RequestException as e:
+                self._record(health, started)
+                error = str(e)
+                continue
+            self._record(health, started)
+
+            if response.status_code != 200:
+                response.close()
+            if response.status_code == 304:
+                with self.lock:
+                    health.status = NOT_MODIFIED
+                    health.not_modified += 1
+                    health.failures = 0
+                    health.last_success = timezone.now()
+                return None
+            if response.status_code in RETRY_STATUSES:
+                error = f'HTTP {response.status_code}'
+                continue
+            if response.status_code != 200:
+                # Остальные ошибки клиента повторять бессмысленно
+                error = f'HTTP {response.status_code}'
+                break
+
+            with self.lock:
+                health.status = OK
+                health.fetched += 1
+                health.failures = 0
+                health.last_success = timezone.now()
+                health.etag = response.headers.get('ETag')
+                health.last_modified = response.headers.get('Last-Modified')
+            return FeedBody(response, lambda size: self._record_bytes(health, size))
+
+        with self.lock:
+            health.status = ERROR
+            health.failures += 1
+            health.last_error = error
+        raise FeedError(error)
+
+    def _record(self, health, started):
+        with self.lock:
+            health.requests += 1
+            health.elapsed += time.perf_counter() - started
+
+    def _record_bytes(self, health, size):
+        with self.lock:
+            health.bytes += size
+
+
+def configured_sources():
+    """Источники из настройки BETTING_FEED_SOURCES"""
+    return [
+        FeedSource(
+            source['name'],
+            source['url'],
+            timeout=source.get('timeout', DEFAULT_TIMEOUT),
+            retries=source.get('retries', DEFAULT_RETRIES),
+            format=source.get('format'),
+        )
+        for source in getattr(settings, 'BETTING_FEED_SOURCES', [])
+    ]
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+def get_fetcher():
+    """
+    Общий для процесса FeedFetcher по настройкам. Живет между опросами,
+    чтобы сохранять соединения и валидаторы условного GET.
+    """
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = FeedFetcher(
+                configured_sources(),
+                max_workers=getattr(settings, 'BETTING_FEED_WORKERS', DEFAULT_WORKERS),
+            )
+        return _fetcher
@@ -0,0 +1,102 @@
+import gzip
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.http import http_date
+
+
+class FeedServer(ThreadingHTTPServer):
+    """
+    Локальная замена источника данных о забегах для тестов и замеров.
+
+    Отдает опубликованные забеги в формате {"races": [...]} с ETag и
+    Last-Modified и отвечает 304 на условный GET. latency задерживает
+    каждый ответ, fail_rate - доля ответов 503, compress - отдавать
+    тело сжатым gzip (Content-Encoding), если клиент это принимает.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), races=(), latency=0.0, fail_rate=0.0, compress=False):
+        super().__init__(address, FeedRequestHandler)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.compress = compress
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.publish(races)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/races'
+
+    def publish(self, races):
+        """Заменить отдаваемые забеги"""
+        body = json.dumps({'races': list(races)}, cls=DjangoJSONEncoder).encode()
+        with self.lock:
+            self.body = body
+            self.etag = '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+            self.last_modified = http_date()
+
+    def start(self):
+        """Запустить сервер в фоновом потоке"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Клиент закрыл соединение, не дочитав поток ответа, - это не ошибка
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            body, etag, last_modified = server.body, server.etag, server.last_modified
+
+        if server.latency:
+            time.sleep(server.latency)
+        if server.fail_rate and random.random() < server.fail_rate:
+            self._respond(503, b'')
+            return
+        if self.headers.get('If-None-Match') == etag or (
+            not self.headers.get('If-None-Match') and self.headers.get('If-Modified-Since') == last_modified
+        ):
+            self._respond(304, b'', etag, last_modified)
+            return
+        encoding = None
+        if server.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body, encoding = gzip.compress(body), 'gzip'
+        self._respond(200, body, etag, last_modified, encoding)
+
+    def _respond(self, status, body, etag=None, last_modified=None, encoding=None):
+        self.send_response(status)
+        if status == 200:
+            self.send_header('Content-Type', 'application/json')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,180 @@
+from decimal import Decimal
+from itertools import islice
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from .caching import invalidate_races
+from .cancellation import CANCELLABLE_STATUSES, cancel_races
+from .models import Race, Horse
+
+# Размер пачки для выборки существующих забегов и для bulk_create
+INGEST_BATCH_SIZE = 500
+
+
+def _race_key(race_data):
+    start_time = race_data['start_time']
+    if timezone.is_naive(start_time):
+        start_time = timezone.make_aware(start_time)
+    return race_data['name'], start_time
+
+
+def existing_races(keys):
+    """
+    Забеги из keys, уже записанные в базу:
+    {(название, время старта): (id, статус)}
+    """
+    names = sorted({name for name, _ in keys})
+    found = {}
+    for i in range(0, len(names), INGEST_BATCH_SIZE):
+        for name, start_time, pk, status in Race.objects.filter(
+            name__in=names[i:i + INGEST_BATCH_SIZE]
+        ).values_list('name', 'start_time', 'pk', 'status'):
+            if (name, start_time) in keys:
+                found[name, start_time] = (pk, status)
+    return found
+
+
+def sync_odds(existing, by_key):
+    """
+    Применить коэффициенты из ленты к уже загруженным открытым забегам.
+
+    Лошади всех открытых забегов пачки читаются одним проходом,
+    сравниваются с лентой по (забег, кличка), и только изменившиеся
+    строки записываются через bulk_update с увеличением odds_version.
+    Стоимость обновления пропорциональна числу изменений, а не размеру
+    программы. Возвращает количество обновленных лошадей.
+    """
+    incoming = {}
+    for key, (race_id, status) in existing.items():
+        if status != 'scheduled':
+            continue
+        for horse_data in by_key[key]['horses']:
+            incoming[race_id, horse_data['name']] = Decimal(horse_data['odds']).quantize(Decimal('0.01'))
+    if not incoming:
+        return 0
+
+    race_ids = sorted({race_id for race_id, _ in incoming})
+    changed = []
+    for i in range(0, len(race_ids), INGEST_BATCH_SIZE):
+        for horse_id, race_id, name, odds in Horse.objects.filter(
+            race_id__in=race_ids[i:i + INGEST_BATCH_SIZE]
+        ).values_list('id', 'race_id', 'name', 'odds'):
+            new = incoming.get((race_id, name))
+            if new is not None and new != odds:
+                changed.append(Horse(id=horse_id, odds=new, odds_version=F('odds_version') + 1))
+
+    Horse.objects.bulk_update(changed, ['odds', 'odds_version'], batch_size=INGEST_BATCH_SIZE)
+    return len(changed)
+
+
+def cancel_scratched(existing, by_key):
+    """
+    Отменить уже загруженные забеги, которые лента сообщает
+    отмененными, с возвратом ставок (cancellation.cancel_races).
+    Статусы в existing обновляются. Возвращает количество отмененных забегов
+    """
+    scratched = {
+        key: race_id for key, (race_id, status) in existing.items()
+        if by_key[key].get('cancelled') and status in CANCELLABLE_STATUSES
+    }
+    if not scratched:
+        return 0
+    for key, race_id in scratched.items():
+        existing[key] = (race_id, 'cancelled')
+    return cancel_races(scratched.values(), 'по данным ленты')['races']
+
+
+def ingest_races(races_data):
+    """
+    Записать забеги из ленты вместе с лошадьми.
+
+    Существующие забеги определяются пачкой запросов по естественному
+    ключу (название, время старта), новые забеги и их лошади создаются
+    через bulk_create в одной транзакции. У уже загруженных забегов
+    обновляются только изменившиеся коэффициенты (sync_odds), поэтому
+    повторная загрузка той же ленты ничего не меняет. Если параллельная
+    загрузка успела записать те же забеги, уникальное ограничение
+    откатывает пачку и она повторяется.
+
+    Возвращает {'races': создано забегов, 'horses': создано лошадей,
+    'skipped': пропущено существующих, 'odds_updated': обновлено
+    коэффициентов, 'cancelled': отменено забегов}. Забеги, которые
+    лента сообщает отмененными, отменяются с возвратом ставок.
+    """
+    by_key = {}
+    for race_data in races_data:
+        by_key.setdefault(_race_key(race_data), race_data)
+
+    try:
+        return _ingest(by_key)
+    except IntegrityError:
+        return _ingest(by_key)
+
+
+def _ingest(by_key):
+    with transaction.atomic():
+        existing = existing_races(by_key)
+        cancelled = cancel_scratched(existing, by_key)
+        odds_updated = sync_odds(existing, by_key)
+        new_keys = [key for key in by_key if key not in existing]
+
+        races = Race.objects.bulk_create(
+            [
+                Race(
+                    name=name, start_time=start_time,
+                    status='cancelled' if by_key[name, start_time].get('cancelled') else 'scheduled',
+                )
+                for name, start_time in new_keys
+            ],
+            batch_size=INGEST_BATCH_SIZE,
+        )
+        if races and races[0].pk is None:
+            # Бэкенд не вернул первичные ключи - дочитываем их по ключу
+            ids = {}
+            names = sorted({name for name, _ in new_keys})
+            for i in range(0, len(names), INGEST_BATCH_SIZE):
+                ids.update(
+                    ((name, start_time), pk) for pk, name, start_time in Race.objects.filter(
+                        name__in=names[i:i + INGEST_BATCH_SIZE]
+                    ).values_list('pk', 'name', 'start_time')
+                )
+            for race in races:
+                race.pk = ids[race.name, race.start_time]
+
+        horses = Horse.objects.bulk_create(
+            [
+                Horse(
+                    race=race,
+                    name=horse_data['name'],
+                    odds=horse_data['odds'],
+                    color=horse_data.get('color', ''),
+                    jockey=horse_data.get('jockey', ''),
+                )
+                for race, key in zip(races, new_keys)
+                for horse_data in by_key[key]['horses']
+            ],
+            batch_size=INGEST_BATCH_SIZE,
+        )
+
+        # bulk_create и bulk_update не отправляют сигналы моделей
+        if races or odds_updated:
+            invalidate_races()
+
+    return {
+        'races': len(races), 'horses': len(horses), 'skipped': len(existing),
+        'odds_updated': odds_updated, 'cancelled': cancelled,
+    }
+
+
+def ingest_stream(races_data, batch_size=INGEST_BATCH_SIZE):
+    """
+    Записать поток забегов пачками по batch_size через ingest_races.
+    В памяти одновременно держится только одна пачка, поэтому поток
+    может быть сколь угодно длинным. Возвращает суммарные счетчики
+    """
+    totals = {'races': 0, 'horses': 0, 'skipped': 0, 'odds_updated': 0, 'cancelled': 0}
+    races_data = iter(races_data)
+    while batch := list(islice(races_data, batch_size)):
+        for key, value in ingest_races(batch).items():
+            totals[key] += value
+    return totals
@@ -0,0 +1,192 @@
+from collections import Counter, defaultdict
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, Q, Sum, When
+from django.utils import timezone
+from .caching import invalidate_users
+from .models import BalanceCheckpoint, Transaction, UserProfile
+from .utils import bulk_increment
+
+# Контрольная точка баланса - после каждой CHECKPOINT_INTERVAL-й операции
+CHECKPOINT_INTERVAL = 100
+# Размер пачки для bulk_create операций журнала
+LEDGER_BATCH_SIZE = 1000
+
+OPENING_DESCRIPTION = 'Начальный баланс'
+
+
+class InsufficientFunds(Exception):
+    """На счете недостаточно средств для списания"""
+
+
+def signed_amount(transaction_type, amount):
+    """Изменение баланса операцией transaction_type на сумму amount"""
+    return -amount if transaction_type in Transaction.DEBIT_TYPES else amount
+
+
+def signed_amount_sum():
+    """Выражение для aggregate: сумма операций журнала со знаком"""
+    return Sum(
+        Case(
+            When(transaction_type__in=Transaction.DEBIT_TYPES, then=-F('amount')),
+            default=F('amount'),
+        ),
+        output_field=DecimalField(max_digits=14, decimal_places=2),
+    )
+
+
+def _checkpoints(entries, counts):
+    """
+    Контрольные точки для только что записанных операций.
+    counts - {user_id: операций у пользователя до записи}; точка
+    ставится на каждую операцию, номер которой кратен CHECKPOINT_INTERVAL
+    """
+    counts = dict(counts)
+    checkpoints = []
+    for entry in entries:
+        counts[entry.user_id] += 1
+        if counts[entry.user_id] % CHECKPOINT_INTERVAL == 0:
+            checkpoints.append(BalanceCheckpoint(
+                user_id=entry.user_id, entry=entry, balance=entry.balance_after,
+                entries=counts[entry.user_id], created_at=entry.created_at,
+            ))
+    BalanceCheckpoint.objects.bulk_create(checkpoints, batch_size=LEDGER_BATCH_SIZE)
+
+
+def post(user_id, transaction_type, amount, description=''):
+    """
+    Записать одну операцию в журнал и изменить баланс.
+
+    Списание - условный UPDATE баланса (balance >= суммы), поэтому
+    параллельные операции не уводят баланс в минус; при нехватке
+    средств бросает InsufficientFunds. UPDATE блокирует строку профиля
+    до конца транзакции, так что операции пользователя записываются
+    в журнал строго по очереди и balance_after образует цепочку.
+    Возвращает созданную запись журнала.
+    """
+    return post_many([Transaction(
+        user_id=user_id, transaction_type=transaction_type, amount=amount, description=description,
+    )])[0]
+
+
+def post_many(entries, now=None):
+    """
+    Записать пачку операций (несохраненных Transaction) одной
+    транзакцией: начисления всем пользователям - одним
+    UPDATE ... CASE на пачку (см. utils.bulk_increment), списания -
+    условным UPDATE на пользователя, затем чтение новых балансов,
+    bulk_create операций с посчитанным balance_after и контрольных точек
+    (по запросу на пачку пользователей). Число запросов на начисления
+    не зависит от количества операций. Бросает InsufficientFunds, если
+    списание увело бы баланс в минус.
+    """
+    entries = list(entries)
+    if not entries:
+        return entries
+    with transaction.atomic():
+        _apply(entries, now or timezone.now())
+        return record(entries)
+
+
+def debit(user_id, amount, transaction_type='bet', description=''):
+    """
+    Условно списать amount первым запросом транзакции, когда данные
+    для записи в журнал (например, описание) еще читаются. Возвращает
+    несохраненную операцию: ее нужно дописать и передать в record()
+    в той же транзакции. Бросает InsufficientFunds.
+    """
+    if not transaction.get_connection().in_atomic_block:
+        raise transaction.TransactionManagementError('ledger.debit() вызывается только внутри транзакции')
+    entry = Transaction(user_id=user_id, transaction_type=transaction_type, amount=amount, description=description)
+    _apply([entry], timezone.now())
+    return entry
+
+
+def _apply(entries, now):
+    """Изменить балансы и счетчики операций профилей на сумму entries"""
+    deltas = defaultdict(Decimal)
+    added = Counter()
+    for entry in entries:
+        deltas[entry.user_id] += signed_amount(entry.transaction_type, entry.amount)
+        added[entry.user_id] += 1
+
+    credits = {}
+    for user_id, delta in deltas.items():
+        if delta >= 0:
+            credits[user_id] = {'balance': delta, 'ledger_entries': added[user_id]}
+            continue
+        debited = UserProfile.objects.filter(user_id=user_id, balance__gte=-delta).update(
+            balance=F('balance') + delta,
+            ledger_entries=F('ledger_entries') + added[user_id],
+            updated_at=now,
+        )
+        if not debited:
+            raise InsufficientFunds('Недостаточно средств')
+    bulk_increment(UserProfile, 'user_id', credits, updated_at=now)
+    # Баланс закэширован вместе с пользователем (betting/profiles.py)
+    invalidate_users(deltas)
+
+
+def record(entries):
+    """
+    Сохранить операции, балансы профилей по которым уже изменены
+    (_apply или debit): balance_after считается от нового баланса
+    назад по пачке, затем bulk_create операций и контрольных точек
+    """
+    added = Counter(entry.user_id for entry in entries)
+    balances = {}
+    user_ids = list(added)
+    for i in range(0, len(user_ids), LEDGER_BATCH_SIZE):
+        balances.update(
+            (user_id, (balance, count))
+            for user_id, balance, count in UserProfile.objects.filter(
+                user_id__in=user_ids[i:i + LEDGER_BATCH_SIZE]
+            ).values_list('user_id', 'balance', 'ledger_entries')
+        )
+    if len(balances) != len(added):
+        raise UserProfile.DoesNotExist('Нет профиля для записи в журнал')
+
+    running = {user_id: balance for user_id, (balance, _) in balances.items()}
+    for entry in reversed(entries):
+        entry.balance_after = running[entry.user_id]
+        running[entry.user_id] -= signed_amount(entry.transaction_type, entry.amount)
+
+    entries = Transaction.objects.bulk_create(entries, batch_size=LEDGER_BATCH_SIZE)
+    _checkpoints(entries, {user_id: count - added[user_id] for user_id, (_, count) in balances.items()})
+    return entries
+
+
+def open_account(profile):
+    """Первая запись журнала нового счета - начальный баланс профиля"""
+    with transaction.atomic():
+        Transaction.objects.create(
+            user_id=profile.user_id, transaction_type='adjustment', amount=profile.balance,
+            description=OPENING_DESCRIPTION, balance_after=profile.balance,
+        )
+        UserProfile.objects.filter(pk=profile.pk).update(ledger_entries=F('ledger_entries') + 1)
+
+
+def current_balance(user_id):
+    """Текущий баланс - balance_after последней операции журнала"""
+    balance = Transaction.objects.filter(user_id=user_id).order_by('-created_at', '-id').values_list(
+        'balance_after', flat=True
+    ).first()
+    return balance if balance is not None else Decimal('0')
+
+
+def balance_at(user_id, when):
+    """
+    Баланс пользователя на момент when: ближайшая контрольная точка не
+    позже when и сумма не более CHECKPOINT_INTERVAL операций после нее.
+    Полная история журнала не суммируется.
+    """
+    checkpoint = BalanceCheckpoint.objects.filter(user_id=user_id, created_at__lte=when).order_by(
+        '-created_at', '-entry_id'
+    ).values_list('created_at', 'entry_id', 'balance').first()
+
+    replay = Transaction.objects.filter(user_id=user_id, created_at__lte=when)
+    balance = Decimal('0')
+    if checkpoint is not None:
+        created_at, entry_id, balance = checkpoint
+        replay = replay.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=entry_id))
+    return balance + (replay.aggregate(total=signed_amount_sum())['total'] or 0)
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import logging
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from .models import Race, Horse
+
+logger = logging.getLogger(__name__)
+
+# Период опроса базы общей лентой изменений, секунд
+DEFAULT_POLL_INTERVAL = 1.0
+# Сколько событий может ждать отправки одному подписчику
+SUBSCRIBER_QUEUE_SIZE = 256
+# Период пустых комментариев, чтобы прокси не закрывали соединение
+HEARTBEAT_INTERVAL = 15
+
+OPEN_STATUSES = ('scheduled', 'in_progress')
+
+
+class Subscription:
+    """Подписчик хаба: очередь событий и забеги, на которые он подписан"""
+
+    def __init__(self, race_ids=None, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        self.race_ids = set(race_ids) if race_ids else None
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.initial = []
+        self.lagged = False
+
+    def wants(self, race_id):
+        return self.race_ids is None or race_id in self.race_ids
+
+
+class RaceEventHub:
+    """
+    Рассылка изменений коэффициентов, статусов и победителей забегов.
+
+    Одна фоновая задача на процесс опрашивает базу раз в interval и
+    сравнивает результат со снимком в памяти; найденные изменения
+    раскладываются по очередям подписчиков. Стоимость опроса не зависит
+    от числа подписчиков. Задача запускается с первым подписчиком и
+    останавливается, когда уходит последний. Подписчик, не успевающий
+    читать события, отключается: клиент переподключится и получит
+    свежий снимок.
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval
+        self.subscribers = set()
+        self.races = {}   # id забега -> (статус, id победителя)
+        self.horses = {}  # id лошади -> (id забега, коэффициент, версия)
+        self.sequence = 0
+        self.loaded = False
+        self.task = None
+        self.ready = None
+
+    def get_interval(self):
+        if self.interval is not None:
+            return self.interval
+        return getattr(settings, 'BETTING_LIVE_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)
+
+    async def subscribe(self, race_ids=None):
+        """Подписаться на события. subscription.initial - снимок текущего состояния"""
+        self._ensure_running()
+        subscription = Subscription(race_ids)
+        await self.ready.wait()
+        subscription.initial = self.snapshot(subscription)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            # Новый цикл событий (или задача завершилась) - начинаем заново
+            self.races, self.horses, self.loaded = {}, {}, False
+            self.ready = asyncio.Event()
+            self.task = loop.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while True:
+                try:
+                    await self.poll()
+                except Exception:
+                    logger.exception('Не удалось опросить изменения забегов')
+                self.ready.set()
+                await asyncio.sleep(self.get_interval())
+                if not self.subscribers:
+                    return
+        finally:
+            self.ready.set()
+
+    async def poll(self):
+        """Один опрос базы: сравнить со снимком и разослать изменения"""
+        tracked = [race_id for race_id, (status, _) in self.races.items() if status in OPEN_STATUSES]
+        races = {
+            race_id: (status, winner_id)
+            async for race_id, status, winner_id in Race.objects.filter(
+                Q(status__in=OPEN_STATUSES) | Q(id__in=tracked)
+            ).values_list('id', 'status', 'winner_id')
+        }
+        horses = {
+            horse_id: (race_id, odds, version)
+            async for horse_id, race_id, odds, version in Horse.objects.filter(
+                race_id__in=[race_id for race_id, (status, _) in races.items() if status in OPEN_STATUSES]
+            ).values_list('id', 'race_id', 'odds', 'odds_version')
+        }
+
+        events = []
+        for race_id, (status, winner_id) in races.items():
+            old_status, old_winner = self.races.get(race_id, (None, None))
+            if status != old_status:
+                events.append(self._event('status', race_id, status=status))
+            if winner_id and winner_id != old_winner:
+                events.append(self._event('winner', race_id, horse_id=winner_id))
+        for horse_id, (race_id, odds, version) in horses.items():
+            known = self.horses.get(horse_id)
+            if known is None or known[2] != version:
+                events.append(self._event('odds', race_id, horse_id=horse_id, odds=odds, odds_version=version))
+
+        # Завершенные забеги больше не отслеживаем
+        self.races = {race_id: state for race_id, state in races.items() if state[0] in OPEN_STATUSES}
+        self.horses = horses
+        # Первый опрос только заполняет снимок
+        if self.loaded:
+            self.publish(events)
+        self.loaded = True
+
+    def _event(self, kind, race_id, **data):
+        self.sequence += 1
+        return {'id': self.sequence, 'event': kind, 'race_id': race_id, **data}
+
+    def publish(self, events):
+        for subscription in list(self.subscribers):
+            for event in events:
+                if not subscription.wants(event['race_id']):
+                    continue
+                try:
+                    subscription.queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    subscription.lagged = True
+                    self.unsubscribe(subscription)
+                    break
+
+    def snapshot(self, subscription):
+        """Текущее состояние забегов подписчика в виде событий"""
+        events = []
+        for race_id, (status, _) in self.races.items():
+            if subscription.wants(race_id):
+                events.append({'id': self.sequence, 'event': 'status', 'race_id': race_id, 'status': status})
+        for horse_id, (race_id, odds, version) in self.horses.items():
+            if subscription.wants(race_id):
+                events.append({
+                    'id': self.sequence, 'event': 'odds', 'race_id': race_id,
+                    'horse_id': horse_id, 'odds': odds, 'odds_version': version,
+                })
+        return events
+
+
+def format_event(event):
+    """Событие в формате text/event-stream"""
+    data = {key: value for key, value in event.items() if key not in ('id', 'event')}
+    return f'id: {event["id"]}\nevent: {event["event"]}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n'
+
+
+async def stream_events(subscription, hub):
+    """Поток SSE для подписчика; отписывает его при отключении клиента"""
+    try:
+        yield 'retry: 3000\n\n'
+        for event in subscription.initial:
+            yield format_event(event)
+        subscription.initial = []
+        while True:
+            if subscription.lagged and subscription.queue.empty():
+                # Отстал - закрываем поток, браузер переподключится
+                return
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ': ping\n\n'
+                continue
+            yield format_event(event)
+    finally:
+        hub.unsubscribe(subscription)
+
+
+hub = RaceEventHub()
@@ -0,0 +1,45 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from betting.feedparse import iter_races, open_feed
+from betting.ingest import INGEST_BATCH_SIZE, ingest_stream
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class Command(BaseCommand):
+    help = 'Загрузка забегов из архивных файлов ленты (JSON или XML, в том числе .gz)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='Файлы ленты')
+        parser.add_argument('--format', choices=['json', 'xml'], help='Формат файлов (по умолчанию по содержимому)')
+        parser.add_argument('--batch-size', type=int, default=INGEST_BATCH_SIZE, help='Забегов в пачке записи')
+
+    def handle(self, *args, **options):
+        for path in options['paths']:
+            started = time.perf_counter()
+            try:
+                with open_feed(path) as stream:
+                    counts = ingest_stream(
+                        iter_races(stream, options['format'], path),
+                        batch_size=options['batch_size'],
+                    )
+            except OSError as e:
+                raise CommandError(f'Не удалось прочитать {path}: {e}')
+            except ValueError as e:
+                raise CommandError(f'Не удалось разобрать {path}: {e}')
+
+            self.stdout.write(
+                f'{path}: создано забегов {counts["races"]}, лошадей {counts["horses"]}, '
+                f'уже загружено {counts["skipped"]}, обновлено коэффициентов {counts["odds_updated"]}, '
+                f'отменено {counts["cancelled"]} за {time.perf_counter() - started:.2f} с'
+            )
+
+        if resource is None:
+            self.stdout.write(self.style.SUCCESS('Готово'))
+            return
+        # ru_maxrss - в килобайтах в Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        self.stdout.write(self.style.SUCCESS(f'Готово. Пиковая память процесса: {peak:.0f} МБ'))
@@ -0,0 +1,66 @@
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from ippodrom.databases import PROFILES
+
+
+class Command(BaseCommand):
+    help = 'Сравнение пропускной способности размещения ставок на разных профилях базы данных'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profiles', default='sqlite-legacy,sqlite',
+            help=f'Профили через запятую ({", ".join(PROFILES)}); postgres берет параметры из IPPODROM_DB_*'
+        )
+        parser.add_argument('--threads', type=int, default=16, help='Потоков размещения ставок')
+        parser.add_argument('--bets', type=int, default=1000, help='Попыток ставок на профиль')
+        parser.add_argument('--users', type=int, default=8, help='Количество игроков')
+
+    def handle(self, *args, **options):
+        profiles = [profile.strip() for profile in options['profiles'].split(',') if profile.strip()]
+        unknown = set(profiles) - set(PROFILES)
+        if unknown:
+            raise CommandError(f'Неизвестные профили: {", ".join(sorted(unknown))}')
+
+        results = []
+        for profile in profiles:
+            self.stdout.write(self.style.MIGRATE_HEADING(f'Профиль {profile}'))
+            results.append((profile, self._run(profile, options)))
+
+        self.stdout.write(f'\n{"профиль":<15} {"принято":>8} {"ставок/с":>10} {"ошибок БД":>10}')
+        for profile, result in results:
+            if result is None:
+                self.stdout.write(f'{profile:<15} {"-":>8} {"-":>10} {"-":>10}')
+            else:
+                self.stdout.write(f'{profile:<15} {result["accepted"]:>8} {result["rate"]:>10} {result["db_errors"]:>10}')
+
+    def _run(self, profile, options):
+        """
+        Прогнать bench_placement в отдельном процессе с профилем
+        profile. SQLite-профили работают на временной копии схемы,
+        чтобы режим журнала не переключал основную базу
+        """
+        manage = [sys.executable, str(settings.BASE_DIR / 'manage.py')]
+        with tempfile.TemporaryDirectory(prefix='bench_db_') as directory:
+            env = {**os.environ, 'IPPODROM_DB': profile, 'IPPODROM_DB_PATH': os.path.join(directory, 'bench.sqlite3')}
+            steps = [
+                manage + ['migrate', '-v0'],
+                manage + [
+                    'bench_placement', '--threads', str(options['threads']), '--bets', str(options['bets']),
+                    '--users', str(options['users']),
+                ],
+            ]
+            for step in steps:
+                completed = subprocess.run(step, env=env, capture_output=True, text=True)
+                self.stdout.write(completed.stdout, ending='')
+                if completed.returncode:
+                    self.stderr.write(self.style.ERROR(completed.stderr.strip().splitlines()[-1]))
+                    return None
+
+        accepted = re.search(r'Принято: (\d+) \((\d+) в секунду\)', completed.stdout)
+        errors = re.search(r'Ошибок БД: (\d+)', completed.stdout)
+        return {'accepted': int(accepted[1]), 'rate': int(accepted[2]), 'db_errors': int(errors[1])}
@@ -0,0 +1,77 @@
+import random
+from datetime import timedelta
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from betting.models import Race, Horse, Bet, Notification
+from betting.notifications import FAN_OUT_CHUNK_SIZE, fan_out_race_results
+
+
+class Command(BaseCommand):
+    help = 'Замер рассылки результатов забега всем сделавшим ставки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bettors', type=int, default=100000, help='Пользователей, сделавших ставки')
+        parser.add_argument('--bets-per-user', type=int, default=2, help='Ставок на пользователя')
+        parser.add_argument('--workers', default='1,4', help='Количества потоков через запятую')
+        parser.add_argument('--chunk-size', type=int, default=FAN_OUT_CHUNK_SIZE, help='Строк в блоке чтения ставок')
+
+    def handle(self, *args, **options):
+        # Потоки рассылки читают данные своими соединениями, поэтому
+        # данные бенчмарка фиксируются и удаляются в конце
+        race, users = self._seed(options['bettors'], options['bets_per_user'])
+        try:
+            self.stdout.write(f'{"потоков":>8} {"пользователей":>14} {"ставок":>10} {"время, с":>10} {"польз./с":>10}')
+            for workers in [int(value) for value in options['workers'].split(',')]:
+                Notification.objects.filter(race=race).delete()
+                result = fan_out_race_results(race, workers=workers, chunk_size=options['chunk_size'])
+                self.stdout.write(
+                    f'{workers:>8} {result["users"]:>14} {result["bets"]:>10} '
+                    f'{result["elapsed"]:>10.2f} {result["rate"]:>10.0f}'
+                )
+            self.stdout.write(self.style.SUCCESS(
+                f'Уведомлений в очереди: {Notification.objects.filter(race=race).count()}'
+            ))
+        finally:
+            Notification.objects.filter(race=race).delete()
+            Bet.objects.filter(race=race).delete()
+            race.delete()
+            for i in range(0, len(users), 5000):
+                User.objects.filter(id__in=users[i:i + 5000]).delete()
+
+    def _seed(self, bettors, bets_per_user):
+        with transaction.atomic():
+            prefix = f'fanout_{timezone.now():%H%M%S}'
+            User.objects.bulk_create(
+                [User(username=f'{prefix}_{i}', email=f'{prefix}_{i}@example.com') for i in range(bettors)],
+                batch_size=5000,
+            )
+            users = list(User.objects.filter(username__startswith=f'{prefix}_').values_list('id', flat=True))
+
+            race = Race.objects.create(
+                name=f'Бенчмарк рассылки {prefix}',
+                start_time=timezone.now() - timedelta(minutes=5),
+                status='finished',
+            )
+            horses = Horse.objects.bulk_create([
+                Horse(race=race, name=f'Лошадь {i}', odds=Decimal(random.randint(150, 900)) / 100)
+                for i in range(8)
+            ])
+            race.winner = horses[0]
+            race.save()
+
+            bets = []
+            for user_id in users:
+                for _ in range(bets_per_user):
+                    horse = random.choice(horses)
+                    bets.append(Bet(
+                        user_id=user_id, race=race, horse=horse, amount=Decimal('100'), odds=horse.odds,
+                        potential_win=Decimal('100') * horse.odds, is_settled=True, is_winner=horse == horses[0],
+                    ))
+                if len(bets) >= 10000:
+                    Bet.objects.bulk_create(bets)
+                    bets = []
+            Bet.objects.bulk_create(bets)
+        return race, users
@@ -0,0 +1,75 @@
+import time
+from django.core.management.base import BaseCommand
+from betting.feedparse import iter_races
+from betting.feeds import FeedFetcher, FeedSource
+from betting.feedserver import FeedServer
+from betting.parsers import RaceDataParser
+
+
+class Command(BaseCommand):
+    help = 'Замер параллельного опроса источников на локальных серверах-заменителях'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sources', type=int, default=8, help='Количество источников')
+        parser.add_argument('--rounds', type=int, default=5, help='Количество опросов')
+        parser.add_argument('--races', type=int, default=50, help='Забегов в каждом источнике')
+        parser.add_argument('--latency', type=float, default=0.2, help='Задержка ответа источника, с')
+        parser.add_argument('--fail-rate', type=float, default=0.0, help='Доля ответов 503')
+        parser.add_argument('--workers', type=int, default=8, help='Потоков опроса')
+        parser.add_argument('--change-every', type=int, default=0,
+                            help='Публиковать новые данные каждые N опросов (0 - никогда)')
+
+    def handle(self, *args, **options):
+        servers = []
+        for i in range(options['sources']):
+            server = FeedServer(
+                races=self._races(options['races']),
+                latency=options['latency'],
+                fail_rate=options['fail_rate'],
+            )
+            server.start()
+            servers.append(server)
+
+        fetcher = FeedFetcher(
+            [FeedSource(f'source-{i}', server.url, retries=2) for i, server in enumerate(servers)],
+            max_workers=options['workers'],
+            backoff=0.05,
+        )
+        try:
+            for round_number in range(1, options['rounds'] + 1):
+                started = time.perf_counter()
+                # Ответы разбираются прямо из потока, по одному источнику за раз
+                races = sum(
+                    sum(1 for _ in iter_races(body))
+                    for _, body in fetcher.fetch_all() if body is not None
+                )
+                elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f'Опрос {round_number}: {elapsed:.2f} с, получено забегов {races}, '
+                    f'без изменений {sum(h.status == "not_modified" for h in fetcher.health.values())}, '
+                    f'с ошибкой {sum(h.status == "error" for h in fetcher.health.values())}'
+                )
+                if options['change_every'] and round_number % options['change_every'] == 0:
+                    for server in servers:
+                        server.publish(self._races(options['races']))
+        finally:
+            fetcher.close()
+            for server in servers:
+                server.stop()
+
+        self.stdout.write('Источники:')
+        for health in fetcher.health.values():
+            self.stdout.write(
+                f'  {health.name}: {health.status}, запросов {health.requests}, '
+                f'получено {health.fetched}, 304 {health.not_modified}, '
+                f'{health.bytes} байт, ошибок подряд {health.failures}'
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f'Сервера обработали {sum(server.requests for server in servers)} запросов'
+        ))
+
+    def _races(self, count):
+        races = []
+        while len(races) < count:
+            races.extend(RaceDataParser._generate_realistic_data())
+        return races[:count]
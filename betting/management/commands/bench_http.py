@@ -0,0 +1,130 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    """
+    Сервер нужно запустить заранее, на той же машине и с тем же числом
+    процессов, например:
+
+        gunicorn ippodrom.wsgi -w 4 --threads 8 -b 127.0.0.1:8001
+        uvicorn ippodrom.asgi:application --workers 4 --port 8002
+
+    и затем:
+
+        python manage.py bench_http --target wsgi=http://127.0.0.1:8001/api/races/ \\
+            --target asgi=http://127.0.0.1:8002/api/races/
+
+    Для каждого уровня параллельности открывается столько соединений,
+    каждое в цикле шлет запросы в течение --duration секунд. Команда
+    сообщает запросы в секунду, задержки p50/p99 и число ошибок.
+    """
+
+    help = 'Сравнение пропускной способности эндпоинтов под WSGI и ASGI'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--target', action='append', required=True,
+            help='Имя и адрес в виде name=url, можно указать несколько раз',
+        )
+        parser.add_argument('--concurrency', default='10,50,200,500', help='Уровни параллельности через запятую')
+        parser.add_argument('--duration', type=float, default=10, help='Длительность каждого замера, с')
+        parser.add_argument('--timeout', type=float, default=10, help='Таймаут одного запроса, с')
+
+    def handle(self, *args, **options):
+        targets = []
+        for target in options['target']:
+            name, sep, url = target.partition('=')
+            parts = urlsplit(url)
+            if not sep or parts.scheme != 'http' or not parts.hostname:
+                raise CommandError(f'Неверная цель "{target}", ожидается name=http://host:port/path')
+            targets.append((name, parts))
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',')]
+        except ValueError:
+            raise CommandError('--concurrency должен быть списком чисел')
+
+        for level in levels:
+            for name, parts in targets:
+                result = asyncio.run(self._measure(parts, level, options['duration'], options['timeout']))
+                self._report(name, level, result)
+
+    async def _measure(self, parts, concurrency, duration, timeout):
+        latencies = []
+        errors = 0
+        deadline = time.perf_counter() + duration
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        request = (
+            f'GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nConnection: keep-alive\r\n\r\n'
+        ).encode()
+
+        async def client():
+            nonlocal errors
+            reader = writer = None
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    if writer is None:
+                        reader, writer = await asyncio.wait_for(
+                            asyncio.open_connection(parts.hostname, parts.port or 80), timeout
+                        )
+                    writer.write(request)
+                    status, keep_alive = await asyncio.wait_for(self._read_response(reader), timeout)
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                    errors += 1
+                    writer = self._close(writer)
+                    continue
+                if status == 200:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors += 1
+                if not keep_alive:
+                    writer = self._close(writer)
+            self._close(writer)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return latencies, errors, time.perf_counter() - started
+
+    async def _read_response(self, reader):
+        """Прочитать ответ целиком. Возвращает (код, можно ли переиспользовать соединение)"""
+        status_line = await reader.readuntil(b'\r\n')
+        status = int(status_line.split()[1])
+        length = None
+        keep_alive = status_line.startswith(b'HTTP/1.1')
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            header, _, value = line.decode('latin-1').partition(':')
+            header = header.strip().lower()
+            if header == 'content-length':
+                length = int(value)
+            elif header == 'connection':
+                keep_alive = value.strip().lower() == 'keep-alive'
+        if length is None:
+            # Без Content-Length тело заканчивается закрытием соединения
+            await reader.read()
+            return status, False
+        await reader.readexactly(length)
+        return status, keep_alive
+
+    def _close(self, writer):
+        if writer is not None:
+            writer.close()
+        return None
+
+    def _report(self, name, concurrency, result):
+        latencies, errors, elapsed = result
+        latencies.sort()
+        if latencies:
+            p50 = latencies[len(latencies) // 2] * 1000
+            p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000
+            timing = f'p50 {p50:.1f} мс, p99 {p99:.1f} мс'
+        else:
+            timing = 'нет успешных ответов'
+        self.stdout.write(
+            f'{name:>6} x{concurrency:<5} {len(latencies) / elapsed:8.0f} запросов/с, {timing}, ошибок: {errors}'
+        )
@@ -0,0 +1,86 @@
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from betting.ingest import ingest_races
+from betting.models import Race, Horse
+
+
+class Command(BaseCommand):
+    help = 'Замер загрузки большой ленты забегов (данные откатываются)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--races', type=int, default=10000, help='Количество забегов в ленте')
+        parser.add_argument('--horses', type=int, default=8, help='Лошадей в забеге')
+        parser.add_argument('--changed', type=float, default=0.01, help='Доля лошадей с новым коэффициентом')
+
+    def handle(self, *args, **options):
+        races_data = self._feed(options['races'], options['horses'])
+        races_before = Race.objects.count()
+
+        with transaction.atomic():
+            started = time.perf_counter()
+            counts = ingest_races(races_data)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f'Первая загрузка: {elapsed:.2f} с, забегов {counts["races"]}, лошадей {counts["horses"]} '
+                f'({counts["horses"] / elapsed:.0f} лошадей в секунду)'
+            )
+
+            started = time.perf_counter()
+            repeat = ingest_races(races_data)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f'Повторная загрузка: {elapsed:.2f} с, создано забегов {repeat["races"]}, '
+                f'пропущено {repeat["skipped"]}, обновлено коэффициентов {repeat["odds_updated"]}'
+            )
+
+            changed = self._change_odds(races_data, options['changed'])
+            started = time.perf_counter()
+            delta = ingest_races(races_data)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f'Загрузка с изменениями: {elapsed:.2f} с, изменено в ленте {changed}, '
+                f'обновлено коэффициентов {delta["odds_updated"]}'
+            )
+
+            created = Race.objects.count() - races_before
+            horses = Horse.objects.filter(race__name__startswith='Лента ').count()
+            transaction.set_rollback(True)
+
+        if repeat['races'] or created != options['races'] or horses != options['races'] * options['horses']:
+            raise CommandError(f'Ожидалось {options["races"]} забегов без дублей, создано {created}, лошадей {horses}')
+        if repeat['odds_updated'] or delta['odds_updated'] != changed:
+            raise CommandError(f'Изменено коэффициентов {changed}, обновлено {delta["odds_updated"]}')
+        self.stdout.write(self.style.SUCCESS('Повторная загрузка не создала дублей и обновила только изменения'))
+
+    def _change_odds(self, races_data, share):
+        """Поменять коэффициент у доли лошадей ленты. Возвращает число изменений"""
+        horses = [horse for race_data in races_data for horse in race_data['horses']]
+        picked = random.sample(horses, int(len(horses) * share))
+        for horse in picked:
+            horse['odds'] += Decimal('0.05')
+        return len(picked)
+
+    def _feed(self, race_count, horse_count):
+        """Лента на день по нескольким ипподромам"""
+        base_time = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        return [
+            {
+                'name': f'Лента {i % 20}: забег {i // 20 + 1}',
+                'start_time': base_time + timedelta(minutes=i // 20 * 5),
+                'horses': [
+                    {
+                        'name': f'Лошадь {i}-{j}',
+                        'odds': Decimal(random.randint(150, 2000)) / 100,
+                        'color': 'Гнедой',
+                        'jockey': 'Иванов А.',
+                    }
+                    for j in range(horse_count)
+                ],
+            }
+            for i in range(race_count)
+        ]
@@ -0,0 +1,117 @@
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+from django.db.models import Sum
+from django.utils import timezone
+from betting import ledger
+from betting.models import Race, Horse, Bet, UserProfile, Transaction
+from betting.placement import BetError, place_bet
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочный тест параллельного размещения ставок'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16, help='Количество потоков')
+        parser.add_argument('--bets', type=int, default=2000, help='Всего попыток ставок')
+        parser.add_argument('--users', type=int, default=1, help='Количество игроков')
+        parser.add_argument('--balance', default='5000', help='Начальный баланс игрока')
+        parser.add_argument('--amount', default='10', help='Сумма одной ставки')
+
+    def handle(self, *args, **options):
+        balance = Decimal(options['balance'])
+        amount = Decimal(options['amount'])
+        users, race, horses = self._setup(options['users'], balance)
+
+        outcomes = Counter()
+        lock = threading.Lock()
+
+        def attempt(i):
+            user = users[i % len(users)]
+            horse = horses[i % len(horses)]
+            try:
+                place_bet(user, race.id, horse.id, amount)
+                outcome = 'accepted'
+            except BetError:
+                outcome = 'rejected'
+            except OperationalError:
+                # Например, "database is locked" в SQLite
+                outcome = 'db_error'
+            finally:
+                connections.close_all()
+            with lock:
+                outcomes[outcome] += 1
+
+        try:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+                list(pool.map(attempt, range(options['bets'])))
+            elapsed = time.perf_counter() - started
+
+            self._report(outcomes, elapsed, options['bets'])
+            self._check(users, race, balance, amount, outcomes['accepted'])
+        finally:
+            Race.objects.filter(pk=race.pk).delete()
+            User.objects.filter(pk__in=[user.pk for user in users]).delete()
+
+    def _setup(self, user_count, balance):
+        stamp = int(time.time())
+        users = []
+        for i in range(user_count):
+            user = User.objects.create(username=f'bench_placement_{stamp}_{i}')
+            # Баланс доводится до заданного операцией журнала, как у настоящего игрока
+            opening = UserProfile.objects.get(user=user).balance
+            if balance > opening:
+                ledger.post(user.pk, 'deposit', balance - opening, 'Пополнение для нагрузочного теста')
+            elif balance < opening:
+                ledger.post(user.pk, 'withdraw', opening - balance, 'Списание для нагрузочного теста')
+            users.append(user)
+        race = Race.objects.create(
+            name=f'Нагрузочный тест {stamp}',
+            start_time=timezone.now() + timedelta(hours=1),
+        )
+        horses = Horse.objects.bulk_create([
+            Horse(race=race, name=f'Лошадь {i}', odds=Decimal('3.00')) for i in range(8)
+        ])
+        return users, race, horses
+
+    def _report(self, outcomes, elapsed, attempts):
+        self.stdout.write(f'Попыток: {attempts} за {elapsed:.2f} с ({attempts / elapsed:.0f} в секунду)')
+        self.stdout.write(f'Принято: {outcomes["accepted"]} ({outcomes["accepted"] / elapsed:.0f} в секунду)')
+        self.stdout.write(f'Отклонено (недостаточно средств): {outcomes["rejected"]}')
+        self.stdout.write(f'Ошибок БД: {outcomes["db_error"]}')
+
+    def _check(self, users, race, balance, amount, accepted):
+        """Проверить инварианты: баланс не ушел в минус и сходится со ставками"""
+        user_ids = [user.pk for user in users]
+        balances = UserProfile.objects.filter(user_id__in=user_ids).aggregate(
+            total=Sum('balance')
+        )['total']
+        negative = UserProfile.objects.filter(user_id__in=user_ids, balance__lt=0).count()
+        bets = Bet.objects.filter(race=race).count()
+        transactions = Transaction.objects.filter(user_id__in=user_ids, transaction_type='bet').count()
+
+        expected = balance * len(users) - amount * accepted
+        problems = []
+        if negative:
+            problems.append(f'отрицательный баланс у {negative} игроков')
+        if balances != expected:
+            problems.append(f'сумма балансов {balances}, ожидалось {expected}')
+        if bets != accepted or transactions != accepted:
+            problems.append(f'ставок {bets}, транзакций {transactions}, принято {accepted}')
+        drifted = [
+            user_id for user_id, profile_balance in UserProfile.objects.filter(user_id__in=user_ids).values_list('user_id', 'balance')
+            if ledger.current_balance(user_id) != profile_balance
+        ]
+        if drifted:
+            problems.append(f'баланс расходится с журналом у {len(drifted)} игроков')
+
+        if problems:
+            raise CommandError('Нарушены инварианты: ' + '; '.join(problems))
+        self.stdout.write(self.style.SUCCESS('Инварианты соблюдены: балансы не отрицательны и сходятся со ставками и журналом'))
@@ -0,0 +1,89 @@
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from betting.models import Race, Horse, Bet, UserProfile
+from betting.placement import BET_TYPE_ODDS
+from betting.settlement import record_results, settle_race
+
+
+class Command(BaseCommand):
+    help = 'Замер времени расчета забега в зависимости от количества ставок'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', default='1000,10000,50000',
+            help='Количества ставок через запятую'
+        )
+        parser.add_argument(
+            '--users', type=int, default=1000,
+            help='Количество пользователей, делающих ставки'
+        )
+        parser.add_argument(
+            '--bet-types', default='win,place,show',
+            help='Типы ставок через запятую; тип каждой ставки выбирается случайно'
+        )
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        bet_types = [bet_type.strip() for bet_type in options['bet_types'].split(',')]
+        unknown = set(bet_types) - set(BET_TYPE_ODDS)
+        if unknown:
+            raise CommandError(f'Неизвестные типы ставок: {", ".join(sorted(unknown))}')
+
+        self.stdout.write(
+            f'{"ставок":>10} {"выиграло":>10} {"запросов":>10} {"время, с":>10} {"ставок/с":>12}'
+        )
+        for size in sizes:
+            won, queries, elapsed = self._run(size, options['users'], bet_types)
+            rate = size / elapsed if elapsed else 0
+            self.stdout.write(f'{size:>10} {won:>10} {queries:>10} {elapsed:>10.3f} {rate:>12.0f}')
+
+    def _run(self, bet_count, user_count, bet_types):
+        """Создать забег со ставками, рассчитать его и откатить данные"""
+        with transaction.atomic():
+            users = User.objects.bulk_create([
+                User(username=f'bench_{bet_count}_{i}')
+                for i in range(min(user_count, bet_count))
+            ])
+            UserProfile.objects.bulk_create([UserProfile(user=user) for user in users])
+
+            race = Race.objects.create(
+                name=f'Бенчмарк {bet_count}',
+                start_time=timezone.now() - timedelta(minutes=5),
+            )
+            horses = Horse.objects.bulk_create([
+                Horse(race=race, name=f'Лошадь {i}', odds=Decimal(random.randint(150, 900)) / 100)
+                for i in range(8)
+            ])
+
+            bets = []
+            for _ in range(bet_count):
+                horse = random.choice(horses)
+                bet_type = random.choice(bet_types)
+                odds = (horse.odds * BET_TYPE_ODDS[bet_type][0]).quantize(Decimal('0.01'))
+                amount = Decimal(random.randint(10, 500))
+                bets.append(Bet(
+                    user=random.choice(users), race=race, horse=horse, bet_type=bet_type,
+                    amount=amount, odds=odds, potential_win=amount * odds,
+                ))
+            Bet.objects.bulk_create(bets, batch_size=1000)
+
+            # Порядок прихода - все лошади в случайном порядке
+            record_results(race, random.sample(horses, len(horses)))
+            race.status = 'finished'
+            race.save()
+
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                result = settle_race(race)
+                elapsed = time.perf_counter() - started
+
+            transaction.set_rollback(True)
+
+        return result['won'], len(captured.captured_queries), elapsed
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from betting.cancellation import cancel_races, refund_cancelled_races
+
+
+class Command(BaseCommand):
+    help = 'Отмена забегов с возвратом нерассчитанных ставок'
+
+    def add_arguments(self, parser):
+        parser.add_argument('race_ids', nargs='*', type=int, help='ID отменяемых забегов')
+        parser.add_argument('--reason', default='', help='Причина отмены для описания операций возврата')
+        parser.add_argument(
+            '--sweep', action='store_true',
+            help='Вернуть ставки, оставшиеся нерассчитанными на уже отмененных забегах'
+        )
+
+    def handle(self, *args, **options):
+        if options['sweep']:
+            result = refund_cancelled_races()
+        elif options['race_ids']:
+            result = cancel_races(options['race_ids'], options['reason'])
+        else:
+            raise CommandError('Укажите ID забегов или --sweep')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Отменено забегов: {result["races"]}, возвращено ставок: {result["bets"]} '
+            f'{result["users"]} пользователям на {result["refunded"]} ₽'
+        ))
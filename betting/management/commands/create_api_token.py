@@ -0,0 +1,19 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from betting.tokens import create_token
+
+
+class Command(BaseCommand):
+    help = 'Выпуск токена JSON API для пользователя (ключ выводится один раз)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='Имя пользователя')
+        parser.add_argument('--name', default='', help='Название токена, например приложение клиента')
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options['username']).first()
+        if user is None:
+            raise CommandError(f'Пользователь {options["username"]} не найден')
+        token, key = create_token(user, options['name'])
+        self.stdout.write(self.style.SUCCESS(f'Токен {token.pk} для {user.username}: {key}'))
+        self.stdout.write('Сохраните ключ: повторно его получить нельзя')
@@ -0,0 +1,47 @@
+import signal
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from betting.scheduler import RaceScheduler
+
+class Command(BaseCommand):
+    help = 'Фоновый процесс: расчет забегов по расписанию и обновление данных о забегах'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--feed-interval', type=int, default=300,
+            help='Период обновления данных о забегах, секунд'
+        )
+        parser.add_argument(
+            '--odds-interval', type=int, default=30,
+            help='Период пересчета коэффициентов тотализатора по пулам ставок, секунд'
+        )
+        parser.add_argument(
+            '--sync-interval', type=int, default=60,
+            help='Период загрузки лент источников (изменения коэффициентов и отмены), секунд'
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Обработать наступившие события и завершиться'
+        )
+
+    def handle(self, *args, **options):
+        scheduler = RaceScheduler(
+            feed_interval=timedelta(seconds=options['feed_interval']),
+            odds_interval=timedelta(seconds=options['odds_interval']),
+            sync_interval=timedelta(seconds=options['sync_interval']),
+            log=self.stdout.write,
+        )
+
+        if options['once']:
+            scheduler.sync_feed()
+            scheduler.refresh_feed()
+            scheduler.reload()
+            scheduler.run_pending()
+            return
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *args: scheduler.stop())
+
+        self.stdout.write('Планировщик забегов запущен')
+        scheduler.run_forever()
+        self.stdout.write(self.style.SUCCESS('Планировщик забегов остановлен'))
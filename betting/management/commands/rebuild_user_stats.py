@@ -0,0 +1,35 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from betting.stats import STATS_BATCH_SIZE, rebuild_user_stats
+
+class Command(BaseCommand):
+    help = 'Пересборка статистики ставок пользователей по истории ставок'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user', action='append', default=[],
+            help='Имя пользователя (можно указать несколько раз)'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=STATS_BATCH_SIZE,
+            help='Сколько пользователей пересчитывается за один запрос'
+        )
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('pk')
+        if options['user']:
+            users = users.filter(username__in=options['user'])
+
+        batch_size = options['batch_size']
+        batch = []
+        rebuilt = 0
+        for user_id in users.values_list('pk', flat=True).iterator(chunk_size=batch_size):
+            batch.append(user_id)
+            if len(batch) == batch_size:
+                rebuilt += rebuild_user_stats(batch)
+                batch = []
+        rebuilt += rebuild_user_stats(batch)
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Статистика пересобрана для {rebuilt} пользователей')
+        )
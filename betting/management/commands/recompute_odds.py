@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from betting.models import Race
+from betting.pools import rebuild_pools, recompute_odds
+
+class Command(BaseCommand):
+    help = 'Пересчет коэффициентов тотализатора открытых забегов по пулам ставок'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--takeout', type=float, default=None,
+            help='Доля тотализатора (по умолчанию settings.BETTING_TAKEOUT)'
+        )
+        parser.add_argument(
+            '--rebuild-pools', action='store_true',
+            help='Предварительно пересобрать пулы открытых забегов по ставкам'
+        )
+
+    def handle(self, *args, **options):
+        if options['rebuild_pools']:
+            race_ids = Race.objects.filter(status='scheduled').values_list('id', flat=True)
+            rebuild_pools(race_ids)
+            self.stdout.write('Пулы открытых забегов пересобраны')
+
+        updated = recompute_odds(takeout=options['takeout'])
+        self.stdout.write(
+            self.style.SUCCESS(f'Коэффициенты тотализатора обновлены у {updated} лошадей')
+        )
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from betting.reconcile import (
+    RECONCILE_CHUNK_SIZE, partition_bounds, reconcile_partition, reconcile_range, report_line,
+)
+
+
+class Command(BaseCommand):
+    help = 'Сверка балансов пользователей с журналом операций'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=RECONCILE_CHUNK_SIZE, help='Пользователей в блоке')
+        parser.add_argument('--partitions', type=int, default=1, help='На сколько диапазонов user_id разбить сверку')
+        parser.add_argument(
+            '--partition', type=int, default=None,
+            help='Сверить только диапазон с этим номером (с 0), например на отдельной машине'
+        )
+        parser.add_argument('--workers', type=int, default=1, help='Процессов для параллельной сверки диапазонов')
+        parser.add_argument('--output', default='-', help='Файл отчета в формате JSON Lines ("-" - stdout)')
+        parser.add_argument('--repair', action='store_true', help='Привести баланс и счетчик операций профилей к журналу')
+
+    def handle(self, *args, **options):
+        partitions = partition_bounds(max(1, options['partitions']))
+        if options['partition'] is not None:
+            if not 0 <= options['partition'] < len(partitions):
+                raise CommandError(f'Нет диапазона {options["partition"]}, всего {len(partitions)}')
+            partitions = [partitions[options['partition']]]
+
+        started = time.monotonic()
+        to_stdout = options['output'] == '-'
+        output = self.stdout if to_stdout else open(options['output'], 'w', encoding='utf-8')
+        try:
+            parallel = options['workers'] > 1 and len(partitions) > 1
+            if parallel and options['repair'] and connections['default'].vendor == 'sqlite':
+                # SQLite допускает одного писателя: параллельные исправления
+                # упирались бы в блокировку базы
+                self.stderr.write(self.style.WARNING('SQLite: исправление идет в одном процессе'))
+                parallel = False
+            if parallel:
+                summaries = self._run_parallel(partitions, options, output)
+            else:
+                summaries = [
+                    reconcile_range(
+                        low, high, chunk_size=options['chunk_size'], fix=options['repair'],
+                        report=lambda item: output.write(report_line(item)),
+                    )
+                    for low, high in partitions
+                ]
+
+            summary = {'users': 0, 'discrepancies': 0, 'repaired': 0, 'drift': Decimal('0')}
+            for partial in summaries:
+                for key, value in partial.items():
+                    summary[key] += value
+            elapsed = time.monotonic() - started
+            output.write(report_line({
+                'summary': True, **summary, 'partitions': len(partitions), 'elapsed': round(elapsed, 3),
+            }))
+        finally:
+            if not to_stdout:
+                output.close()
+
+        # В stdout уже идет отчет - итог пишется в stderr
+        message = (
+            f'Проверено {summary["users"]} пользователей за {elapsed:.1f} с, '
+            f'расхождений {summary["discrepancies"]}, исправлено {summary["repaired"]}'
+        )
+        stream = self.stderr if to_stdout else self.stdout
+        stream.write(self.style.WARNING(message) if summary['discrepancies'] > summary['repaired']
+                     else self.style.SUCCESS(message))
+
+    def _run_parallel(self, partitions, options, output):
+        """
+        Диапазоны сверяются в отдельных процессах, каждый пишет свою
+        часть отчета во временный файл; части склеиваются по порядку
+        """
+        # Дочерние процессы открывают собственные соединения с базой
+        connections.close_all()
+        parts = tempfile.mkdtemp(prefix='reconcile_')
+        try:
+            paths = [os.path.join(parts, f'{number}.jsonl') for number in range(len(partitions))]
+            with ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup) as executor:
+                futures = [
+                    executor.submit(
+                        reconcile_partition, low, high, path,
+                        chunk_size=options['chunk_size'], fix=options['repair'],
+                    )
+                    for (low, high), path in zip(partitions, paths)
+                ]
+                summaries = [future.result() for future in futures]
+            for path in paths:
+                with open(path, encoding='utf-8') as part:
+                    for line in part:
+                        output.write(line)
+            return summaries
+        finally:
+            shutil.rmtree(parts, ignore_errors=True)
@@ -0,0 +1,48 @@
+import signal
+import threading
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from betting.notifications import drain_outbox, fan_out_queued_races, get_batch_size
+
+
+class Command(BaseCommand):
+    help = 'Рассылка результатов забегов и отправка уведомлений из очереди пачками через одно почтовое соединение'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Уведомлений в пачке')
+        parser.add_argument('--max-batches', type=int, default=None, help='Отправить не больше N пачек за проход')
+        parser.add_argument('--loop', action='store_true', help='Работать постоянно, опрашивая очередь')
+        parser.add_argument('--interval', type=float, default=5.0, help='Пауза между проходами в режиме --loop, секунд')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size'] or get_batch_size()
+        if not options['loop']:
+            self._report_races(fan_out_queued_races())
+            self._report(drain_outbox(batch_size, options['max_batches']))
+            return
+
+        stop = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *args: stop.set())
+
+        self.stdout.write('Отправка уведомлений запущена')
+        while not stop.is_set():
+            close_old_connections()
+            races = fan_out_queued_races()
+            if races:
+                self._report_races(races)
+            totals = drain_outbox(batch_size, options['max_batches'])
+            if any(totals.values()):
+                self._report(totals)
+            stop.wait(options['interval'])
+        self.stdout.write(self.style.SUCCESS('Отправка уведомлений остановлена'))
+
+    def _report_races(self, races):
+        self.stdout.write(f'Разослано результатов забегов: {races}')
+
+    def _report(self, totals):
+        message = f'Отправлено {totals["sent"]}, отложено для повтора {totals["retry"]}, не доставлено {totals["dead"]}'
+        if totals['retry'] or totals['dead']:
+            self.stdout.write(self.style.WARNING(message))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
@@ -1,4 +1,5 @@
 from django.core.management.base import BaseCommand
+from betting.feeds import ERROR, get_fetcher
 from betting.parsers import RaceDataParser
 
 class Command(BaseCommand):
@@ -8,11 +9,29 @@ class Command(BaseCommand):
         self.stdout.write('Начинаем обновление данных о забегах...')
         
         try:
-            RaceDataParser.update_races_from_real_sources()
+            counts = RaceDataParser.update_races_from_real_sources()
             self.stdout.write(
                 self.style.SUCCESS('Данные о забегах успешно обновлены!')
             )
+            self.stdout.write(
+                f'Создано забегов: {counts["races"]}, лошадей: {counts["horses"]}, '
+                f'уже загружено: {counts["skipped"]}, обновлено коэффициентов: {counts["odds_updated"]}, '
+                f'отменено: {counts["cancelled"]}'
+            )
+            self._report_health()
         except Exception as e:
             self.stdout.write(
                 self.style.ERROR(f'Ошибка при обновлении данных: {str(e)}')
-            )
\ No newline at end of file
+            )
+
+    def _report_health(self):
+        """Вывести состояние каждого источника после опроса"""
+        for health in get_fetcher().health.values():
+            line = (
+                f'{health.name}: {health.status}, запросов {health.requests}, '
+                f'ошибок подряд {health.failures}'
+            )
+            if health.status == ERROR:
+                self.stdout.write(self.style.ERROR(f'{line} ({health.last_error})'))
+            else:
+                self.stdout.write(line)
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:36
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('betting', '0002_transaction'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_bets', models.PositiveIntegerField(default=0)),
+                ('active_bets', models.PositiveIntegerField(default=0)),
+                ('won_bets', models.PositiveIntegerField(default=0)),
+                ('lost_bets', models.PositiveIntegerField(default=0)),
+                ('total_wagered', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('total_won', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('win_bets', models.PositiveIntegerField(default=0)),
+                ('win_won', models.PositiveIntegerField(default=0)),
+                ('place_bets', models.PositiveIntegerField(default=0)),
+                ('place_won', models.PositiveIntegerField(default=0)),
+                ('show_bets', models.PositiveIntegerField(default=0)),
+                ('show_won', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='betting_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
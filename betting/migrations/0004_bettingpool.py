@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_pools(apps, schema_editor):
+    """Собрать пулы по уже сделанным ставкам"""
+    Bet = apps.get_model('betting', 'Bet')
+    BettingPool = apps.get_model('betting', 'BettingPool')
+    rows = Bet.objects.values('race_id', 'horse_id', 'bet_type').annotate(
+        total=Sum('amount'), count=Count('id'),
+    ).order_by()
+    BettingPool.objects.bulk_create([
+        BettingPool(
+            race_id=row['race_id'], horse_id=row['horse_id'], bet_type=row['bet_type'],
+            stake=row['total'], bet_count=row['count'],
+        )
+        for row in rows.iterator()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('betting', '0003_userstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BettingPool',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bet_type', models.CharField(choices=[('win', 'Победа'), ('place', 'Место'), ('show', 'Показ')], default='win', max_length=10)),
+                ('stake', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('bet_count', models.PositiveIntegerField(default=0)),
+                ('horse', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pools', to='betting.horse')),
+                ('race', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pools', to='betting.race')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('race', 'bet_type', 'horse'), name='unique_pool_horse')],
+            },
+        ),
+        migrations.RunPython(backfill_pools, migrations.RunPython.noop),
+    ]
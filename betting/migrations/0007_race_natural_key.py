@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('betting', '0006_betslip'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='race',
+            constraint=models.UniqueConstraint(fields=('name', 'start_time'), name='unique_race_name_start'),
+        ),
+    ]
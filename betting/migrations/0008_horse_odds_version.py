@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('betting', '0007_race_natural_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='horse',
+            name='odds_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,108 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:10
+
+from decimal import Decimal
+from itertools import groupby
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+CHECKPOINT_INTERVAL = 100
+USERS_PER_BATCH = 1000
+DEBIT_TYPES = ('withdraw', 'bet')
+
+
+def backfill_ledger(apps, schema_editor):
+    """
+    Достроить журнал по существующим данным. Часть изменений баланса
+    раньше не записывалась в журнал (начальный баланс, возвраты из
+    админки), поэтому расхождение между балансом профиля и суммой
+    операций записывается корректировкой в начало журнала. Затем
+    проставляются balance_after, счетчики операций и контрольные точки.
+    """
+    UserProfile = apps.get_model('betting', 'UserProfile')
+    Transaction = apps.get_model('betting', 'Transaction')
+    BalanceCheckpoint = apps.get_model('betting', 'BalanceCheckpoint')
+
+    def signed(transaction_type, amount):
+        return -amount if transaction_type in DEBIT_TYPES else amount
+
+    profiles = UserProfile.objects.order_by('user_id').values_list('id', 'user_id', 'balance', 'created_at')
+    profiles = list(profiles)
+    for start in range(0, len(profiles), USERS_PER_BATCH):
+        chunk = {user_id: (pk, balance, created_at) for pk, user_id, balance, created_at in profiles[start:start + USERS_PER_BATCH]}
+        entries = Transaction.objects.filter(user_id__in=chunk).order_by('user_id', 'created_at', 'id')
+
+        sums = {user_id: Decimal('0') for user_id in chunk}
+        for user_id, transaction_type, amount in entries.values_list('user_id', 'transaction_type', 'amount').iterator():
+            sums[user_id] += signed(transaction_type, amount)
+
+        openings = []
+        for user_id, (_, balance, created_at) in chunk.items():
+            if balance != sums[user_id]:
+                openings.append(Transaction(
+                    user_id=user_id, transaction_type='adjustment', amount=balance - sums[user_id],
+                    description='Начальный баланс', created_at=created_at,
+                ))
+        openings = Transaction.objects.bulk_create(openings)
+        # auto_now_add перезаписал время - возвращаем его в начало журнала
+        Transaction.objects.bulk_update(openings, ['created_at'])
+
+        updated, checkpoints, counts = [], [], []
+        rows = entries.values_list('id', 'user_id', 'transaction_type', 'amount', 'created_at').iterator()
+        for user_id, group in groupby(rows, key=lambda row: row[1]):
+            balance = Decimal('0')
+            count = 0
+            for pk, _, transaction_type, amount, created_at in group:
+                balance += signed(transaction_type, amount)
+                count += 1
+                updated.append(Transaction(id=pk, balance_after=balance))
+                if count % CHECKPOINT_INTERVAL == 0:
+                    checkpoints.append(BalanceCheckpoint(
+                        user_id=user_id, entry_id=pk, balance=balance, entries=count, created_at=created_at,
+                    ))
+            counts.append(UserProfile(id=chunk[user_id][0], ledger_entries=count))
+        Transaction.objects.bulk_update(updated, ['balance_after'], batch_size=500)
+        BalanceCheckpoint.objects.bulk_create(checkpoints, batch_size=500)
+        UserProfile.objects.bulk_update(counts, ['ledger_entries'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('betting', '0010_race_result_notifications'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='balance_after',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='ledger_entries',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='transaction_type',
+            field=models.CharField(choices=[('deposit', 'Пополнение'), ('withdraw', 'Вывод'), ('bet', 'Ставка'), ('win', 'Выигрыш'), ('refund', 'Возврат'), ('adjustment', 'Корректировка')], max_length=10),
+        ),
+        migrations.CreateModel(
+            name='BalanceCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('entries', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField()),
+                ('entry', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoint', to='betting.transaction')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_checkpoints', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'created_at'], name='checkpoint_user_created_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_ledger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_winners(apps, schema_editor):
+    """
+    Победитель уже завершенного забега - первое место. Победитель,
+    который не участвовал в забеге (старые данные), не переносится
+    """
+    Race = apps.get_model('betting', 'Race')
+    RaceResult = apps.get_model('betting', 'RaceResult')
+    results = []
+    for race_id, winner_id in Race.objects.filter(winner__race=F('id')).values_list('id', 'winner_id').iterator(
+        chunk_size=1000
+    ):
+        results.append(RaceResult(race_id=race_id, horse_id=winner_id, position=1))
+        if len(results) == 1000:
+            RaceResult.objects.bulk_create(results)
+            results = []
+    RaceResult.objects.bulk_create(results)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('betting', '0011_balance_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RaceResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveSmallIntegerField()),
+                ('horse', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='result', to='betting.horse')),
+                ('race', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='results', to='betting.race')),
+            ],
+            options={
+                'ordering': ['race', 'position'],
+                'constraints': [models.UniqueConstraint(fields=('race', 'position'), name='unique_race_position')],
+            },
+        ),
+        migrations.RunPython(backfill_winners, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('betting', '0014_api_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='race',
+            name='results_queued_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='notification',
+            name='kind',
+            field=models.CharField(choices=[('bet_placed', 'Ставка принята'), ('race_completed', 'Результаты забега')], max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='race',
+            index=models.Index(condition=models.Q(('results_queued_at__isnull', False)), fields=['results_queued_at'], name='race_results_queued_idx'),
+        ),
+    ]
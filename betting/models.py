@@ -1,13 +1,16 @@
 from django.db import models
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.utils import timezone
 from decimal import Decimal
+from .caching import invalidate_races, invalidate_users
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='betting_profile')
     balance = models.DecimalField(max_digits=10, decimal_places=2, default=1000.00)
+    # Количество операций в журнале пользователя
+    ledger_entries = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -30,6 +33,23 @@ class Race(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='scheduled')
     created_at = models.DateTimeField(auto_now_add=True)
     winner = models.ForeignKey('Horse', on_delete=models.SET_NULL, null=True, blank=True, related_name='won_races')
+    # Рассылка результатов поставлена в очередь (см. notifications.fan_out_queued_races)
+    results_queued_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Ближайшие/завершенные забеги и забеги к расчету
+            models.Index(fields=['status', 'start_time'], name='race_status_start_idx'),
+            # Очередь рассылки результатов: в индексе только ожидающие забеги
+            models.Index(
+                fields=['results_queued_at'], name='race_results_queued_idx',
+                condition=models.Q(results_queued_at__isnull=False),
+            ),
+        ]
+        constraints = [
+            # Естественный ключ забега: повторная загрузка ленты не создает дублей
+            models.UniqueConstraint(fields=['name', 'start_time'], name='unique_race_name_start'),
+        ]
 
     def __str__(self):
         return self.name
@@ -39,51 +59,48 @@ class Race(models.Model):
 
     def settle_bets(self):
         """Рассчитать выигрыши по ставкам после завершения забега"""
-        if self.status == 'finished' and self.winner:
-            winning_bets = Bet.objects.filter(race=self, horse=self.winner, is_settled=False)
-            for bet in winning_bets:
-                bet.is_winner = True
-                bet.is_settled = True
-                bet.settled_at = timezone.now()
-                bet.save()
-                
-                # Начисляем выигрыш
-                user_profile = bet.user.betting_profile
-                user_profile.balance += bet.potential_win
-                user_profile.save()
-                
-                # Записываем транзакцию выигрыша
-                Transaction.objects.create(
-                    user=bet.user,
-                    transaction_type='win',
-                    amount=bet.potential_win,
-                    description=f'Выигрыш по ставке - {bet.horse.name}'
-                )
-        
-        # Также помечаем проигравшие ставки
-        losing_bets = Bet.objects.filter(race=self, is_settled=False).exclude(horse=self.winner)
-        for bet in losing_bets:
-            bet.is_winner = False
-            bet.is_settled = True
-            bet.settled_at = timezone.now()
-            bet.save()
+        from .settlement import settle_race
+        return settle_race(self)
 
 class Horse(models.Model):
     race = models.ForeignKey(Race, on_delete=models.CASCADE, related_name='horses')
     name = models.CharField(max_length=100)
     odds = models.DecimalField(max_digits=5, decimal_places=2, default=2.0)
+    # Растет при каждом изменении коэффициента
+    odds_version = models.PositiveIntegerField(default=0)
+    # Коэффициент тотализатора по пулу ставок на победу (betting/pools.py);
+    # NULL, пока пул забега не достиг порога ликвидности. Ставки
+    # принимаются по фиксированному коэффициенту odds
+    tote_odds = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
     color = models.CharField(max_length=50, blank=True)
     jockey = models.CharField(max_length=100, blank=True)
 
     def __str__(self):
         return f"{self.name} ({self.odds})"
 
+class RaceResult(models.Model):
+    """Место лошади на финише забега (итоговый порядок прихода)"""
+    race = models.ForeignKey(Race, on_delete=models.CASCADE, related_name='results')
+    horse = models.OneToOneField(Horse, on_delete=models.CASCADE, related_name='result')
+    position = models.PositiveSmallIntegerField()
+
+    class Meta:
+        ordering = ['race', 'position']
+        constraints = [
+            models.UniqueConstraint(fields=['race', 'position'], name='unique_race_position'),
+        ]
+
+    def __str__(self):
+        return f"{self.race.name}: {self.position}. {self.horse.name}"
+
 class Bet(models.Model):
     BET_TYPES = [
         ('win', 'Победа'),
         ('place', 'Место'),
         ('show', 'Показ'),
     ]
+    # Ставка выигрывает, если лошадь финишировала не ниже этого места
+    PAYOUT_POSITIONS = {'win': 1, 'place': 2, 'show': 3}
     
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     race = models.ForeignKey(Race, on_delete=models.CASCADE)
@@ -97,6 +114,16 @@ class Bet(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     settled_at = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'is_settled'], name='bet_user_settled_idx'),
+            models.Index(fields=['user', 'is_winner'], name='bet_user_winner_idx'),
+            # История ставок пользователя (курсор created_at, id)
+            models.Index(fields=['user', 'created_at'], name='bet_user_created_idx'),
+            # Расчет забега: ставки на победителя и нерассчитанные ставки
+            models.Index(fields=['race', 'horse', 'is_settled'], name='bet_race_horse_settled_idx'),
+        ]
+
     def save(self, *args, **kwargs):
         # Автоматически рассчитываем потенциальный выигрыш
         self.potential_win = self.amount * self.odds
@@ -105,33 +132,253 @@ class Bet(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.horse.name} - {self.amount}₽"
 
-# Сигналы для автоматического создания профиля
-@receiver(post_save, sender=User)
-def create_user_profile(sender, instance, created, **kwargs):
-    if created:
-        UserProfile.objects.get_or_create(user=instance)
+class BettingPool(models.Model):
+    """
+    Пул ставок забега: сумма и количество ставок на лошадь по типу ставки.
+    Обновляется при каждом размещении ставки (см. betting/pools.py).
+    """
+    race = models.ForeignKey(Race, on_delete=models.CASCADE, related_name='pools')
+    horse = models.ForeignKey(Horse, on_delete=models.CASCADE, related_name='pools')
+    bet_type = models.CharField(max_length=10, choices=Bet.BET_TYPES, default='win')
+    stake = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    bet_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['race', 'bet_type', 'horse'], name='unique_pool_horse'),
+        ]
+
+    def __str__(self):
+        return f"{self.race.name} - {self.horse.name} ({self.bet_type}): {self.stake}₽"
+
+class BetSlip(models.Model):
+    """
+    Купон из нескольких ставок, размещенный через JSON API.
+    Ключ идемпотентности позволяет клиенту безопасно повторить запрос:
+    повтор с тем же ключом возвращает сохраненный ответ.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='bet_slips')
+    idempotency_key = models.CharField(max_length=64, blank=True)
+    request_hash = models.CharField(max_length=64)
+    total_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    response = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'idempotency_key'],
+                condition=~models.Q(idempotency_key=''),
+                name='unique_slip_idempotency_key',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - купон {self.pk} - {self.total_amount}₽"
+
+class ApiToken(models.Model):
+    """
+    Токен JSON API для мобильных и внешних клиентов (заголовок
+    Authorization: Token <ключ>). Хранится только SHA-256 ключа:
+    сам ключ показывается один раз при создании (create_api_token).
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='api_tokens')
+    name = models.CharField(max_length=100, blank=True)
+    key_hash = models.CharField(max_length=64, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.user.username} - {self.name or 'токен'}"
+
+class UserStats(models.Model):
+    """
+    Денормализованная статистика ставок пользователя.
+    Обновляется в той же транзакции, что и размещение и расчет ставок
+    (см. betting/stats.py), и пересобирается командой rebuild_user_stats.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='betting_stats')
+    total_bets = models.PositiveIntegerField(default=0)
+    active_bets = models.PositiveIntegerField(default=0)
+    won_bets = models.PositiveIntegerField(default=0)
+    lost_bets = models.PositiveIntegerField(default=0)
+    total_wagered = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    total_won = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    win_bets = models.PositiveIntegerField(default=0)
+    win_won = models.PositiveIntegerField(default=0)
+    place_bets = models.PositiveIntegerField(default=0)
+    place_won = models.PositiveIntegerField(default=0)
+    show_bets = models.PositiveIntegerField(default=0)
+    show_won = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user.username} - {self.total_bets} ставок"
+
+    @property
+    def net_profit(self):
+        return self.total_won - self.total_wagered
+
+    @property
+    def win_rate(self):
+        return (self.won_bets / self.total_bets * 100) if self.total_bets > 0 else 0
+
+    def get_bet_types(self):
+        """Статистика по типам ставок в формате {'bet_type', 'count', 'won'}"""
+        return [
+            {
+                'bet_type': bet_type,
+                'count': getattr(self, f'{bet_type}_bets'),
+                'won': getattr(self, f'{bet_type}_won'),
+            }
+            for bet_type, _ in Bet.BET_TYPES
+            if getattr(self, f'{bet_type}_bets')
+        ]
+
+    def as_dict(self):
+        return {
+            'total_bets': self.total_bets,
+            'active_bets': self.active_bets,
+            'won_bets': self.won_bets,
+            'lost_bets': self.lost_bets,
+            'total_wagered': self.total_wagered,
+            'total_won': self.total_won,
+            'net_profit': self.net_profit,
+            'win_rate': self.win_rate,
+            'bet_types': self.get_bet_types(),
+        }
+
+class Notification(models.Model):
+    """
+    Исходящее уведомление (outbox). Пишется в той же транзакции, что
+    и ставка или расчет, и доставляется отдельным процессом
+    send_notifications (см. betting/notifications.py).
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Ожидает отправки'),
+        ('sending', 'Отправляется'),
+        ('retry', 'Повторная отправка'),
+        ('sent', 'Отправлено'),
+        ('dead', 'Не доставлено'),
+    ]
+    KIND_CHOICES = [
+        ('bet_placed', 'Ставка принята'),
+        ('race_completed', 'Результаты забега'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
+    race = models.ForeignKey(Race, on_delete=models.CASCADE, null=True, blank=True, related_name='notifications')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=200)
+    body = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # Когда уведомление можно взять в отправку: время следующей попытки
+    # или окончание аренды отправляющим процессом
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    claim = models.CharField(max_length=32, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # Выборка очередной пачки к отправке
+            models.Index(fields=['status', 'next_attempt_at'], name='notification_due_idx'),
+        ]
+        constraints = [
+            # Одно письмо с результатами забега на пользователя:
+            # повторная рассылка по тому же забегу не создает дублей
+            models.UniqueConstraint(
+                fields=['race', 'user'],
+                condition=models.Q(kind='race_completed'),
+                name='unique_race_result_notification',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.recipient} - {self.subject} ({self.get_status_display()})"
+
+# Профиль создается вместе с пользователем; остальные сохранения
+# пользователя (например, last_login при входе) запросов не добавляют
 @receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    UserProfile.objects.get_or_create(user=instance)
+def create_user_profile(sender, instance, created, raw=False, **kwargs):
+    invalidate_users([instance.pk])
+    if created and not raw:
+        from .ledger import open_account
+        instance.betting_profile = UserProfile.objects.create(user=instance)
+        open_account(instance.betting_profile)
+
+@receiver(post_delete, sender=User)
+@receiver([post_save, post_delete], sender=UserProfile)
+def invalidate_user_cache(sender, instance, **kwargs):
+    # Пользователь кэшируется вместе с профилем (betting/profiles.py)
+    invalidate_users([instance.pk if sender is User else instance.user_id])
+
+@receiver([post_save, post_delete], sender=Race)
+@receiver([post_save, post_delete], sender=Horse)
+def invalidate_race_cache(sender, **kwargs):
+    # Кэш страниц и фрагментов с забегами
+    invalidate_races()
 
 class Transaction(models.Model):
+    """
+    Запись журнала операций со счетом. Журнал только дополняется и
+    является источником истины для баланса: UserProfile.balance - его
+    проекция, balance_after - баланс после операции. Все изменения
+    баланса проходят через betting/ledger.py.
+    """
     TRANSACTION_TYPES = [
         ('deposit', 'Пополнение'),
         ('withdraw', 'Вывод'),
         ('bet', 'Ставка'),
         ('win', 'Выигрыш'),
         ('refund', 'Возврат'),
+        ('adjustment', 'Корректировка'),
     ]
+    # Списания; сумма корректировки хранится со знаком
+    DEBIT_TYPES = ('withdraw', 'bet')
     
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     transaction_type = models.CharField(max_length=10, choices=TRANSACTION_TYPES)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     description = models.CharField(max_length=200, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    balance_after = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)
     
     def __str__(self):
         return f"{self.user.username} - {self.get_transaction_type_display()} - {self.amount}₽"
+
+    @property
+    def signed_amount(self):
+        """Изменение баланса этой операцией"""
+        return -self.amount if self.transaction_type in self.DEBIT_TYPES else self.amount
     
     class Meta:
-        ordering = ['-created_at']
\ No newline at end of file
+        ordering = ['-created_at']
+        indexes = [
+            # История операций пользователя (курсор created_at, id)
+            models.Index(fields=['user', 'created_at'], name='transaction_user_created_idx'),
+        ]
+
+class BalanceCheckpoint(models.Model):
+    """
+    Баланс пользователя после каждой CHECKPOINT_INTERVAL-й операции
+    журнала (см. betting/ledger.py). Баланс на любой момент - ближайшая
+    контрольная точка и не больше CHECKPOINT_INTERVAL операций после нее.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='balance_checkpoints')
+    entry = models.OneToOneField(Transaction, on_delete=models.CASCADE, related_name='checkpoint')
+    balance = models.DecimalField(max_digits=12, decimal_places=2)
+    # Порядковый номер операции в журнале пользователя
+    entries = models.PositiveIntegerField()
+    # Время операции entry: точки упорядочены так же, как журнал
+    created_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='checkpoint_user_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.balance}₽ после {self.entries} операций"
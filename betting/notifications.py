@@ -1,39 +1,401 @@
-from django.contrib import messages
-from django.core.mail import send_mail
+import logging
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from itertools import groupby
+from operator import itemgetter
 from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection as db_connection
+from django.db.models import F
+from django.db.models.functions import Mod
+from django.utils import timezone
+from .models import Bet, Horse, Notification, Race
+
+logger = logging.getLogger(__name__)
+
+# Уведомлений в одной пачке отправки
+NOTIFICATION_BATCH_SIZE = 100
+# После стольких неудачных попыток уведомление уходит в статус dead
+MAX_ATTEMPTS = 5
+# Задержка перед повтором; удваивается с каждой попыткой
+RETRY_DELAY = timedelta(minutes=1)
+# Если отправляющий процесс упал, уведомление снова станет доступно
+# другим процессам через это время
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+# Рассылка результатов забега: потоков и размер блока чтения ставок
+FAN_OUT_WORKERS = 4
+FAN_OUT_CHUNK_SIZE = 2000
+# Забегов из очереди рассылки за один проход
+FAN_OUT_RACES_PER_PASS = 10
+
+# Статусы, из которых уведомление можно взять в отправку
+DUE_STATUSES = ('pending', 'retry', 'sending')
+
+SUBJECTS = {
+    'bet_placed': 'Ставка принята - Ипподром',
+    'race_completed': 'Результаты забега - Ипподром',
+}
+
+
+def get_batch_size():
+    return getattr(settings, 'BETTING_NOTIFICATION_BATCH_SIZE', NOTIFICATION_BATCH_SIZE)
+
+
+def get_max_attempts():
+    return getattr(settings, 'BETTING_NOTIFICATION_MAX_ATTEMPTS', MAX_ATTEMPTS)
+
+
+def build_notification(user_id, recipient, kind, body):
+    """Несохраненное уведомление; None, если у пользователя нет email"""
+    if not recipient:
+        return None
+    return Notification(user_id=user_id, recipient=recipient, kind=kind, subject=SUBJECTS[kind], body=body)
+
+
+def _bet_message(horse_name, amount, potential_win):
+    return f'Ваша ставка на {horse_name} принята! Сумма: {amount}₽, потенциальный выигрыш: {potential_win}₽'
+
 
 def send_bet_notification(user, bet, bet_type):
     """
-    Отправляет уведомления о ставках
+    Поставить уведомление о ставке в очередь отправки.
+    Вызывается внутри транзакции ставки: уведомление появится только
+    вместе с ней. Письмо отправит send_notifications. О результатах
+    ставок сообщает рассылка по забегу (fan_out_race_results)
     """
-    if bet_type == 'placed':
-        message = f'Ваша ставка на {bet.horse.name} принята! Сумма: {bet.amount}₽, потенциальный выигрыш: {bet.potential_win}₽'
-        messages.success(user, message)
-        
-        # Отправка email (если настроено)
-        try:
-            send_mail(
-                'Ставка принята - Ипподром',
-                message,
-                settings.DEFAULT_FROM_EMAIL,
-                [user.email],
-                fail_silently=True,
+    if bet_type != 'placed':
+        return None
+    notification = build_notification(
+        user.pk, user.email, 'bet_placed', _bet_message(bet.horse.name, bet.amount, bet.potential_win)
+    )
+    if notification is not None:
+        notification.save()
+    return notification
+
+
+def notify_bets_placed(user, bets):
+    """Одно уведомление на купон из нескольких ставок"""
+    lines = [_bet_message(bet.horse.name, bet.amount, bet.potential_win) for bet in bets]
+    notification = build_notification(user.pk, user.email, 'bet_placed', '\n'.join(lines))
+    if notification is not None:
+        notification.save()
+    return notification
+
+
+def get_fan_out_workers():
+    return getattr(settings, 'BETTING_NOTIFICATION_WORKERS', FAN_OUT_WORKERS)
+
+
+def _race_result_message(race, winner_name, bets):
+    """Одно сообщение пользователю обо всех его ставках на забег"""
+    bet_types = dict(Bet.BET_TYPES)
+    lines = [f'Забег "{race.name}" завершен! Победитель: {winner_name or "не определен"}.', '']
+    won_total = Decimal('0')
+    for horse_name, bet_type, amount, potential_win, is_winner in bets:
+        if is_winner:
+            won_total += potential_win
+            lines.append(f'🎉 {bet_types.get(bet_type, bet_type)} - {horse_name}: ставка {amount}₽, выигрыш {potential_win}₽')
+        else:
+            lines.append(f'😔 {bet_types.get(bet_type, bet_type)} - {horse_name}: ставка {amount}₽ не сыграла')
+    lines += ['', f'Итого выигрыш: {won_total}₽. Подробности - в истории ставок.']
+    return '\n'.join(lines)
+
+
+def _insert_race_results(rows):
+    """
+    Записать уведомления с результатами забега.
+    rows - (user_id, race_id, получатель, текст). Строки, уже
+    записанные прежней рассылкой по забегу, пропускаются
+    (уникальность race/user для race_completed)
+    """
+    Notification.objects.bulk_create(
+        [
+            Notification(
+                user_id=user_id, race_id=race_id, recipient=recipient, body=body,
+                kind='race_completed', subject=SUBJECTS['race_completed'],
             )
-        except:
-            pass
-            
-    elif bet_type == 'won':
-        message = f'🎉 Поздравляем! Ваша ставка на {bet.horse.name} выиграла! Выигрыш: {bet.potential_win}₽'
-        messages.success(user, message)
-        
-    elif bet_type == 'lost':
-        message = f'😔 Ставка на {bet.horse.name} не сыграла. Сумма ставки: {bet.amount}₽'
-        messages.info(user, message)
+            for user_id, race_id, recipient, body in rows
+        ],
+        batch_size=FAN_OUT_CHUNK_SIZE,
+        ignore_conflicts=True,
+    )
+
+
+def _partition_batches(race, winner_name, partition, partitions, chunk_size):
+    """
+    Сообщения пользователям одной части забега (user_id % partitions ==
+    partition) пачками: выдает (строки, пользователей, ставок). Ставки
+    читаются итератором по chunk_size строк в порядке user_id
+    и группируются по пользователю, поэтому в памяти держится не больше
+    chunk_size ставок и пачка сообщений
+    """
+    bets = Bet.objects.filter(race=race, is_settled=True)
+    if partitions > 1:
+        bets = bets.annotate(partition=Mod('user_id', partitions)).filter(partition=partition)
+    rows = bets.order_by('user_id', 'id').values_list(
+        'user_id', 'user__email', 'horse__name', 'bet_type', 'amount', 'potential_win', 'is_winner'
+    ).iterator(chunk_size=chunk_size)
+
+    users = bet_count = 0
+    batch = []
+    for (user_id, email), group in groupby(rows, key=itemgetter(0, 1)):
+        user_bets = [row[2:] for row in group]
+        users += 1
+        bet_count += len(user_bets)
+        if email:
+            batch.append((user_id, race.pk, email, _race_result_message(race, winner_name, user_bets)))
+        if len(batch) >= chunk_size:
+            yield batch, users, bet_count
+            batch, users, bet_count = [], 0, 0
+    if users:
+        yield batch, users, bet_count
+
+
+# Признак конца части в очереди пачек
+_PARTITION_DONE = object()
+
+
+def _put(batches, stop, item):
+    """Положить в очередь пачек; False, если запись уже остановлена"""
+    while not stop.is_set():
+        try:
+            batches.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _fan_out_reader(batches, stop, *args):
+    """Поток чтения одной части: пачки сообщений уходят писателю"""
+    try:
+        for item in _partition_batches(*args):
+            if not _put(batches, stop, item):
+                return
+    except Exception as e:
+        _put(batches, stop, e)
+    finally:
+        # У каждого потока свое соединение с базой
+        db_connection.close()
+        _put(batches, stop, _PARTITION_DONE)
+
+
+def _parallel_batches(race, winner_name, workers, chunk_size):
+    """
+    Пачки сообщений, которые читают и собирают workers потоков, каждый
+    по своей части пользователей. Пишет только вызывающий поток:
+    очередь пачек ограничена, поэтому чтение не уходит далеко вперед
+    записи, а база получает одного писателя (это допускает и SQLite)
+    """
+    batches = queue.Queue(maxsize=workers * 2)
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for partition in range(workers):
+            pool.submit(_fan_out_reader, batches, stop, race, winner_name, partition, workers, chunk_size)
+        try:
+            finished = 0
+            while finished < workers:
+                item = batches.get()
+                if item is _PARTITION_DONE:
+                    finished += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+
+
+def fan_out_race_results(race, workers=None, chunk_size=None):
+    """
+    Разослать всем сделавшим ставки на забег одно сводное сообщение
+    с результатами их ставок (через очередь уведомлений).
+
+    Пользователи делятся на workers частей по user_id, ставки каждой
+    части читает и превращает в сообщения свой поток со своим
+    соединением с базой, а записывает их текущий поток. Внутри
+    транзакции другие соединения не видят ее изменений - в этом случае
+    работа идет в текущем потоке. Повторный запуск по тому же забегу
+    не создает дублей. Возвращает {'users', 'bets', 'elapsed', 'rate'}
+    """
+    workers = workers or get_fan_out_workers()
+    chunk_size = chunk_size or FAN_OUT_CHUNK_SIZE
+    winner_name = Horse.objects.filter(pk=race.winner_id).values_list('name', flat=True).first()
+    started = time.perf_counter()
+
+    if workers == 1 or db_connection.in_atomic_block:
+        batches = _partition_batches(race, winner_name, 0, 1, chunk_size)
+    else:
+        batches = _parallel_batches(race, winner_name, workers, chunk_size)
+    users = bet_count = 0
+    try:
+        for rows, batch_users, batch_bets in batches:
+            if rows:
+                _insert_race_results(rows)
+            users += batch_users
+            bet_count += batch_bets
+    finally:
+        # При ошибке записи потоки чтения останавливаются сразу
+        batches.close()
+
+    elapsed = time.perf_counter() - started
+    result = {
+        'users': users,
+        'bets': bet_count,
+        'elapsed': elapsed,
+        'rate': users / elapsed if elapsed else 0,
+    }
+    logger.info(
+        'Результаты забега "%s": %s пользователей, %s ставок за %.2f с (%.0f пользователей/с)',
+        race.name, result['users'], result['bets'], elapsed, result['rate'],
+    )
+    return result
+
+
+def queue_race_results(race, now=None):
+    """
+    Поставить рассылку результатов забега в очередь. Вызывается
+    в транзакции расчета: задание появится только вместе с ним,
+    а рассылку выполнит send_notifications (fan_out_queued_races)
+    """
+    race.results_queued_at = now or timezone.now()
+    Race.objects.filter(pk=race.pk).update(results_queued_at=race.results_queued_at)
+
+
+def fan_out_queued_races(limit=None, workers=None):
+    """
+    Разослать результаты забегов из очереди (не больше limit забегов).
+
+    Отметка очереди снимается после рассылки и только если забег
+    не поставили в очередь заново за это время. Рассылка не создает
+    дублей, поэтому после сбоя или при параллельном запуске забег
+    просто обрабатывается повторно. Возвращает количество забегов
+    """
+    races = list(
+        Race.objects.filter(results_queued_at__isnull=False)
+        .order_by('results_queued_at')[:limit or FAN_OUT_RACES_PER_PASS]
+    )
+    done = 0
+    for race in races:
+        try:
+            fan_out_race_results(race, workers=workers)
+        except Exception:
+            logger.exception('Рассылка результатов забега %s не удалась, повтор на следующем проходе', race.pk)
+            continue
+        Race.objects.filter(pk=race.pk, results_queued_at=race.results_queued_at).update(results_queued_at=None)
+        done += 1
+    return done
+
 
 def send_race_notification(race, notification_type):
     """
     Уведомления о забегах
     """
     if notification_type == 'completed':
-        message = f'Забег "{race.name}" завершен! Результаты доступны в истории ставок.'
-        # Здесь можно добавить массовую рассылку пользователям
\ No newline at end of file
+        return queue_race_results(race)
+
+
+def claim_batch(batch_size=None, now=None):
+    """
+    Взять в отправку пачку уведомлений, время которых наступило.
+
+    Захват - условный UPDATE с меткой процесса, поэтому параллельные
+    отправители не получат одно уведомление дважды. Метка действует
+    CLAIM_TIMEOUT: если процесс упал, уведомления вернутся в очередь.
+    """
+    now = now or timezone.now()
+    due = Notification.objects.filter(status__in=DUE_STATUSES, next_attempt_at__lte=now)
+    ids = list(due.order_by('next_attempt_at', 'id').values_list('id', flat=True)[:batch_size or get_batch_size()])
+    if not ids:
+        return []
+
+    claim = uuid.uuid4().hex
+    due.filter(id__in=ids).update(status='sending', claim=claim, next_attempt_at=now + CLAIM_TIMEOUT)
+    return list(Notification.objects.filter(claim=claim, status='sending').order_by('id'))
+
+
+def _retry_delay(attempts):
+    return RETRY_DELAY * 2 ** (attempts - 1)
+
+
+def deliver_batch(notifications, connection, now=None):
+    """
+    Отправить пачку через одно открытое соединение почтового бэкенда
+    и записать результат. Возвращает {'sent', 'retry', 'dead'}
+    """
+    now = now or timezone.now()
+    sent = []
+    failed = {}
+    try:
+        connection.open()
+    except Exception as e:
+        # Бэкенд недоступен - вся пачка уходит на повтор
+        failed = {notification.pk: e for notification in notifications}
+    else:
+        try:
+            for notification in notifications:
+                message = EmailMessage(
+                    notification.subject, notification.body,
+                    settings.DEFAULT_FROM_EMAIL, [notification.recipient],
+                    connection=connection,
+                )
+                try:
+                    if connection.send_messages([message]):
+                        sent.append(notification.pk)
+                    else:
+                        failed[notification.pk] = 'Письмо не принято бэкендом'
+                except Exception as e:
+                    failed[notification.pk] = e
+        finally:
+            connection.close()
+
+    Notification.objects.filter(pk__in=sent).update(
+        status='sent', sent_at=now, claim='', attempts=F('attempts') + 1, last_error='',
+    )
+
+    result = {'sent': len(sent), 'retry': 0, 'dead': 0}
+    max_attempts = get_max_attempts()
+    retried = []
+    for notification in notifications:
+        if notification.pk not in failed:
+            continue
+        notification.attempts += 1
+        notification.claim = ''
+        notification.last_error = str(failed[notification.pk])[:1000]
+        if notification.attempts >= max_attempts:
+            notification.status = 'dead'
+            logger.warning('Уведомление %s не доставлено: %s', notification.pk, notification.last_error)
+        else:
+            notification.status = 'retry'
+            notification.next_attempt_at = now + _retry_delay(notification.attempts)
+        result[notification.status] += 1
+        retried.append(notification)
+    Notification.objects.bulk_update(
+        retried, ['attempts', 'claim', 'last_error', 'status', 'next_attempt_at'], batch_size=get_batch_size()
+    )
+    return result
+
+
+def drain_outbox(batch_size=None, max_batches=None, connection=None):
+    """
+    Отправлять пачки, пока в очереди есть уведомления, время которых
+    наступило (не больше max_batches пачек). Соединение почтового
+    бэкенда одно на пачку. Возвращает суммарные {'sent', 'retry', 'dead'}
+    """
+    connection = connection or get_connection()
+    totals = {'sent': 0, 'retry': 0, 'dead': 0}
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        notifications = claim_batch(batch_size)
+        if not notifications:
+            break
+        for key, value in deliver_batch(notifications, connection).items():
+            totals[key] += value
+        batches += 1
+    return totals
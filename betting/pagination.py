@@ -0,0 +1,78 @@
+import base64
+from datetime import datetime
+from django.db.models import Q
+
+# Количество строк на странице истории
+HISTORY_PAGE_SIZE = 25
+
+
+class KeysetPage:
+    """
+    Страница истории, выбранная по курсору (created_at, id).
+
+    В отличие от OFFSET-пагинации стоимость запроса не зависит от того,
+    насколько глубоко пользователь пролистал историю: каждая страница -
+    это индексный поиск по ключу и чтение page_size + 1 строк.
+    """
+
+    def __init__(self, items, has_older, has_newer):
+        self.items = items
+        self.has_older = has_older and bool(items)
+        self.has_newer = has_newer and bool(items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def older_cursor(self):
+        return encode_cursor(self.items[-1]) if self.has_older else None
+
+    @property
+    def newer_cursor(self):
+        return encode_cursor(self.items[0]) if self.has_newer else None
+
+
+def encode_cursor(obj):
+    raw = f'{obj.created_at.isoformat()}|{obj.pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Разобрать курсор. Для некорректного значения возвращает None"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, pk = raw.split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def keyset_page(queryset, before=None, after=None, page_size=HISTORY_PAGE_SIZE):
+    """
+    Выбрать страницу queryset (от новых к старым) по курсору.
+
+    before - курсор для перехода к более старым записям,
+    after - к более новым. Без курсора возвращается первая страница.
+    """
+    before = decode_cursor(before) if before else None
+    after = decode_cursor(after) if after else None
+
+    if after:
+        created_at, pk = after
+        rows = list(queryset.filter(
+            Q(created_at__gt=created_at) | Q(created_at=created_at, pk__gt=pk)
+        ).order_by('created_at', 'pk')[:page_size + 1])
+        has_newer = len(rows) > page_size
+        return KeysetPage(rows[:page_size][::-1], has_older=True, has_newer=has_newer)
+
+    queryset = queryset.order_by('-created_at', '-pk')
+    if before:
+        created_at, pk = before
+        queryset = queryset.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk)
+        )
+    rows = list(queryset[:page_size + 1])
+    return KeysetPage(rows[:page_size], has_older=len(rows) > page_size, has_newer=bool(before))
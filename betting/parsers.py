@@ -1,8 +1,13 @@
-import requests
+import logging
 from datetime import datetime, timedelta
 from decimal import Decimal
 import random
-from .models import Race, Horse
+from lxml import etree
+from . import feeds
+from .feedparse import iter_races
+from .ingest import ingest_stream
+
+logger = logging.getLogger(__name__)
 
 class RaceDataParser:
     """
@@ -12,31 +17,24 @@ class RaceDataParser:
     @staticmethod
     def parse_races_from_api():
         """
-        Парсинг данных из открытого API (пример с Horse Racing API)
-        Если API недоступно, генерируем тестовые данные
-        """
-        try:
-            # Попробуем получить данные из API
-            # Это пример - нужно найти реальное API
-            response = requests.get('https://api.example.com/horse-races', timeout=10)
-            if response.status_code == 200:
-                return RaceDataParser._parse_api_data(response.json())
-            else:
-                # Если API недоступно, генерируем реалистичные данные
-                return RaceDataParser._generate_realistic_data()
-        except:
-            # В случае ошибки генерируем реалистичные данные
-            return RaceDataParser._generate_realistic_data()
-    
-    @staticmethod
-    def _parse_api_data(api_data):
-        """
-        Парсинг данных из API (заглушка - нужно адаптировать под реальное API)
+        Получение данных о забегах из источников BETTING_FEED_SOURCES.
+        Источники опрашиваются параллельно, ответы разбираются прямо
+        из сетевого потока, по одному источнику за раз, и выдаются по
+        одному забегу. Недоступный или не изменившийся источник
+        пропускается, его состояние видно в get_fetcher().health.
+        Если источники не настроены, генерируем тестовые данные
         """
-        races_data = []
-        # Здесь должна быть логика парсинга реального API
-        # Пока возвращаем тестовые данные
-        return RaceDataParser._generate_realistic_data()
+        if not feeds.configured_sources():
+            yield from RaceDataParser._generate_realistic_data()
+            return
+
+        for source, body in feeds.get_fetcher().fetch_all():
+            if body is None:
+                continue
+            try:
+                yield from iter_races(body, source.format, source.name)
+            except (ValueError, etree.XMLSyntaxError, feeds.FeedError) as e:
+                logger.warning('Источник %s: не удалось разобрать ответ (%s)', source.name, e)
     
     @staticmethod
     def _generate_realistic_data():
@@ -105,33 +103,7 @@ class RaceDataParser:
     @staticmethod
     def update_races_from_real_sources():
         """
-        Основной метод для обновления данных о забегах из реальных источников
+        Основной метод для обновления данных о забегах из реальных источников.
+        Возвращает счетчики ingest_stream
         """
-        races_data = RaceDataParser.parse_races_from_api()
-        
-        for race_data in races_data:
-            # Проверяем, существует ли уже такой забег
-            existing_race = Race.objects.filter(
-                name=race_data['name'],
-                start_time=race_data['start_time']
-            ).first()
-            
-            if not existing_race:
-                # Создаем новый забег
-                race = Race.objects.create(
-                    name=race_data['name'],
-                    start_time=race_data['start_time'],
-                    status='scheduled'
-                )
-                
-                # Создаем лошадей для забега
-                for horse_data in race_data['horses']:
-                    Horse.objects.create(
-                        race=race,
-                        name=horse_data['name'],
-                        odds=horse_data['odds'],
-                        color=horse_data['color'],
-                        jockey=horse_data['jockey']
-                    )
-                
-                print(f"Создан забег: {race.name}")
\ No newline at end of file
+        return ingest_stream(RaceDataParser.parse_races_from_api())
@@ -0,0 +1,221 @@
+import hashlib
+import json
+from decimal import Decimal, InvalidOperation
+from django.db import IntegrityError, transaction
+from . import ledger, notifications, pools, stats
+from .models import Horse, Bet, BetSlip, Transaction
+
+MIN_BET_AMOUNT = Decimal('10')
+# Максимальное количество ставок в одном купоне
+MAX_SLIP_BETS = 100
+
+# Поправка к коэффициенту и название типа ставки для сообщений
+BET_TYPE_ODDS = {
+    'win': (Decimal('1'), 'победу'),
+    'place': (Decimal('0.6'), 'место'),
+    'show': (Decimal('0.4'), 'показ'),
+}
+
+
+class BetError(Exception):
+    """Ставка отклонена. Текст исключения можно показать пользователю"""
+
+
+def parse_amount(amount):
+    """Привести сумму ставки к Decimal с двумя знаками"""
+    try:
+        amount = Decimal(str(amount)).quantize(Decimal('0.01'))
+    except (InvalidOperation, TypeError, ValueError):
+        raise BetError('Введите корректную сумму')
+    if not amount.is_finite():
+        raise BetError('Введите корректную сумму')
+    return amount
+
+
+def debit_balance(user_id, amount):
+    """
+    Списать amount с баланса, если средств достаточно.
+    Проверка и списание - один условный UPDATE, поэтому параллельные
+    ставки одного пользователя не могут увести баланс в минус.
+    Возвращает операцию журнала, которую нужно сохранить через
+    ledger.record() в той же транзакции.
+    """
+    try:
+        return ledger.debit(user_id, amount, 'bet')
+    except ledger.InsufficientFunds:
+        raise BetError('Недостаточно средств')
+
+
+def validate_bet(horse_id, amount, bet_type):
+    """Проверить параметры ставки до обращения к базе"""
+    if not isinstance(bet_type, str) or bet_type not in BET_TYPE_ODDS:
+        raise BetError('Неизвестный тип ставки')
+    try:
+        horse_id = int(horse_id)
+    except (TypeError, ValueError):
+        raise BetError('Выберите лошадь')
+    amount = parse_amount(amount)
+    if amount < MIN_BET_AMOUNT:
+        raise BetError(f'Минимальная сумма ставки - {MIN_BET_AMOUNT} ₽')
+    return horse_id, amount
+
+
+def place_bet(user, race_id, horse_id, amount, bet_type='win'):
+    """
+    Разместить ставку одной транзакцией: условное списание баланса
+    с записью в журнал, создание ставки, обновление статистики и пула,
+    постановка уведомления в очередь отправки.
+
+    Коэффициент читается после списания, внутри той же транзакции,
+    поэтому ставка фиксирует согласованный с балансом снимок.
+    Возвращает созданную ставку, при отказе бросает BetError.
+    """
+    horse_id, amount = validate_bet(horse_id, amount, bet_type)
+    odds_factor, bet_type_display = BET_TYPE_ODDS[bet_type]
+
+    with transaction.atomic():
+        entry = debit_balance(user.pk, amount)
+
+        horse = Horse.objects.filter(
+            id=horse_id, race_id=race_id, race__status='scheduled'
+        ).only('id', 'name', 'odds', 'race_id').first()
+        if horse is None:
+            # Откатываем списание
+            raise BetError('Ставки на эту лошадь не принимаются')
+
+        entry.description = f'Ставка на {bet_type_display} - {horse.name}'
+        ledger.record([entry])
+
+        bet = Bet.objects.create(
+            user=user,
+            race_id=race_id,
+            horse=horse,
+            bet_type=bet_type,
+            amount=amount,
+            odds=(horse.odds * odds_factor).quantize(Decimal('0.01')),
+        )
+
+        # Обновляем статистику пользователя и пул забега
+        stats.record_bet(bet)
+        pools.record_bet(bet)
+        notifications.send_bet_notification(user, bet, 'placed')
+
+    return bet
+
+
+def _slip_item_error(index, error):
+    return BetError(f'Ставка #{index + 1}: {error}')
+
+
+def place_bet_slip(user, items, idempotency_key=''):
+    """
+    Разместить купон из нескольких ставок на разные забеги.
+
+    Все лошади проверяются одним запросом, баланс списывается одним
+    условным UPDATE на сумму купона с записью операций в журнал
+    (ledger.post_many), ставки создаются через bulk_create - все
+    в одной транзакции: купон принимается целиком или не принимается
+    вовсе.
+
+    Повтор с тем же idempotency_key возвращает сохраненный купон
+    без повторного списания. Возвращает (купон, повтор ли это).
+    """
+    if not items:
+        raise BetError('Купон пуст')
+    if len(items) > MAX_SLIP_BETS:
+        raise BetError(f'В купоне не больше {MAX_SLIP_BETS} ставок')
+
+    request_hash = hashlib.sha256(
+        json.dumps(items, sort_keys=True, default=str).encode()
+    ).hexdigest()
+    if idempotency_key:
+        slip = _replay_slip(user, idempotency_key, request_hash)
+        if slip:
+            return slip, True
+
+    parsed = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise _slip_item_error(index, 'неверный формат')
+        try:
+            horse_id, amount = validate_bet(item.get('horse_id'), item.get('amount'), item.get('bet_type', 'win'))
+        except BetError as e:
+            raise _slip_item_error(index, e)
+        parsed.append((item.get('race_id'), horse_id, amount, item.get('bet_type', 'win')))
+    total = sum(amount for _, _, amount, _ in parsed)
+
+    try:
+        with transaction.atomic():
+            # Запись купона первой занимает ключ идемпотентности
+            slip = BetSlip.objects.create(
+                user=user, idempotency_key=idempotency_key,
+                request_hash=request_hash, total_amount=total,
+            )
+
+            horses = Horse.objects.filter(
+                id__in={horse_id for _, horse_id, _, _ in parsed}, race__status='scheduled'
+            ).only('id', 'name', 'odds', 'race_id').in_bulk()
+
+            bets = []
+            for index, (race_id, horse_id, amount, bet_type) in enumerate(parsed):
+                horse = horses.get(horse_id)
+                if horse is None or (race_id is not None and str(race_id) != str(horse.race_id)):
+                    raise _slip_item_error(index, 'ставки на эту лошадь не принимаются')
+                odds = (horse.odds * BET_TYPE_ODDS[bet_type][0]).quantize(Decimal('0.01'))
+                bets.append(Bet(
+                    user=user, race_id=horse.race_id, horse=horse, bet_type=bet_type,
+                    amount=amount, odds=odds, potential_win=(amount * odds).quantize(Decimal('0.01')),
+                ))
+            try:
+                entries = ledger.post_many([
+                    Transaction(
+                        user=user,
+                        transaction_type='bet',
+                        amount=bet.amount,
+                        description=f'Ставка на {BET_TYPE_ODDS[bet.bet_type][1]} - {bet.horse.name}',
+                    )
+                    for bet in bets
+                ])
+            except ledger.InsufficientFunds:
+                raise BetError('Недостаточно средств')
+            bets = Bet.objects.bulk_create(bets)
+
+            # Обновляем статистику пользователя и пулы забегов
+            stats.record_bets(bets)
+            pools.record_bets(bets)
+            notifications.notify_bets_placed(user, bets)
+
+            balance = entries[-1].balance_after
+            slip.response = {
+                'slip_id': slip.pk,
+                'total_amount': str(total),
+                'balance': str(balance),
+                'bets': [
+                    {
+                        'id': bet.pk,
+                        'race_id': bet.race_id,
+                        'horse_id': bet.horse_id,
+                        'bet_type': bet.bet_type,
+                        'amount': str(bet.amount),
+                        'odds': str(bet.odds),
+                        'potential_win': str(bet.potential_win),
+                    }
+                    for bet in bets
+                ],
+            }
+            slip.save(update_fields=['response'])
+    except IntegrityError:
+        # Параллельный запрос с тем же ключом успел первым
+        slip = _replay_slip(user, idempotency_key, request_hash) if idempotency_key else None
+        if slip is None:
+            raise
+        return slip, True
+
+    return slip, False
+
+
+def _replay_slip(user, idempotency_key, request_hash):
+    slip = BetSlip.objects.filter(user=user, idempotency_key=idempotency_key).first()
+    if slip is not None and slip.request_hash != request_hash:
+        raise BetError('Ключ идемпотентности уже использован для другого купона')
+    return slip
@@ -0,0 +1,135 @@
+from collections import defaultdict
+from decimal import Decimal
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from .caching import invalidate_races
+from .models import Horse, Bet, BettingPool
+from .utils import bulk_increment
+
+# Доля тотализатора по умолчанию, если BETTING_TAKEOUT не задан
+DEFAULT_TAKEOUT = 0.15
+# Пороги ликвидности по умолчанию (BETTING_TOTE_MIN_POOL и
+# BETTING_TOTE_MIN_COVERAGE): сумма пула забега и доля лошадей со ставками
+DEFAULT_TOTE_MIN_POOL = 1000
+DEFAULT_TOTE_MIN_COVERAGE = 1.0
+# Пределы коэффициента (Horse.tote_odds - DecimalField(max_digits=5))
+MIN_ODDS = 1.01
+MAX_ODDS = 999.99
+
+
+def record_bet(bet):
+    """Добавить ставку в пул забега. Вызывается в транзакции размещения ставки"""
+    pool = BettingPool.objects.filter(race_id=bet.race_id, horse_id=bet.horse_id, bet_type=bet.bet_type)
+    increment = {'stake': F('stake') + bet.amount, 'bet_count': F('bet_count') + 1}
+    if not pool.update(**increment):
+        BettingPool.objects.get_or_create(race_id=bet.race_id, horse_id=bet.horse_id, bet_type=bet.bet_type)
+        pool.update(**increment)
+
+
+def record_bets(bets):
+    """
+    Добавить пачку ставок в пулы: создание недостающих строк,
+    чтение их id и один UPDATE ... CASE на пачку пулов.
+    """
+    deltas = defaultdict(lambda: {'stake': Decimal('0'), 'bet_count': 0})
+    for bet in bets:
+        key = (bet.race_id, bet.horse_id, bet.bet_type)
+        deltas[key]['stake'] += bet.amount
+        deltas[key]['bet_count'] += 1
+    if not deltas:
+        return 0
+
+    BettingPool.objects.bulk_create(
+        [BettingPool(race_id=race_id, horse_id=horse_id, bet_type=bet_type) for race_id, horse_id, bet_type in deltas],
+        ignore_conflicts=True,
+    )
+    pool_ids = BettingPool.objects.filter(
+        race_id__in={key[0] for key in deltas}, horse_id__in={key[1] for key in deltas},
+    ).values_list('race_id', 'horse_id', 'bet_type', 'id')
+    return bulk_increment(BettingPool, 'id', {
+        pool_id: deltas[(race_id, horse_id, bet_type)]
+        for race_id, horse_id, bet_type, pool_id in pool_ids
+        if (race_id, horse_id, bet_type) in deltas
+    })
+
+
+def rebuild_pools(race_ids):
+    """Пересобрать пулы забегов по таблице ставок"""
+    race_ids = list(race_ids)
+    with transaction.atomic():
+        BettingPool.objects.filter(race_id__in=race_ids).delete()
+        rows = Bet.objects.filter(race_id__in=race_ids).values(
+            'race_id', 'horse_id', 'bet_type'
+        ).annotate(total=Sum('amount'), count=Count('id')).order_by()
+        BettingPool.objects.bulk_create([
+            BettingPool(
+                race_id=row['race_id'], horse_id=row['horse_id'], bet_type=row['bet_type'],
+                stake=row['total'], bet_count=row['count'],
+            )
+            for row in rows
+        ], batch_size=1000)
+
+
+def tote_odds(race_index, stakes, takeout, min_pool=0, min_coverage=0):
+    """
+    Коэффициенты тотализатора для всех лошадей сразу.
+
+    race_index - номер забега для каждой лошади (0..n-1),
+    stakes - сумма ставок на лошадь (0 - ставок нет). Коэффициент
+    лошади равен (1 - takeout) * пул забега / ставки на лошадь.
+    Цена публикуется только для забегов, пул которых не меньше
+    min_pool, а доля лошадей со ставками не меньше min_coverage:
+    по малому или однобокому пулу коэффициент бессмыслен (одна
+    лошадь со ставками получила бы минимальный коэффициент). Для
+    остальных забегов и для лошадей без ставок возвращается NaN.
+    """
+    stakes = np.asarray(stakes, dtype=float)
+    race_totals = np.bincount(race_index, weights=stakes)
+    coverage = np.bincount(race_index, weights=stakes > 0) / np.bincount(race_index)
+    liquid = (race_totals >= min_pool) & (race_totals > 0) & (coverage >= min_coverage)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        odds = (1 - takeout) * race_totals[race_index] / stakes
+    odds[(stakes <= 0) | ~liquid[race_index]] = np.nan
+    return np.round(np.clip(odds, MIN_ODDS, MAX_ODDS), 2)
+
+
+def recompute_odds(takeout=None, bet_type='win'):
+    """
+    Пересчитать коэффициенты тотализатора (Horse.tote_odds) всех
+    открытых забегов по пулам ставок: чтение лошадей и пулов, расчет
+    в NumPy (tote_odds) и один bulk_update изменившихся лошадей.
+    Horse.odds - фиксированный коэффициент ленты, по которому
+    принимаются ставки, - не меняется. Пороги ликвидности задают
+    BETTING_TOTE_MIN_POOL и BETTING_TOTE_MIN_COVERAGE; пока забег их
+    не достиг, его цены тотализатора не публикуются (NULL).
+    Возвращает количество обновленных лошадей.
+    """
+    if takeout is None:
+        takeout = getattr(settings, 'BETTING_TAKEOUT', DEFAULT_TAKEOUT)
+
+    horses = list(Horse.objects.filter(race__status='scheduled').values_list('id', 'race_id', 'tote_odds'))
+    if not horses:
+        return 0
+    stakes = dict(BettingPool.objects.filter(
+        race__status='scheduled', bet_type=bet_type,
+    ).values_list('horse_id', 'stake'))
+
+    horse_ids, race_ids, current = zip(*horses)
+    _, race_index = np.unique(race_ids, return_inverse=True)
+    odds = tote_odds(
+        race_index, [float(stakes.get(horse_id, 0)) for horse_id in horse_ids], takeout,
+        min_pool=getattr(settings, 'BETTING_TOTE_MIN_POOL', DEFAULT_TOTE_MIN_POOL),
+        min_coverage=getattr(settings, 'BETTING_TOTE_MIN_COVERAGE', DEFAULT_TOTE_MIN_COVERAGE),
+    )
+
+    changed = []
+    for horse_id, new, old in zip(horse_ids, odds, current):
+        new = None if np.isnan(new) else Decimal(f'{new:.2f}')
+        if new != old:
+            changed.append(Horse(id=horse_id, tote_odds=new))
+    Horse.objects.bulk_update(changed, ['tote_odds'], batch_size=500)
+    if changed:
+        invalidate_races()
+    return len(changed)
@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.db import transaction
+from .caching import invalidate_users, user_cache, user_cache_key
+from .ledger import open_account
+from .models import UserProfile
+
+# Время жизни пользователя с профилем в кэше, секунд. Изменения
+# баланса и сохранения пользователя и профиля сбрасывают запись сразу;
+# срок ограничивает устаревание после изменений в обход моделей
+# (например, queryset.update)
+DEFAULT_TIMEOUT = 60
+
+
+def get_timeout():
+    return getattr(settings, 'BETTING_USER_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def _users():
+    return User._default_manager.select_related('betting_profile')
+
+
+def cached_user(user_id):
+    """
+    Пользователь вместе с профилем (user.betting_profile не делает
+    запроса): из общего кэша (caching.user_cache) или одним запросом
+    с JOIN. None - нет пользователя
+    """
+    users = user_cache()
+    if users is None:
+        return _users().filter(pk=user_id).first()
+    key = user_cache_key(user_id)
+    user = users.get(key)
+    if user is None:
+        user = _users().filter(pk=user_id).first()
+        if user is not None:
+            users.set(key, user, get_timeout())
+    return user
+
+
+async def acached_user(user_id):
+    users = user_cache()
+    if users is None:
+        return await _users().filter(pk=user_id).afirst()
+    key = user_cache_key(user_id)
+    user = await users.aget(key)
+    if user is None:
+        user = await _users().filter(pk=user_id).afirst()
+        if user is not None:
+            await users.aset(key, user, get_timeout())
+    return user
+
+
+class CachedProfileBackend(ModelBackend):
+    """
+    Аутентификация по модели User; пользователь сессии загружается
+    вместе с профилем ставок одним запросом, а при общем кэше
+    пользователей - из кэша (cached_user)
+    """
+
+    def get_user(self, user_id):
+        user = cached_user(user_id)
+        return user if user is not None and self.user_can_authenticate(user) else None
+
+    async def aget_user(self, user_id):
+        user = await acached_user(user_id)
+        return user if user is not None and self.user_can_authenticate(user) else None
+
+
+def get_profile(user):
+    """
+    Профиль пользователя. Профили создаются вместе с пользователем;
+    для старых пользователей без профиля он создается здесь
+    """
+    try:
+        return user.betting_profile
+    except UserProfile.DoesNotExist:
+        pass
+    with transaction.atomic():
+        profile, created = UserProfile.objects.get_or_create(user=user)
+        if created:
+            open_account(profile)
+    invalidate_users([user.pk])
+    user.betting_profile = profile
+    return profile
@@ -0,0 +1,199 @@
+import json
+import logging
+from decimal import Decimal
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections as db_connections, transaction
+from django.db.models import Count, Max, Min, OuterRef, Subquery
+from django.utils import timezone
+from .caching import invalidate_users
+from .ledger import signed_amount_sum
+from .models import Transaction, UserProfile
+
+logger = logging.getLogger(__name__)
+
+# Пользователей в одном блоке сверки
+RECONCILE_CHUNK_SIZE = 5000
+
+CENT = Decimal('0.01')
+
+
+def partition_bounds(partitions):
+    """
+    Разбить пользователей на partitions непересекающихся диапазонов
+    user_id [от, до] примерно равной ширины. Каждый диапазон сверяется
+    независимо, в том числе отдельным процессом
+    """
+    bounds = UserProfile.objects.aggregate(low=Min('user_id'), high=Max('user_id'))
+    if bounds['low'] is None:
+        return []
+    low, high = bounds['low'], bounds['high']
+    width = (high - low) // partitions + 1
+    return [
+        (start, min(start + width - 1, high))
+        for start in range(low, high + 1, width)
+    ]
+
+
+def _ledger_totals(transactions):
+    """Сумма операций со знаком и их количество: {user_id: (сумма, операций)}"""
+    return {
+        row['user_id']: ((row['total'] or Decimal('0')).quantize(CENT), row['entries'])
+        for row in transactions.values('user_id').annotate(
+            total=signed_amount_sum(), entries=Count('id')
+        ).order_by()
+    }
+
+
+def _inspect(profiles, transactions):
+    """
+    Сверить профили с их журналом: баланс с суммой операций, счетчик
+    операций с их количеством и balance_after последней операции с
+    балансом. Возвращает (проверено пользователей, список расхождений)
+    """
+    last_balance = Transaction.objects.filter(user_id=OuterRef('user_id')).order_by(
+        '-created_at', '-id'
+    ).values('balance_after')[:1]
+    rows = profiles.annotate(last_balance=Subquery(last_balance)).values_list(
+        'user_id', 'balance', 'ledger_entries', 'last_balance'
+    )
+    totals = _ledger_totals(transactions)
+
+    checked = 0
+    discrepancies = []
+    for user_id, balance, entries, last in rows:
+        checked += 1
+        ledger_balance, ledger_entries = totals.get(user_id, (Decimal('0.00'), 0))
+        problems = []
+        if balance != ledger_balance:
+            problems.append('balance')
+        if entries != ledger_entries:
+            problems.append('entries')
+        if last != (balance if ledger_entries else None):
+            problems.append('balance_after')
+        if problems:
+            discrepancies.append({
+                'user_id': user_id,
+                'problems': problems,
+                'profile_balance': str(balance),
+                'ledger_balance': str(ledger_balance),
+                'drift': str(balance - ledger_balance),
+                'last_balance_after': None if last is None else str(last),
+                'profile_entries': entries,
+                'ledger_entries': ledger_entries,
+            })
+    return checked, discrepancies
+
+
+def check_range(low, high):
+    """Сверить пользователей с user_id в [low, high] (два запроса)"""
+    return _inspect(
+        UserProfile.objects.filter(user_id__gte=low, user_id__lte=high),
+        Transaction.objects.filter(user_id__gte=low, user_id__lte=high),
+    )
+
+
+def _ledger_intact(item):
+    """balance_after последней операции сходится с суммой журнала"""
+    if not item['ledger_entries']:
+        return item['last_balance_after'] is None
+    return item['last_balance_after'] is not None and Decimal(item['last_balance_after']) == Decimal(item['ledger_balance'])
+
+
+def repair(user_ids):
+    """
+    Исправить расхождения пользователей user_ids. Журнал - источник
+    истины: баланс профиля и счетчик операций выставляются по журналу
+    (сумма операций со знаком и их количество), найденная разница
+    пишется в лог. Расхождения пересчитываются под блокировкой профилей:
+    операция, прошедшая между проверкой и исправлением, не превращается
+    в ложное исправление. Если balance_after последней операции не
+    сходится с суммой журнала, испорчен сам журнал - такое расхождение
+    только попадает в отчет. Возвращает множество исправленных user_id
+    """
+    if not user_ids:
+        return set()
+    with transaction.atomic():
+        profiles = UserProfile.objects.select_for_update().filter(user_id__in=user_ids)
+        _, discrepancies = _inspect(profiles, Transaction.objects.filter(user_id__in=user_ids))
+        fixable = {
+            item['user_id']: item for item in discrepancies
+            if _ledger_intact(item)
+        }
+        if not fixable:
+            return set()
+
+        now = timezone.now()
+        reset = []
+        for profile in profiles.filter(user_id__in=fixable):
+            item = fixable[profile.user_id]
+            logger.warning(
+                'Баланс пользователя %s приведен к журналу: %s -> %s (операций %s -> %s)',
+                profile.user_id, profile.balance, item['ledger_balance'],
+                profile.ledger_entries, item['ledger_entries'],
+            )
+            profile.balance = Decimal(item['ledger_balance'])
+            profile.ledger_entries = item['ledger_entries']
+            profile.updated_at = now
+            reset.append(profile)
+        UserProfile.objects.bulk_update(reset, ['balance', 'ledger_entries', 'updated_at'])
+        # Баланс закэширован вместе с пользователем (betting/profiles.py)
+        invalidate_users(fixable)
+    return set(fixable)
+
+
+def _chunk_end(start, high, chunk_size):
+    """
+    Последний user_id блока из chunk_size пользователей, начиная со
+    start (поиск по индексу без чтения строк), но не дальше high
+    """
+    end = UserProfile.objects.filter(user_id__gte=start, user_id__lte=high).order_by(
+        'user_id'
+    ).values_list('user_id', flat=True)[chunk_size - 1:chunk_size].first()
+    return high if end is None else end
+
+
+def reconcile_range(low, high, chunk_size=RECONCILE_CHUNK_SIZE, fix=False, report=None):
+    """
+    Сверить пользователей с user_id в [low, high] блоками по chunk_size
+    пользователей (по ключу user_id, без OFFSET). На блок - три запроса,
+    в памяти держится только текущий блок. С fix=True расхождения блока
+    сразу исправляются (repair). Каждое расхождение передается в
+    report(dict). Возвращает сводку
+    {'users', 'discrepancies', 'repaired', 'drift'}
+    """
+    summary = {'users': 0, 'discrepancies': 0, 'repaired': 0, 'drift': Decimal('0')}
+    start = low
+    while start <= high:
+        end = _chunk_end(start, high, chunk_size)
+        checked, discrepancies = check_range(start, end)
+        repaired = repair([item['user_id'] for item in discrepancies]) if fix else set()
+
+        summary['users'] += checked
+        summary['discrepancies'] += len(discrepancies)
+        summary['repaired'] += len(repaired)
+        for item in discrepancies:
+            summary['drift'] += Decimal(item['drift'])
+            item['repaired'] = item['user_id'] in repaired
+            if report is not None:
+                report(item)
+        start = end + 1
+    return summary
+
+
+def report_line(item):
+    """Строка машиночитаемого отчета (JSON Lines)"""
+    return json.dumps(item, ensure_ascii=False, cls=DjangoJSONEncoder) + '\n'
+
+
+def reconcile_partition(low, high, path, chunk_size=RECONCILE_CHUNK_SIZE, fix=False):
+    """
+    Сверить диапазон [low, high] в отдельном процессе и записать
+    расхождения в файл path. Возвращает сводку reconcile_range
+    """
+    try:
+        with open(path, 'w', encoding='utf-8') as output:
+            return reconcile_range(
+                low, high, chunk_size=chunk_size, fix=fix, report=lambda item: output.write(report_line(item))
+            )
+    finally:
+        db_connections.close_all()
@@ -0,0 +1,159 @@
+import logging
+import math
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+# Допустимое отставание реплики, секунд: дольше этого после записи
+# клиент читает с основной базы, и реплика с большим отставанием не
+# используется вовсе
+DEFAULT_MAX_LAG = 5
+# Как часто перепроверять отставание реплики, секунд
+LAG_CHECK_INTERVAL = 5
+# Cookie клиента, недавно писавшего в базу
+PRIMARY_COOKIE = 'ippodrom_primary'
+
+
+class RoutingState:
+    """Состояние маршрутизации запроса: разрешено ли читать с реплики и была ли запись"""
+
+    def __init__(self, pinned=False):
+        self.replica_reads = False
+        self.pinned = pinned
+        self.wrote = False
+
+
+_state = ContextVar('betting_routing_state', default=None)
+# alias -> (время проверки, отставание в секундах или None)
+_lag_checks = {}
+
+
+def get_replica_alias():
+    alias = getattr(settings, 'BETTING_REPLICA_DATABASE', None)
+    return alias if alias in connections.settings else None
+
+
+def get_max_lag():
+    return getattr(settings, 'BETTING_REPLICA_MAX_LAG', DEFAULT_MAX_LAG)
+
+
+def replica_lag(alias):
+    """
+    Отставание реплики alias, секунд; None - реплика недоступна.
+    Для PostgreSQL - время с последней примененной транзакции
+    (на простаивающей основной базе растет и без реального
+    отставания). Копию SQLite считаем актуальной
+    """
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT CASE WHEN pg_is_in_recovery() '
+                'THEN COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) ELSE 0 END'
+            )
+            return float(cursor.fetchone()[0])
+    except DatabaseError:
+        logger.warning('Реплика %s недоступна', alias, exc_info=True)
+        return None
+
+
+def replica_is_fresh(alias):
+    """Отставание реплики в пределах BETTING_REPLICA_MAX_LAG (проверка кэшируется)"""
+    now = time.monotonic()
+    checked = _lag_checks.get(alias)
+    if checked is None or now - checked[0] >= LAG_CHECK_INTERVAL:
+        lag = replica_lag(alias)
+        if lag is not None and lag > get_max_lag():
+            logger.warning('Реплика %s отстает на %.1f с, чтение идет с основной базы', alias, lag)
+        checked = _lag_checks[alias] = (now, lag)
+    return checked[1] is not None and checked[1] <= get_max_lag()
+
+
+@contextmanager
+def replica_reads():
+    """
+    Разрешить чтение с реплики внутри блока. После первой записи
+    чтения до конца запроса идут с основной базы
+    """
+    state = _state.get()
+    token = None
+    if state is None:
+        token = _state.set(state := RoutingState())
+    previous, state.replica_reads = state.replica_reads, True
+    try:
+        yield
+    finally:
+        state.replica_reads = previous
+        if token is not None:
+            _state.reset(token)
+
+
+def use_replica(func):
+    """Декоратор: функция читает с реплики (см. replica_reads)"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with replica_reads():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class ReplicaRouter:
+    """
+    Чтения внутри replica_reads() - на реплику BETTING_REPLICA_DATABASE,
+    все остальное - на основную базу. Реплика не используется, если
+    в этом запросе уже была запись, клиент писал в базу в пределах
+    допустимого отставания (cookie ReplicaPinningMiddleware) или
+    реплика отстает больше допустимого
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        alias = get_replica_alias()
+        if state is None or not state.replica_reads or state.pinned or alias is None:
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        return alias if replica_is_fresh(alias) else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.pinned = state.wrote = True
+        # Явно: иначе объект, прочитанный с реплики, сохранился бы в нее
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплика содержит те же данные, что и основная база
+        return True
+
+
+class ReplicaPinningMiddleware:
+    """
+    Чтение своих записей между запросами: после запроса с записью
+    клиент получает cookie на BETTING_REPLICA_MAX_LAG секунд, и пока
+    она жива, его чтения идут с основной базы
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = RoutingState(pinned=PRIMARY_COOKIE in request.COOKIES)
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        if state.wrote and get_replica_alias() is not None:
+            response.set_cookie(
+                PRIMARY_COOKIE, '1', max_age=math.ceil(get_max_lag()), httponly=True, samesite='Lax',
+            )
+        return response
@@ -0,0 +1,175 @@
+import heapq
+import logging
+import threading
+from datetime import timedelta
+from django.db import close_old_connections
+from django.utils import timezone
+from . import feeds
+from .models import Race
+from .parsers import RaceDataParser
+from .pools import recompute_odds
+from .tasks import RACE_DURATION, finish_race
+
+logger = logging.getLogger(__name__)
+
+# Типы событий в очереди
+SETTLE = 'settle'
+REFRESH = 'refresh'
+ODDS = 'odds'
+SYNC = 'sync'
+
+# Пауза перед повтором события после ошибки; удваивается с каждой
+# ошибкой подряд, но не превышает RETRY_MAX
+RETRY_BASE = timedelta(seconds=5)
+RETRY_MAX = timedelta(minutes=5)
+
+
+class RaceScheduler:
+    """
+    Планировщик расчета забегов и обновления данных о забегах.
+
+    Держит min-heap событий (время, тип, id забега) и спит ровно до
+    ближайшего из них, а не опрашивает базу в цикле. Событие SETTLE
+    наступает через RACE_DURATION после старта забега, событие REFRESH
+    повторяется каждые feed_interval и заодно перечитывает расписание,
+    чтобы подхватить забеги, добавленные через админку или парсер.
+    Событие ODDS раз в odds_interval пересчитывает коэффициенты
+    тотализатора по пулам (Horse.tote_odds). Событие SYNC раз в
+    sync_interval загружает ленты настроенных источников независимо от
+    расписания: так до открытых забегов доходят изменения коэффициентов
+    (ingest.sync_odds) и отмены.
+
+    Ошибка события (например, при расчете забега) записывается в лог и
+    не останавливает планировщик: событие повторяется с экспоненциальной
+    паузой от RETRY_BASE до RETRY_MAX.
+    """
+
+    def __init__(self, feed_interval=timedelta(minutes=5), odds_interval=timedelta(seconds=30),
+                 sync_interval=timedelta(minutes=1), log=None):
+        self.feed_interval = feed_interval
+        self.odds_interval = odds_interval
+        self.sync_interval = sync_interval
+        self.log = log or logger.info
+        self.heap = []
+        # Ошибок подряд по событию (тип, id забега)
+        self.failures = {}
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def reload(self, now=None):
+        """Перестроить очередь по текущему расписанию забегов"""
+        now = now or timezone.now()
+        races = Race.objects.filter(status='scheduled').values_list('id', 'start_time')
+        # Отложенные после ошибки повторы расчета сохраняют свою паузу
+        retries = {
+            race_id: when for when, kind, race_id in self.heap
+            if kind == SETTLE and (kind, race_id) in self.failures
+        }
+        heap = []
+        for race_id, start_time in races:
+            deadline = start_time + RACE_DURATION
+            heap.append((max(deadline, retries.get(race_id, deadline)), SETTLE, race_id))
+        heap.append((now + self.feed_interval, REFRESH, None))
+        heap.append((now + self.odds_interval, ODDS, None))
+        heap.append((now + self.sync_interval, SYNC, None))
+        heapq.heapify(heap)
+        self.heap = heap
+        # Забыть ошибки забегов, которые больше не ждут расчета
+        scheduled = {race_id for _, kind, race_id in heap if kind == SETTLE}
+        self.failures = {
+            (kind, race_id): count for (kind, race_id), count in self.failures.items()
+            if kind != SETTLE or race_id in scheduled
+        }
+
+    def refresh_feed(self):
+        """Обновить данные о забегах, если запланированных забегов не осталось"""
+        if Race.objects.filter(status='scheduled').exists():
+            return
+        try:
+            RaceDataParser.update_races_from_real_sources()
+            self.log('Данные о забегах обновлены')
+        except Exception as e:
+            self.log(f'Не удалось обновить данные о забегах: {e}')
+
+    def sync_feed(self):
+        """
+        Загрузить ленты настроенных источников: новые забеги, отмены и
+        изменившиеся коэффициенты открытых забегов. Источники отвечают
+        304 на условный GET, пока данные не изменились, поэтому частый
+        опрос дешев. Без настроенных источников ничего не делает
+        """
+        if not feeds.configured_sources():
+            return
+        counts = RaceDataParser.update_races_from_real_sources()
+        if counts['races'] or counts['odds_updated'] or counts['cancelled']:
+            self.log(
+                f'Лента: новых забегов {counts["races"]}, обновлено коэффициентов '
+                f'{counts["odds_updated"]}, отменено забегов {counts["cancelled"]}'
+            )
+
+    def settle(self, race_id, now):
+        """Завершить забег, если он все еще ожидает расчета"""
+        race = Race.objects.filter(id=race_id, status='scheduled').first()
+        if race is None:
+            return
+        deadline = race.start_time + RACE_DURATION
+        if deadline > now:
+            # Время старта перенесли - ставим забег в очередь заново
+            heapq.heappush(self.heap, (deadline, SETTLE, race.id))
+            return
+
+        winner = finish_race(race)
+        if winner:
+            self.log(f'Забег "{race.name}" завершен. Победитель: {winner.name}')
+        else:
+            self.log(f'Забег "{race.name}" отменен (нет лошадей)')
+
+    def run_pending(self, now=None):
+        """Обработать все наступившие события. Возвращает время следующего"""
+        now = now or timezone.now()
+        while self.heap and self.heap[0][0] <= now:
+            when, kind, race_id = heapq.heappop(self.heap)
+            close_old_connections()
+            try:
+                self.dispatch(kind, race_id, now)
+            except Exception:
+                self.retry(kind, race_id, now)
+            else:
+                self.failures.pop((kind, race_id), None)
+        return self.heap[0][0] if self.heap else None
+
+    def dispatch(self, kind, race_id, now):
+        """Выполнить одно событие очереди"""
+        if kind == REFRESH:
+            self.refresh_feed()
+            self.reload(now)
+        elif kind == ODDS:
+            recompute_odds()
+            heapq.heappush(self.heap, (now + self.odds_interval, ODDS, None))
+        elif kind == SYNC:
+            self.sync_feed()
+            heapq.heappush(self.heap, (now + self.sync_interval, SYNC, None))
+        else:
+            self.settle(race_id, now)
+
+    def retry(self, kind, race_id, now):
+        """Записать ошибку события в лог и поставить его в очередь повторно с паузой"""
+        failures = self.failures.get((kind, race_id), 0) + 1
+        self.failures[kind, race_id] = failures
+        delay = min(RETRY_BASE * 2 ** (failures - 1), RETRY_MAX)
+        logger.exception(
+            'Событие %s (забег %s) завершилось ошибкой (%s подряд), повтор через %s',
+            kind, race_id, failures, delay,
+        )
+        heapq.heappush(self.heap, (now + delay, kind, race_id))
+
+    def run_forever(self):
+        self.refresh_feed()
+        self.reload()
+        while not self.stop_event.is_set():
+            next_at = self.run_pending()
+            delay = (next_at - timezone.now()).total_seconds() if next_at else self.feed_interval.total_seconds()
+            # Спим до ближайшего события или до остановки
+            self.stop_event.wait(max(delay, 0))
@@ -1,7 +1,10 @@
-from django.utils import timezone
-from .models import Race, Bet, UserProfile
-from django.db.models import Sum, Count
-from django.contrib.auth.models import User
+from django.db import transaction
+from .models import BettingPool
+from .settlement import record_results, settle_race
+from .placement import BetError, place_bet
+from .replicas import use_replica
+from .stats import get_user_stats
+from django.db.models import Sum
 
 class BettingService:
     @staticmethod
@@ -13,31 +16,10 @@ class BettingService:
     def place_bet(user, race, horse, amount, bet_type='win'):
         """Разместить ставку"""
         try:
-            user_profile = user.betting_profile
-            
-            # Проверяем достаточно ли средств
-            if amount > user_profile.balance:
-                return False, "Недостаточно средств"
-            
-            if amount < 10:
-                return False, "Минимальная сумма ставки - 10 ₽"
-            
-            # Создаем ставку
-            bet = Bet.objects.create(
-                user=user,
-                race=race,
-                horse=horse,
-                bet_type=bet_type,
-                amount=amount,
-                odds=horse.odds
-            )
-            
-            # Списываем средства
-            user_profile.balance -= amount
-            user_profile.save()
-            
+            place_bet(user, race.id, horse.id, amount, bet_type)
             return True, "Ставка успешно размещена"
-            
+        except BetError as e:
+            return False, str(e)
         except Exception as e:
             return False, f"Ошибка при размещении ставки: {str(e)}"
     
@@ -45,27 +27,13 @@ class BettingService:
     def settle_race(race, winner_horse):
         """Рассчитать результаты забега"""
         try:
-            race.winner = winner_horse
-            race.status = 'finished'
-            race.save()
-            
-            # Рассчитываем выигрыши
-            winning_bets = Bet.objects.filter(
-                race=race, 
-                horse=winner_horse, 
-                is_settled=False
-            )
-            
-            for bet in winning_bets:
-                bet.is_winner = True
-                bet.is_settled = True
-                bet.settled_at = timezone.now()
-                bet.save()
+            with transaction.atomic():
+                record_results(race, [winner_horse])
+                race.status = 'finished'
+                race.save()
                 
-                # Начисляем выигрыш
-                user_profile = bet.user.betting_profile
-                user_profile.balance += bet.potential_win
-                user_profile.save()
+                # Рассчитываем выигрыши массовыми запросами
+                settle_race(race)
             
             return True, f"Забег завершен. Победитель: {winner_horse.name}"
             
@@ -73,37 +41,29 @@ class BettingService:
             return False, f"Ошибка при расчете забега: {str(e)}"
 
 class AnalyticsService:
+    """Только чтение истории - запросы идут на реплику, если она настроена"""
+
     @staticmethod
+    @use_replica
     def get_user_stats(user):
         """Получить статистику пользователя"""
-        user_bets = Bet.objects.filter(user=user)
-        
-        stats = {
-            'total_bets': user_bets.count(),
-            'active_bets': user_bets.filter(is_settled=False).count(),
-            'won_bets': user_bets.filter(is_winner=True).count(),
-            'lost_bets': user_bets.filter(is_settled=True, is_winner=False).count(),
-            'total_wagered': user_bets.aggregate(Sum('amount'))['amount__sum'] or 0,
-            'total_won': user_bets.filter(is_winner=True).aggregate(Sum('potential_win'))['potential_win__sum'] or 0,
-        }
-        
-        stats['net_profit'] = stats['total_won'] - stats['total_wagered']
-        stats['win_rate'] = (stats['won_bets'] / stats['total_bets'] * 100) if stats['total_bets'] > 0 else 0
-        
-        return stats
+        return get_user_stats(user).as_dict()
     
     @staticmethod
+    @use_replica
     def get_race_stats(race):
-        """Получить статистику по забегу"""
-        race_bets = Bet.objects.filter(race=race)
+        """Получить статистику по забегу (по пулам ставок, без обхода Bet)"""
+        race_pools = BettingPool.objects.filter(race=race)
+        totals = race_pools.aggregate(count=Sum('bet_count'), amount=Sum('stake'))
         
         stats = {
-            'total_bets': race_bets.count(),
-            'total_amount': race_bets.aggregate(Sum('amount'))['amount__sum'] or 0,
-            'bets_per_horse': race_bets.values('horse__name').annotate(
-                count=Count('id'),
-                total=Sum('amount')
-            ),
+            'total_bets': totals['count'] or 0,
+            'total_amount': totals['amount'] or 0,
+            # Список, а не ленивый QuerySet: запрос выполняется здесь, на реплике
+            'bets_per_horse': list(race_pools.values('horse__name').annotate(
+                count=Sum('bet_count'),
+                total=Sum('stake')
+            ).order_by('horse__name')),
         }
         
         return stats
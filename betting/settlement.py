@@ -0,0 +1,126 @@
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+from .ledger import post_many
+from .models import Bet, Race, RaceResult, Transaction
+from .notifications import queue_race_results
+from .stats import record_settlement
+
+
+def record_results(race, horses):
+    """
+    Записать порядок прихода: horses - лошади (или их id) в порядке
+    финиша, начиная с победителя. Прежние результаты заменяются,
+    победитель забега - первая лошадь. Вызывается до settle_race
+    """
+    horse_ids = [getattr(horse, 'pk', horse) for horse in horses]
+    with transaction.atomic():
+        RaceResult.objects.filter(race=race).delete()
+        RaceResult.objects.bulk_create([
+            RaceResult(race=race, horse_id=horse_id, position=position)
+            for position, horse_id in enumerate(horse_ids, start=1)
+        ])
+        race.winner_id = horse_ids[0] if horse_ids else None
+
+
+def winning_bets(race):
+    """
+    Условие выигрыша ставок забега по порядку прихода: лошадь ставки
+    финишировала не ниже места Bet.PAYOUT_POSITIONS для ее типа.
+    Без записанных результатов первое место - победитель забега
+    """
+    positions = dict(RaceResult.objects.filter(race=race).values_list('horse_id', 'position'))
+    if not positions and race.winner_id:
+        positions = {race.winner_id: 1}
+
+    won = Q()
+    for bet_type, limit in Bet.PAYOUT_POSITIONS.items():
+        horse_ids = [horse_id for horse_id, position in positions.items() if position <= limit]
+        if horse_ids:
+            won |= Q(bet_type=bet_type, horse_id__in=horse_ids)
+    # Без результатов условие превращается в horse_id IS NULL - все проиграли
+    return won or Q(horse_id=None)
+
+
+def settle_race(race, bet_ids=None):
+    """
+    Рассчитать все нерассчитанные ставки забега (или только bet_ids)
+    на победу, место и показ по порядку прихода (winning_bets).
+
+    Вместо обхода ставок по одной выполняет постоянное число
+    массовых запросов в одной транзакции:
+      0. блокировка строки забега (SELECT ... FOR UPDATE) с проверкой
+         статуса и чтение порядка прихода. Параллельный расчет того же
+         забега ждет фиксации транзакции и затем не находит
+         нерассчитанных ставок: ставки читаются только под блокировкой;
+      1. один сгруппированный по (пользователь, тип ставки) запрос:
+         выигравшие и проигравшие ставки и сумма выигрыша - для
+         статистики пользователей (UPDATE ... CASE строк статистики)
+         и для выплат;
+      2. запись выигрышей в журнал (ledger.post_many), по операции на
+         пользователя и тип ставки: UPDATE ... CASE, начисляющее каждому
+         пользователю сумму выигрышей (одно на пачку пользователей),
+         чтение новых балансов и bulk_create операций;
+      3. одно UPDATE выигравших ставок;
+      4. одно UPDATE проигравших ставок.
+
+    В той же транзакции забег ставится в очередь рассылки: каждому
+    сделавшему ставки пользователю уйдет сводное сообщение
+    с результатами (см. notifications.fan_out_queued_races).
+
+    Возвращает словарь с количеством выигравших/проигравших ставок
+    и общей суммой выплат.
+    """
+    result = {'won': 0, 'lost': 0, 'paid': 0}
+    if race.status != 'finished':
+        return result
+
+    now = timezone.now()
+    with transaction.atomic():
+        locked = Race.objects.select_for_update().filter(pk=race.pk, status='finished')
+        if not locked.values_list('pk', flat=True).first():
+            return result
+        pending = Bet.objects.filter(race=race, is_settled=False)
+        if bet_ids is not None:
+            pending = pending.filter(id__in=list(bet_ids))
+        won = winning_bets(race)
+
+        rows = list(
+            pending.values('user_id', 'bet_type').annotate(
+                won=Count('id', filter=won),
+                lost=Count('id', filter=~won),
+                won_amount=Sum('potential_win', filter=won),
+            ).order_by('user_id', 'bet_type')
+        )
+        record_settlement(rows)
+
+        payouts = [row for row in rows if row['won']]
+        if payouts:
+            # Начисление выигрышей с записью в журнал
+            bet_types = dict(Bet.BET_TYPES)
+            post_many(
+                [
+                    Transaction(
+                        user_id=row['user_id'],
+                        transaction_type='win',
+                        amount=row['won_amount'],
+                        description=f'Выигрыш ({bet_types.get(row["bet_type"], row["bet_type"]).lower()}) - {race.name}'[:200],
+                    )
+                    for row in payouts
+                ],
+                now,
+            )
+            result['won'] = pending.filter(won).update(
+                is_winner=True, is_settled=True, settled_at=now
+            )
+            result['paid'] = sum(row['won_amount'] for row in payouts)
+
+        # Все оставшиеся ставки проиграли
+        result['lost'] = pending.update(
+            is_winner=False, is_settled=True, settled_at=now
+        )
+
+        if result['won'] or result['lost']:
+            queue_race_results(race, now)
+
+    return result
@@ -40,9 +40,49 @@ function initializePlaceBetRace() {
     if (betForm) {
         setupHorseSelection();
         setupAmountInput();
+        if (betForm.dataset.raceId && window.EventSource) {
+            subscribeRaceEvents(betForm.dataset.raceId);
+        }
     }
 }
 
+function subscribeRaceEvents(raceId) {
+    // Живые коэффициенты и статус забега (Server-Sent Events)
+    const source = new EventSource(`/api/races/events/?race=${raceId}`);
+
+    source.addEventListener('odds', function(e) {
+        const data = JSON.parse(e.data);
+        const radio = document.getElementById(`horse_${data.horse_id}`);
+        if (!radio || radio.dataset.odds === String(data.odds)) {
+            return;
+        }
+        radio.dataset.odds = data.odds;
+        const oddsElement = document.querySelector(`label[for="horse_${data.horse_id}"] .horse-odds`);
+        if (oddsElement) {
+            oddsElement.textContent = data.odds;
+        }
+        updatePotentialWin();
+    });
+
+    source.addEventListener('status', function(e) {
+        const data = JSON.parse(e.data);
+        if (data.status !== 'scheduled') {
+            const submitButton = document.querySelector('.bet-form button[type="submit"]');
+            if (submitButton) {
+                submitButton.disabled = true;
+            }
+            showMessage('Прием ставок на этот забег закрыт', 'info');
+        }
+    });
+
+    source.addEventListener('winner', function(e) {
+        const data = JSON.parse(e.data);
+        const label = document.querySelector(`label[for="horse_${data.horse_id}"] .horse-name`);
+        showMessage(`Забег завершен. Победитель: ${label ? label.textContent : data.horse_id}`, 'info');
+        source.close();
+    });
+}
+
 function setupHorseSelection() {
     const horseRadios = document.querySelectorAll('input[name="horse_id"]');
     const amountInput = document.getElementById('amount');
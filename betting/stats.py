@@ -0,0 +1,164 @@
+from collections import defaultdict
+from decimal import Decimal
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+from .models import Bet, UserStats
+from .utils import bulk_increment
+
+# Сколько пользователей обрабатывается одним запросом
+STATS_BATCH_SIZE = 500
+BET_TYPE_CODES = {code for code, _ in Bet.BET_TYPES}
+STATS_FIELDS = [
+    'total_bets', 'active_bets', 'won_bets', 'lost_bets', 'total_wagered', 'total_won',
+    'win_bets', 'win_won', 'place_bets', 'place_won', 'show_bets', 'show_won',
+]
+
+
+def _empty_stats():
+    stats = {field: 0 for field in STATS_FIELDS}
+    stats['total_wagered'] = Decimal('0')
+    stats['total_won'] = Decimal('0')
+    return stats
+
+
+def rebuild_user_stats(user_ids):
+    """
+    Пересчитать статистику пользователей по таблице ставок.
+    Один сгруппированный запрос на всю пачку пользователей и
+    один upsert строк статистики. Возвращенные ставки отмененных
+    забегов не учитываются (см. record_refunds).
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return 0
+
+    stats = {user_id: _empty_stats() for user_id in user_ids}
+    bets = Bet.objects.filter(user_id__in=user_ids).exclude(race__status='cancelled', is_settled=True)
+    rows = bets.values('user_id', 'bet_type').annotate(
+        total=Count('id'),
+        active=Count('id', filter=Q(is_settled=False)),
+        won=Count('id', filter=Q(is_winner=True)),
+        lost=Count('id', filter=Q(is_settled=True, is_winner=False)),
+        wagered=Sum('amount'),
+        won_amount=Sum('potential_win', filter=Q(is_winner=True)),
+    ).order_by()
+
+    for row in rows:
+        user_stats = stats[row['user_id']]
+        user_stats['total_bets'] += row['total']
+        user_stats['active_bets'] += row['active']
+        user_stats['won_bets'] += row['won']
+        user_stats['lost_bets'] += row['lost']
+        user_stats['total_wagered'] += row['wagered'] or 0
+        user_stats['total_won'] += row['won_amount'] or 0
+        if row['bet_type'] in BET_TYPE_CODES:
+            user_stats[f"{row['bet_type']}_bets"] += row['total']
+            user_stats[f"{row['bet_type']}_won"] += row['won']
+
+    UserStats.objects.bulk_create(
+        [UserStats(user_id=user_id, **values) for user_id, values in stats.items()],
+        update_conflicts=True,
+        unique_fields=['user'],
+        update_fields=STATS_FIELDS + ['updated_at'],
+    )
+    return len(stats)
+
+
+def ensure_user_stats(user_ids):
+    """Создать недостающие строки статистики, собрав их по истории ставок"""
+    user_ids = list(set(user_ids))
+    for start in range(0, len(user_ids), STATS_BATCH_SIZE):
+        chunk = user_ids[start:start + STATS_BATCH_SIZE]
+        existing = set(UserStats.objects.filter(user_id__in=chunk).values_list('user_id', flat=True))
+        rebuild_user_stats(set(chunk) - existing)
+
+
+def get_user_stats(user):
+    """Статистика пользователя одним запросом (строка создается при первом обращении)"""
+    stats = UserStats.objects.filter(user=user).first()
+    if stats is None:
+        rebuild_user_stats([user.pk])
+        stats = UserStats.objects.get(user=user)
+    return stats
+
+
+def record_bet(bet):
+    """Учесть новую ставку. Вызывается в транзакции размещения ставки"""
+    updates = {
+        'total_bets': F('total_bets') + 1,
+        'active_bets': F('active_bets') + 1,
+        'total_wagered': F('total_wagered') + bet.amount,
+        'updated_at': timezone.now(),
+    }
+    if bet.bet_type in BET_TYPE_CODES:
+        field = f'{bet.bet_type}_bets'
+        updates[field] = F(field) + 1
+
+    if not UserStats.objects.filter(user_id=bet.user_id).update(**updates):
+        # Строки еще нет - собираем ее по истории, включая новую ставку
+        rebuild_user_stats([bet.user_id])
+
+
+def record_bets(bets):
+    """Учесть пачку новых ставок: проверка строк и один UPDATE ... CASE"""
+    deltas = defaultdict(lambda: defaultdict(int))
+    for bet in bets:
+        user_deltas = deltas[bet.user_id]
+        user_deltas['total_bets'] += 1
+        user_deltas['active_bets'] += 1
+        user_deltas['total_wagered'] += bet.amount
+        if bet.bet_type in BET_TYPE_CODES:
+            user_deltas[f'{bet.bet_type}_bets'] += 1
+
+    # Недостающие строки собираются по истории, куда уже входят новые ставки
+    existing = set(UserStats.objects.filter(user_id__in=list(deltas)).values_list('user_id', flat=True))
+    missing = set(deltas) - existing
+    rebuild_user_stats(missing)
+    return bulk_increment(
+        UserStats, 'user_id',
+        {user_id: values for user_id, values in deltas.items() if user_id not in missing},
+        updated_at=timezone.now(),
+    )
+
+
+def record_settlement(rows):
+    """
+    Учесть расчет ставок. rows - сгруппированные по (user_id, bet_type)
+    словари с полями won, lost и won_amount. Вызывается до того, как
+    ставки помечены рассчитанными, в той же транзакции.
+    """
+    rows = list(rows)
+    ensure_user_stats(row['user_id'] for row in rows)
+
+    deltas = defaultdict(lambda: defaultdict(int))
+    for row in rows:
+        user_deltas = deltas[row['user_id']]
+        user_deltas['won_bets'] += row['won']
+        user_deltas['lost_bets'] += row['lost']
+        user_deltas['active_bets'] -= row['won'] + row['lost']
+        user_deltas['total_won'] += row['won_amount'] or 0
+        if row['bet_type'] in BET_TYPE_CODES:
+            user_deltas[f"{row['bet_type']}_won"] += row['won']
+
+    return bulk_increment(UserStats, 'user_id', deltas, updated_at=timezone.now())
+
+
+def record_refunds(rows):
+    """
+    Учесть возврат ставок отмененного забега: ставки вычитаются из
+    статистики, как будто их не было - возврат не проигрыш. rows -
+    сгруппированные по (user_id, bet_type) словари с полями bets и
+    amount. Строки статистики должны быть созданы до захвата ставок
+    (ensure_user_stats): пересчет по истории возвращенные ставки уже
+    не учитывает.
+    """
+    deltas = defaultdict(lambda: defaultdict(int))
+    for row in rows:
+        user_deltas = deltas[row['user_id']]
+        user_deltas['total_bets'] -= row['bets']
+        user_deltas['active_bets'] -= row['bets']
+        user_deltas['total_wagered'] -= row['amount']
+        if row['bet_type'] in BET_TYPE_CODES:
+            user_deltas[f"{row['bet_type']}_bets"] -= row['bets']
+
+    return bulk_increment(UserStats, 'user_id', deltas, updated_at=timezone.now())
@@ -1,44 +1,67 @@
+from django.db import transaction
 from django.utils import timezone
 from datetime import timedelta
 import random
 from .models import Race, Horse
+from .settlement import record_results, settle_race
 
-def auto_settle_races():
+# Забег длится 2 минуты
+RACE_DURATION = timedelta(minutes=2)
+
+def races_due_for_settlement(now=None):
     """
-    Автоматический расчет завершенных забегов
+    Забеги, которые ДОЛЖНЫ БЫЛИ завершиться и еще не рассчитаны
     """
-    # Находим забеги, которые ДОЛЖНЫ БЫЛИ начаться и еще не завершены
-    races_to_settle = Race.objects.filter(
+    now = now or timezone.now()
+    return Race.objects.filter(
         status='scheduled',
-        start_time__lte=timezone.now()  # ← Ищем забеги, которые уже должны были начаться
+        start_time__lte=now - RACE_DURATION
     )
-    
+
+def finish_race(race):
+    """
+    Завершить забег: определить порядок прихода и рассчитать ставки.
+    Если в забеге нет лошадей, забег отменяется.
+    Возвращает победителя или None.
+    """
+    horses_list = list(Horse.objects.filter(race=race))
+
+    with transaction.atomic():
+        if not horses_list:
+            race.status = 'cancelled'
+            race.save()
+            return None
+
+        # Порядок прихода: лошади с меньшим коэффициентом чаще впереди
+        finish_order = []
+        remaining = list(horses_list)
+        while remaining:
+            weights = [1.0 / float(horse.odds) for horse in remaining]
+            horse = random.choices(remaining, weights=weights, k=1)[0]
+            finish_order.append(horse)
+            remaining.remove(horse)
+        winner = finish_order[0]
+
+        record_results(race, finish_order)
+        race.status = 'finished'
+        race.save()
+
+        # Рассчитываем выигрыши
+        settle_race(race)
+
+    return winner
+
+def auto_settle_races():
+    """
+    Автоматический расчет завершенных забегов
+    """
     results = []
-    
-    for race in races_to_settle:
-        # Проверяем, прошло ли достаточно времени с начала забега
-        time_since_start = timezone.now() - race.start_time
-        if time_since_start >= timedelta(minutes=2):  # Забег длится 2 минуты
-            # Автоматически выбираем победителя
-            horses_in_race = Horse.objects.filter(race=race)
-            if horses_in_race.exists():
-                # Более реалистичный выбор победителя
-                horses_list = list(horses_in_race)
-                weights = [1.0 / float(horse.odds) for horse in horses_list]
-                
-                winner = random.choices(horses_list, weights=weights, k=1)[0]
-                race.winner = winner
-                race.status = 'finished'
-                race.save()
-                
-                # Рассчитываем выигрыши
-                race.settle_bets()
-                
-                results.append(f'Забег "{race.name}" завершен. Победитель: {winner.name}')
-            else:
-                # Если нет лошадей, отменяем забег
-                race.status = 'cancelled'
-                race.save()
-                results.append(f'Забег "{race.name}" отменен (нет лошадей)')
-    
-    return results
\ No newline at end of file
+
+    for race in races_due_for_settlement():
+        winner = finish_race(race)
+        if winner:
+            results.append(f'Забег "{race.name}" завершен. Победитель: {winner.name}')
+        else:
+            results.append(f'Забег "{race.name}" отменен (нет лошадей)')
+
+    return results
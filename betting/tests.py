@@ -1,3 +1,1514 @@
-from django.test import TestCase
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipIf, skipUnless
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.db import connection, connections
+from django.db.models import F, Sum
+from django.core import mail
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.core.mail.backends.locmem import EmailBackend as LocMemEmailBackend
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from ippodrom.databases import database_from_env
+from . import feeds, ledger, live, placement, replicas, scheduler
+from .caching import cache_stats
+from .cancellation import cancel_races
+from .feedparse import iter_json_races, iter_races
+from .feeds import ERROR, NOT_MODIFIED, OK, FeedBody, FeedFetcher, FeedSource
+from .feedserver import FeedServer
+from .ingest import ingest_races, ingest_stream
+from .models import Race, Horse, Bet, BalanceCheckpoint, BetSlip, Notification, Transaction, UserProfile, UserStats
+from .notifications import claim_batch, drain_outbox, fan_out_queued_races, fan_out_race_results
+from .parsers import RaceDataParser
+from .placement import BetError, place_bet, place_bet_slip
+from .reconcile import reconcile_range
+from .replicas import replica_reads
+from .scheduler import SETTLE, SYNC, RaceScheduler
+from .pools import rebuild_pools, recompute_odds, tote_odds
+from .services import AnalyticsService
+from .settlement import record_results, settle_race
+from .stats import STATS_FIELDS, get_user_stats, rebuild_user_stats
+from .tasks import RACE_DURATION, races_due_for_settlement
+from .tokens import create_token
 
-# Create your tests here.
+
+def seed_betting_data(users=3, races=4, horses=6, bets_per_user=40, prefix='player'):
+    """Заполнить базу пользователями, забегами, ставками и транзакциями"""
+    now = timezone.now()
+    user_list = []
+    for i in range(users):
+        User.objects.create_user(f'{prefix}{i}', password='password')
+        user_list.append(User.objects.get(username=f'{prefix}{i}'))
+
+    race_list = []
+    for i in range(races):
+        status = 'finished' if i % 2 else 'scheduled'
+        race = Race.objects.create(
+            name=f'Забег {prefix} {i}', status=status,
+            start_time=now + timedelta(hours=i - races // 2),
+        )
+        Horse.objects.bulk_create([
+            Horse(race=race, name=f'Лошадь {i}-{j}', odds=Decimal('2.00') + j)
+            for j in range(horses)
+        ])
+        race_list.append(race)
+
+    bets = []
+    transactions = []
+    for user in user_list:
+        for i in range(bets_per_user):
+            race = race_list[i % races]
+            horse = race.horses.all()[i % horses]
+            bets.append(Bet(
+                user=user, race=race, horse=horse, amount=Decimal('10'),
+                odds=horse.odds, potential_win=Decimal('10') * horse.odds,
+                is_settled=race.status == 'finished',
+            ))
+            transactions.append(Transaction(user=user, transaction_type='bet', amount=Decimal('10')))
+    Bet.objects.bulk_create(bets)
+    Transaction.objects.bulk_create(transactions)
+    rebuild_pools(race.id for race in race_list)
+    rebuild_user_stats(user.id for user in user_list)
+    return user_list, race_list
+
+
+# Проверки запросов идут без кэша страниц и фрагментов, иначе
+# попадание в кэш скрыло бы запросы отрисовки
+NO_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN доступен только в SQLite')
+@override_settings(CACHES=NO_CACHE)
+class QueryPlanTests(TestCase):
+    """
+    Горячие запросы представлений и сервисов не должны читать таблицы
+    приложения полным сканированием: каждый запрос прогоняется через
+    EXPLAIN QUERY PLAN и проверяется на строки вида "SCAN betting_*".
+    """
+
+    FULL_SCAN = re.compile(r'\bSCAN (betting_\w+)(?! USING (?:COVERING )?INDEX)')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users, cls.races = seed_betting_data()
+
+    def setUp(self):
+        self.user = self.users[0]
+        self.client.force_login(self.user)
+
+    def full_scans(self, queries):
+        scans = []
+        with connection.cursor() as cursor:
+            for query in queries:
+                sql = query['sql']
+                if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                    continue
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                for row in cursor.fetchall():
+                    match = self.FULL_SCAN.search(row[-1])
+                    if match:
+                        scans.append(f'{match.group(1)}: {sql}')
+        return scans
+
+    def assertNoFullScans(self, func, *args, **kwargs):
+        with CaptureQueriesContext(connection) as captured:
+            func(*args, **kwargs)
+        scans = self.full_scans(captured.captured_queries)
+        self.assertFalse(scans, 'Полное сканирование таблиц:\n' + '\n'.join(scans))
+
+    def test_views(self):
+        for name in ['home', 'place_bet', 'bet_history', 'transaction_history', 'user_stats', 'user_profile']:
+            with self.subTest(view=name):
+                self.assertNoFullScans(self.client.get, reverse(f'betting:{name}'))
+
+    def test_history_next_page(self):
+        for name in ['bet_history', 'transaction_history']:
+            first = self.client.get(reverse(f'betting:{name}'))
+            page = first.context['bets' if name == 'bet_history' else 'transactions']
+            with self.subTest(view=name):
+                self.assertNoFullScans(
+                    self.client.get, reverse(f'betting:{name}'), {'before': page.older_cursor}
+                )
+
+    def test_place_bet_race(self):
+        race = self.races[0]
+        horse = race.horses.first()
+        url = reverse('betting:place_bet_race', args=[race.id])
+        self.assertNoFullScans(self.client.get, url)
+        self.assertNoFullScans(self.client.post, url, {'horse_id': horse.id, 'amount': '10', 'bet_type': 'win'})
+
+    def test_services(self):
+        race = self.races[0]
+        self.assertNoFullScans(lambda: list(races_due_for_settlement()))
+        self.assertNoFullScans(AnalyticsService.get_user_stats, self.user)
+        self.assertNoFullScans(lambda: list(AnalyticsService.get_race_stats(race)['bets_per_horse']))
+        self.assertNoFullScans(recompute_odds)
+
+    def test_settlement(self):
+        race = self.races[0]
+        race.winner = race.horses.first()
+        race.status = 'finished'
+        race.save()
+        self.assertNoFullScans(settle_race, race)
+
+
+class QueryBudgetMixin:
+    """
+    Проверка бюджета запросов: представление должно укладываться в
+    фиксированное число запросов, не зависящее от количества забегов,
+    лошадей и ставок. grow - функция, добавляющая данные между двумя
+    замерами; если число запросов после нее выросло, это N+1.
+    """
+
+    def count_queries(self, func, *args, **kwargs):
+        with CaptureQueriesContext(connection) as captured:
+            func(*args, **kwargs)
+        return captured.captured_queries
+
+    def assertQueryBudget(self, budget, func, *args, grow=None, **kwargs):
+        queries = self.count_queries(func, *args, **kwargs)
+        if grow is not None:
+            grow()
+            grown = self.count_queries(func, *args, **kwargs)
+            self.assertEqual(
+                len(queries), len(grown),
+                'Число запросов растет вместе с данными:\n' + '\n'.join(q['sql'] for q in grown),
+            )
+        self.assertLessEqual(
+            len(queries), budget,
+            f'Превышен бюджет в {budget} запросов:\n' + '\n'.join(q['sql'] for q in queries),
+        )
+
+
+@override_settings(CACHES=NO_CACHE)
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users, cls.races = seed_betting_data(users=1, races=3, horses=3, bets_per_user=3)
+
+    def setUp(self):
+        self.user = self.users[0]
+        self.client.force_login(self.user)
+        self.grown = 0
+
+    def grow(self):
+        """Добавить забеги, лошадей и ставки текущему пользователю"""
+        self.grown += 1
+        users, _ = seed_betting_data(
+            users=1, races=6, horses=8, bets_per_user=20, prefix=f'grown{self.grown}-'
+        )
+        Bet.objects.filter(user=users[0]).update(user=self.user)
+        Transaction.objects.filter(user=users[0]).update(user=self.user)
+
+    def test_view_budgets(self):
+        budgets = {
+            'home': 8,
+            'place_bet': 6,
+            'bet_history': 6,
+            'transaction_history': 6,
+            'user_stats': 5,
+            'user_profile': 5,
+        }
+        for name, budget in budgets.items():
+            with self.subTest(view=name):
+                self.assertQueryBudget(budget, self.client.get, reverse(f'betting:{name}'), grow=self.grow)
+
+    def test_anonymous_home_budget(self):
+        self.client.logout()
+        self.assertQueryBudget(3, self.client.get, reverse('betting:home'), grow=self.grow)
+
+    def test_place_bet_race_budget(self):
+        race = self.races[0]
+        self.assertQueryBudget(
+            5, self.client.get, reverse('betting:place_bet_race', args=[race.id]), grow=self.grow
+        )
+
+
+class RaceCacheTests(QueryBudgetMixin, TestCase):
+    """Кэш анонимных страниц и фрагментов с забегами"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users, cls.races = seed_betting_data(users=1, races=3, horses=3, bets_per_user=3)
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_anonymous_home_served_from_cache(self):
+        url = reverse('betting:home')
+        first = self.client.get(url)
+        self.assertQueryBudget(0, self.client.get, url)
+        self.assertEqual(self.client.get(url).content, first.content)
+        self.assertEqual(cache_stats()['home'], {'hits': 2, 'misses': 1})
+
+    def test_model_changes_invalidate(self):
+        url = reverse('betting:home')
+        # Единственный забег сида, который еще не начался
+        race = self.races[2]
+        horse = race.horses.first()
+        self.client.get(url)
+
+        horse.odds = Decimal('42.00')
+        with self.captureOnCommitCallbacks(execute=True):
+            horse.save()
+        self.assertContains(self.client.get(url), '42.00')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            race.delete()
+        self.assertNotContains(self.client.get(url), race.name)
+        self.assertEqual(cache_stats()['home'], {'hits': 0, 'misses': 3})
+
+    def test_fragments_shared_by_users(self):
+        self.client.force_login(self.users[0])
+        self.client.get(reverse('betting:home'))
+        self.client.get(reverse('betting:place_bet'))
+        with self.captureOnCommitCallbacks(execute=True):
+            user = User.objects.create_user('second', password='password')
+        self.client.force_login(user)
+
+        # Страница не кэшируется целиком: баланс и статистика персональные
+        response = self.client.get(reverse('betting:home'))
+        self.assertContains(response, 'Привет, second')
+        self.client.get(reverse('betting:place_bet'))
+        stats = cache_stats()
+        self.assertEqual(stats['home'], {'hits': 0, 'misses': 0})
+        self.assertEqual(stats['upcoming_races'], {'hits': 1, 'misses': 1})
+        self.assertEqual(stats['race_cards'], {'hits': 1, 'misses': 1})
+
+    def test_change_in_another_process_invalidates(self):
+        url = reverse('betting:home')
+        self.client.get(url)
+        self.client.get(url)
+        # race_daemon меняет забег в своем процессе со своим локальным кэшем
+        subprocess.run(
+            [sys.executable, '-c', 'import django; django.setup(); '
+             'from betting.caching import _bump_races_version; _bump_races_version()'],
+            cwd=settings.BASE_DIR, env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'ippodrom.settings'}, check=True,
+        )
+        self.client.get(url)
+        self.assertEqual(cache_stats()['home'], {'hits': 1, 'misses': 2})
+
+
+class RaceEventsTests(TestCase):
+    """Общая лента изменений забегов и поток SSE"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users, cls.races = seed_betting_data(users=1, races=4, horses=3, bets_per_user=3)
+
+    def setUp(self):
+        # Опрашиваем вручную, фоновая задача только заполняет снимок
+        self.hub = live.RaceEventHub(interval=3600)
+        patcher = mock.patch.object(live, 'hub', self.hub)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        if self.hub.task:
+            self.hub.task.cancel()
+
+    async def test_fan_out(self):
+        race, other = self.races[0], self.races[2]
+        everyone = [await self.hub.subscribe() for _ in range(100)]
+        filtered = await self.hub.subscribe([race.id])
+        self.assertEqual({event['race_id'] for event in filtered.initial}, {race.id})
+
+        horse = await race.horses.afirst()
+        await Horse.objects.filter(pk=horse.pk).aupdate(odds=Decimal('9.99'), odds_version=F('odds_version') + 1)
+        await Race.objects.filter(pk=other.pk).aupdate(status='in_progress')
+        # Один опрос на всех подписчиков
+        await self.hub.poll()
+        for subscription in everyone:
+            self.assertEqual(subscription.queue.qsize(), 2)
+        event = filtered.queue.get_nowait()
+        self.assertEqual(
+            (event['event'], event['horse_id'], event['odds'], event['odds_version']),
+            ('odds', horse.id, Decimal('9.99'), 1),
+        )
+        self.assertTrue(filtered.queue.empty())
+
+        await Race.objects.filter(pk=other.pk).aupdate(status='finished', winner_id=horse.id)
+        await self.hub.poll()
+        events = [everyone[0].queue.get_nowait() for _ in range(everyone[0].queue.qsize())]
+        self.assertEqual([event['event'] for event in events][-2:], ['status', 'winner'])
+        self.assertNotIn(other.id, self.hub.races)
+
+    async def test_lagging_subscriber_is_dropped(self):
+        subscription = await self.hub.subscribe()
+        self.hub.publish([self.hub._event('status', self.races[0].id, status='scheduled')] * (live.SUBSCRIBER_QUEUE_SIZE + 1))
+        self.assertTrue(subscription.lagged)
+        self.assertNotIn(subscription, self.hub.subscribers)
+
+    async def test_stream(self):
+        race = self.races[0]
+        response = await self.async_client.get(reverse('betting:api_race_events'), {'race': race.id})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await anext(stream), b'retry: 3000\n\n')
+        chunks = [await anext(stream) for _ in range(4)]
+        self.assertTrue(chunks[0].startswith(b'id: '))
+        self.assertIn(b'event: status', chunks[0])
+        self.assertEqual(sum(b'event: odds' in chunk for chunk in chunks), 3)
+        await stream.aclose()
+
+    def test_stream_requires_asgi(self):
+        response = self.client.get(reverse('betting:api_race_events'))
+        self.assertEqual(response.status_code, 501)
+        self.assertFalse(response.streaming)
+        self.assertFalse(self.hub.subscribers)
+
+
+class ToteOddsTests(TestCase):
+    """Коэффициенты тотализатора по пулам ставок"""
+
+    def test_tote_odds(self):
+        # Забег 0: пул 1000 на двух лошадях; забег 1 - ставки только на
+        # одну из двух, без порогов ее цена падает до минимальной
+        odds = tote_odds([0, 0, 1, 1], [800, 200, 500, 0], takeout=0.2)
+        self.assertEqual(odds[:3].tolist(), [1.01, 4.0, 1.01])
+        self.assertTrue(np.isnan(odds[3]))
+
+        # Порог пула и доли лошадей со ставками
+        odds = tote_odds([0, 0, 1, 1], [600, 400, 50, 50], takeout=0, min_pool=500, min_coverage=1.0)
+        self.assertEqual(odds[:2].tolist(), [1.67, 2.5])
+        self.assertTrue(np.isnan(odds[2:]).all())
+        odds = tote_odds([0, 0, 0], [100, 100, 0], takeout=0, min_coverage=0.5)
+        self.assertEqual(odds[:2].tolist(), [2.0, 2.0])
+        self.assertTrue(np.isnan(odds[2]))
+
+    @override_settings(BETTING_TAKEOUT=0.1, BETTING_TOTE_MIN_POOL=1000, BETTING_TOTE_MIN_COVERAGE=1.0)
+    def test_recompute_odds_publishes_liquid_pools_only(self):
+        user = User.objects.create_user('tote', password='password')
+        ledger.post(user.pk, 'deposit', Decimal('5000'))
+        race = Race.objects.create(name='Тотализатор', start_time=timezone.now() + timedelta(hours=1))
+        horses = [Horse.objects.create(race=race, name=f'Лошадь {i}', odds=Decimal('3.00')) for i in range(2)]
+
+        place_bet(user, race.id, horses[0].id, '900')
+        self.assertEqual(recompute_odds(), 0)
+        self.assertEqual(list(Horse.objects.filter(race=race).values_list('tote_odds', flat=True)), [None, None])
+
+        place_bet(user, race.id, horses[1].id, '300')
+        place_bet(user, race.id, horses[1].id, '100', 'place')
+        self.assertEqual(recompute_odds(), 2)
+        self.assertEqual(
+            list(Horse.objects.filter(race=race).order_by('name').values_list('odds', 'odds_version', 'tote_odds')),
+            [(Decimal('3.00'), 0, Decimal('1.20')), (Decimal('3.00'), 0, Decimal('3.60'))],
+        )
+        self.assertEqual(recompute_odds(), 0)
+
+        # Пул пересобран без ставок - цены снимаются
+        Bet.objects.filter(race=race).delete()
+        rebuild_pools([race.id])
+        self.assertEqual(recompute_odds(), 2)
+        self.assertFalse(Horse.objects.filter(tote_odds__isnull=False).exists())
+
+
+class RaceSchedulerTests(TestCase):
+    """Очередь событий планировщика забегов"""
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.scheduler = RaceScheduler(log=lambda message: None)
+        self.races = []
+        for i, minutes in enumerate([-10, -5, 30]):
+            race = Race.objects.create(name=f'Очередь {i}', start_time=self.now + timedelta(minutes=minutes))
+            Horse.objects.create(race=race, name=f'Лошадь {i}', odds=Decimal('2.00'))
+            self.races.append(race)
+
+    def events(self):
+        return sorted(self.scheduler.heap)
+
+    def test_due_races_are_settled_in_deadline_order(self):
+        self.scheduler.reload(self.now)
+        self.assertEqual(
+            [(when, kind, race_id) for when, kind, race_id in self.events() if kind == SETTLE],
+            [(race.start_time + RACE_DURATION, SETTLE, race.id) for race in self.races],
+        )
+
+        next_at = self.scheduler.run_pending(self.now)
+        self.assertEqual(
+            list(Race.objects.order_by('name').values_list('status', flat=True)),
+            ['finished', 'finished', 'scheduled'],
+        )
+        self.assertEqual(next_at, self.now + self.scheduler.odds_interval)
+        self.assertEqual(self.scheduler.heap[0][0], next_at)
+
+    def test_moved_start_time_requeues_race(self):
+        self.scheduler.reload(self.now)
+        later = self.now + timedelta(hours=1)
+        Race.objects.filter(pk=self.races[0].pk).update(start_time=later)
+        self.scheduler.run_pending(self.now)
+        self.assertEqual(Race.objects.get(pk=self.races[0].pk).status, 'scheduled')
+        self.assertIn((later + RACE_DURATION, SETTLE, self.races[0].id), self.scheduler.heap)
+
+    def test_feed_sync_runs_while_races_are_scheduled(self):
+        self.scheduler.reload(self.now)
+        counts = {'races': 0, 'horses': 0, 'skipped': 3, 'odds_updated': 2, 'cancelled': 0}
+        with mock.patch.object(feeds, 'configured_sources', return_value=[FeedSource('лента', 'http://feed')]), \
+                mock.patch.object(RaceDataParser, 'update_races_from_real_sources', return_value=counts) as update:
+            # Запланированные забеги есть: обновление расписания пропускается
+            self.scheduler.refresh_feed()
+            self.assertEqual(update.call_count, 0)
+
+            sync_at = self.now + self.scheduler.sync_interval
+            self.scheduler.run_pending(sync_at)
+            self.assertEqual(update.call_count, 1)
+            self.assertIn((sync_at + self.scheduler.sync_interval, SYNC, None), self.scheduler.heap)
+            self.scheduler.run_pending(sync_at + self.scheduler.sync_interval)
+            self.assertEqual(update.call_count, 2)
+
+        # Без настроенных источников синхронизация ничего не делает
+        with mock.patch.object(RaceDataParser, 'update_races_from_real_sources') as update:
+            self.scheduler.sync_feed()
+        update.assert_not_called()
+
+    def test_failed_event_is_logged_and_retried_with_backoff(self):
+        self.scheduler.reload(self.now)
+        broken = self.races[0]
+        real_finish_race = scheduler.finish_race
+
+        def finish_race(race):
+            if race.pk == broken.pk:
+                raise RuntimeError('сбой расчета')
+            return real_finish_race(race)
+
+        with mock.patch.object(scheduler, 'finish_race', side_effect=finish_race):
+            with self.assertLogs('betting.scheduler', 'ERROR') as logs:
+                self.scheduler.run_pending(self.now)
+            self.assertIn('сбой расчета', logs.output[0])
+            # Остальные забеги рассчитаны, сломанный ждет повтора
+            self.assertEqual(Race.objects.get(pk=self.races[1].pk).status, 'finished')
+            self.assertIn((self.now + scheduler.RETRY_BASE, SETTLE, broken.id), self.scheduler.heap)
+
+            # Пауза удваивается и переживает перестроение очереди
+            retry_at = self.now + scheduler.RETRY_BASE
+            with self.assertLogs('betting.scheduler', 'ERROR'):
+                self.scheduler.run_pending(retry_at)
+            self.scheduler.reload(retry_at)
+            self.assertIn((retry_at + 2 * scheduler.RETRY_BASE, SETTLE, broken.id), self.scheduler.heap)
+
+        self.scheduler.run_pending(retry_at + 2 * scheduler.RETRY_BASE)
+        self.assertEqual(Race.objects.get(pk=broken.pk).status, 'finished')
+        self.assertEqual(self.scheduler.failures, {})
+
+
+class FeedFetcherTests(SimpleTestCase):
+    """Опрос источников на локальных серверах-заменителях"""
+
+    def start_server(self, **kwargs):
+        server = FeedServer(races=RaceDataParser._generate_realistic_data(), **kwargs)
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+
+    def make_fetcher(self, *servers, retries=2):
+        fetcher = FeedFetcher(
+            [FeedSource(f'source-{i}', server.url, timeout=2, retries=retries) for i, server in enumerate(servers)],
+            backoff=0.01,
+        )
+        self.addCleanup(fetcher.close)
+        return fetcher
+
+    def test_conditional_get(self):
+        server = self.start_server()
+        fetcher = self.make_fetcher(server)
+        source = fetcher.sources[0]
+
+        with fetcher.fetch(source) as body:
+            races = list(iter_races(body))
+        self.assertEqual(len(races), 6)
+        self.assertIsNone(fetcher.fetch(source))
+        self.assertEqual(fetcher.health[source.name].status, NOT_MODIFIED)
+
+        server.publish(RaceDataParser._generate_realistic_data()[:2])
+        with fetcher.fetch(source) as body:
+            self.assertEqual(len(list(iter_races(body))), 2)
+        self.assertEqual(fetcher.health[source.name].status, OK)
+
+    def test_bodies_are_streamed_one_source_at_a_time(self):
+        servers = [self.start_server(compress=True), self.start_server()]
+        fetcher = self.make_fetcher(*servers)
+
+        bodies = []
+        for source, body in fetcher.fetch_all():
+            # Сжатый ответ читается распакованным прямо из сокета
+            self.assertIsInstance(body, FeedBody)
+            self.assertEqual(len(list(iter_races(body))), 6)
+            self.assertTrue(all(previous.closed for previous in bodies))
+            bodies.append(body)
+        self.assertTrue(all(body.closed for body in bodies))
+        for server, health in zip(servers, fetcher.health.values()):
+            self.assertEqual(health.bytes, len(server.body))
+
+        # Потребитель остановился на первом источнике - второй ответ закрыт
+        for server in servers:
+            server.publish(RaceDataParser._generate_realistic_data())
+        results = fetcher.fetch_all()
+        _, first = next(results)
+        results.close()
+        self.assertTrue(first.closed)
+
+    @override_settings(BETTING_FEED_SOURCES=[])
+    def test_parser_streams_configured_sources(self):
+        server = self.start_server(compress=True)
+        fetcher = self.make_fetcher(server)
+        with mock.patch.object(feeds, 'configured_sources', return_value=fetcher.sources), \
+                mock.patch.object(feeds, 'get_fetcher', return_value=fetcher):
+            self.assertEqual(len(list(RaceDataParser.parse_races_from_api())), 6)
+
+    def test_failing_source_does_not_block_others(self):
+        healthy = self.start_server()
+        broken = self.start_server(fail_rate=1.0)
+        fetcher = self.make_fetcher(healthy, broken, retries=2)
+
+        results = dict((source.name, payload) for source, payload in fetcher.fetch_all())
+        self.assertIsNotNone(results['source-0'])
+        self.assertIsNone(results['source-1'])
+
+        health = fetcher.health['source-1']
+        self.assertEqual(health.status, ERROR)
+        self.assertEqual(health.requests, 3)
+        self.assertEqual(health.failures, 1)
+        self.assertEqual(broken.requests, 3)
+
+
+
+class FeedParseTests(TestCase):
+    """Потоковый разбор лент и пакетная запись"""
+
+    XML = """<?xml version="1.0" encoding="utf-8"?>
+        <races>
+          <race name="Кубок" start_time="2030-01-01T12:00:00+00:00">
+            <horse name="Буран" odds="2.50" color="Гнедой" jockey="Иванов А."/>
+            <horse><name>Молния</name><odds>4.10</odds></horse>
+          </race>
+          <race><name>Дерби</name><start_time>2030-01-01T15:00:00+00:00</start_time></race>
+          <race name="Без времени"/>
+        </races>""".encode()
+
+    def json_feed(self, count):
+        races = [
+            {'name': f'Забег {i}', 'start_time': f'2030-01-01T{i % 24:02d}:{i // 24 % 60:02d}:00+00:00',
+             'horses': [{'name': f'Лошадь {i}-{j}', 'odds': '3.25'} for j in range(3)]}
+            for i in range(count)
+        ]
+        return json.dumps({'source': 'archive', 'races': races}, ensure_ascii=False).encode()
+
+    def test_xml(self):
+        races = list(iter_races(io.BytesIO(self.XML)))
+        self.assertEqual([race['name'] for race in races], ['Кубок', 'Дерби'])
+        self.assertEqual(
+            [(horse['name'], horse['odds']) for horse in races[0]['horses']],
+            [('Буран', Decimal('2.50')), ('Молния', Decimal('4.10'))],
+        )
+
+    def test_json_across_chunk_boundaries(self):
+        body = self.json_feed(50)
+        # Блоки меньше одного забега: каждый объект дочитывается по частям
+        races = list(iter_json_races(io.BytesIO(body), chunk_size=7))
+        self.assertEqual(len(races), 50)
+        self.assertEqual(races[49]['horses'][2]['name'], 'Лошадь 49-2')
+        self.assertEqual(len(list(iter_races(io.BytesIO(b'[]')))), 0)
+        with self.assertRaises(ValueError):
+            list(iter_json_races(io.BytesIO(body[:-40])))
+
+    def test_invalid_races_are_skipped(self):
+        races = list(iter_races(io.BytesIO(json.dumps([
+            {'name': 'Забег', 'start_time': '2030-01-01T12:00:00+00:00', 'horses': [{'name': 'Буран', 'odds': '2.5'}]},
+            {'name': 'Без времени', 'start_time': 'завтра', 'horses': []},
+            {'name': 'Без коэффициента', 'start_time': '2030-01-01T12:00:00+00:00', 'horses': [{'name': 'Буран', 'odds': 'NaN'}]},
+            {'start_time': '2030-01-01T12:00:00+00:00'},
+        ]).encode())))
+        self.assertEqual([race['name'] for race in races], ['Забег'])
+
+    def test_ingest_stream_in_batches(self):
+        body = self.json_feed(25)
+        counts = ingest_stream(iter_races(io.BytesIO(body)), batch_size=10)
+        self.assertEqual(counts, {'races': 25, 'horses': 75, 'skipped': 0, 'odds_updated': 0, 'cancelled': 0})
+        counts = ingest_stream(iter_races(io.BytesIO(body)), batch_size=10)
+        self.assertEqual(counts, {'races': 0, 'horses': 0, 'skipped': 25, 'odds_updated': 0, 'cancelled': 0})
+        self.assertEqual(Race.objects.filter(name__startswith='Забег ').count(), 25)
+
+    def test_odds_delta_sync(self):
+        races = list(iter_races(io.BytesIO(self.json_feed(3))))
+        ingest_races(races)
+        Race.objects.filter(name='Забег 2').update(status='finished')
+
+        for race in races:
+            race['horses'][0]['odds'] = Decimal('5.00')
+        races[0]['horses'][1]['odds'] = Decimal('3.250')
+        with CaptureQueriesContext(connection) as captured:
+            counts = ingest_races(races)
+        updates = [q for q in captured.captured_queries if q['sql'].startswith('UPDATE')]
+
+        # Завершенный забег и неизменившиеся коэффициенты не трогаем
+        self.assertEqual(counts['odds_updated'], 2)
+        self.assertEqual(len(updates), 1)
+        changed = Horse.objects.filter(odds_version=1).order_by('race__name')
+        self.assertEqual(
+            [(horse.race.name, horse.odds) for horse in changed],
+            [('Забег 0', Decimal('5.00')), ('Забег 1', Decimal('5.00'))],
+        )
+        self.assertEqual(ingest_races(races)['odds_updated'], 0)
+
+
+class FlakyEmailBackend(LocMemEmailBackend):
+    """Почтовый бэкенд, отклоняющий письма на адреса из rejected"""
+
+    def __init__(self, rejected=(), **kwargs):
+        super().__init__(**kwargs)
+        self.rejected = set(rejected)
+        self.opened = 0
+
+    def open(self):
+        self.opened += 1
+
+    def send_messages(self, messages):
+        for message in messages:
+            if self.rejected.intersection(message.to):
+                raise ConnectionError('550 mailbox unavailable')
+        return super().send_messages(messages)
+
+
+class NotificationOutboxTests(TestCase):
+    """Очередь уведомлений и пакетная отправка"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users, cls.races = seed_betting_data(users=3, races=2, horses=3, bets_per_user=0)
+        for user in cls.users:
+            User.objects.filter(pk=user.pk).update(email=f'{user.username}@example.com')
+            user.email = f'{user.username}@example.com'
+
+    def place_bets(self):
+        race = self.races[0]
+        for user in self.users:
+            place_bet(user, race.id, race.horses.first().id, '100')
+
+    def test_placement_queues_without_sending(self):
+        self.place_bets()
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(Notification.objects.filter(kind='bet_placed', status='pending').count(), 3)
+
+        connection = FlakyEmailBackend()
+        self.assertEqual(drain_outbox(batch_size=2, connection=connection), {'sent': 3, 'retry': 0, 'dead': 0})
+        # Одно соединение на пачку, а не на письмо
+        self.assertEqual(connection.opened, 2)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), [f'{user.username}@example.com' for user in self.users])
+        self.assertFalse(Notification.objects.exclude(status='sent').exists())
+
+    def test_settlement_fans_out_one_message_per_user(self):
+        self.place_bets()
+        race = self.races[0]
+        horses = list(race.horses.all())
+        place_bet(self.users[0], race.id, horses[1].id, '50', 'place')
+        race.winner = horses[0]
+        race.status = 'finished'
+        race.save()
+        settle_race(race)
+
+        # Расчет только ставит рассылку в очередь
+        results = Notification.objects.filter(kind='race_completed', race=race)
+        self.assertFalse(results.exists())
+        race.refresh_from_db()
+        self.assertIsNotNone(race.results_queued_at)
+        self.assertEqual(fan_out_queued_races(), 1)
+        self.assertEqual(results.count(), 3)
+        race.refresh_from_db()
+        self.assertIsNone(race.results_queued_at)
+        self.assertEqual(fan_out_queued_races(), 0)
+        body = results.get(user=self.users[0]).body
+        self.assertIn('выигрыш 200.00₽', body)
+        self.assertIn('не сыграла', body)
+
+        # Повторная рассылка дублей не создает
+        self.assertEqual(fan_out_race_results(race, chunk_size=1)['users'], 3)
+        self.assertEqual(results.count(), 3)
+
+    def test_retry_then_dead_letter(self):
+        self.place_bets()
+        rejected = f'{self.users[0].username}@example.com'
+        connection = FlakyEmailBackend(rejected=[rejected])
+        with override_settings(BETTING_NOTIFICATION_MAX_ATTEMPTS=2):
+            self.assertEqual(drain_outbox(connection=connection), {'sent': 2, 'retry': 1, 'dead': 0})
+            failed = Notification.objects.get(recipient=rejected)
+            self.assertEqual((failed.status, failed.attempts), ('retry', 1))
+            self.assertIn('550', failed.last_error)
+            # До времени повтора уведомление не берется
+            self.assertEqual(drain_outbox(connection=connection)['retry'], 0)
+
+            Notification.objects.filter(pk=failed.pk).update(next_attempt_at=timezone.now())
+            with self.assertLogs('betting.notifications', 'WARNING'):
+                self.assertEqual(drain_outbox(connection=connection), {'sent': 0, 'retry': 0, 'dead': 1})
+        self.assertEqual(Notification.objects.get(pk=failed.pk).status, 'dead')
+
+    def test_claimed_batch_is_not_claimed_twice(self):
+        self.place_bets()
+        self.assertEqual(len(claim_batch(batch_size=10)), 3)
+        self.assertEqual(claim_batch(batch_size=10), [])
+        # Аренда истекла - отправитель упал, уведомления снова доступны
+        later = timezone.now() + timedelta(hours=1)
+        self.assertEqual(len(claim_batch(batch_size=10, now=later)), 3)
+
+
+class ParallelFanOutTests(TransactionTestCase):
+    """Рассылка результатов потоками: данные должны быть зафиксированы"""
+
+    def test_workers_read_partitions_single_writer(self):
+        users, races = seed_betting_data(users=7, races=2, horses=3, bets_per_user=4)
+        for user in users[1:]:
+            User.objects.filter(pk=user.pk).update(email=f'{user.username}@example.com')
+        race = races[1]
+        Race.objects.filter(pk=race.pk).update(winner=race.horses.first())
+        race.refresh_from_db()
+
+        result = fan_out_race_results(race, workers=3, chunk_size=1)
+        self.assertEqual((result['users'], result['bets']), (7, 14))
+        # У первого пользователя нет email
+        results = Notification.objects.filter(kind='race_completed', race=race)
+        self.assertEqual(sorted(results.values_list('user_id', flat=True)), sorted(user.pk for user in users[1:]))
+        self.assertEqual(fan_out_race_results(race, workers=3)['users'], 7)
+        self.assertEqual(results.count(), 6)
+
+    def test_reader_error_stops_fan_out(self):
+        users, races = seed_betting_data(users=3, races=2, horses=3, bets_per_user=2)
+        User.objects.update(email='player@example.com')
+        with mock.patch('betting.notifications._race_result_message', side_effect=RuntimeError('boom')):
+            with self.assertRaisesMessage(RuntimeError, 'boom'):
+                fan_out_race_results(races[1], workers=2)
+
+
+class LedgerAssertions:
+    """Проверка журнала: цепочка balance_after, баланс и счетчик операций профиля"""
+
+    def assertLedgerConsistent(self, user):
+        profile = UserProfile.objects.get(user=user)
+        entries = list(Transaction.objects.filter(user=user).order_by('created_at', 'id'))
+        balance = Decimal('0')
+        for entry in entries:
+            balance += entry.signed_amount
+            self.assertEqual(entry.balance_after, balance)
+        self.assertEqual(profile.balance, balance)
+        self.assertEqual(profile.ledger_entries, len(entries))
+        self.assertEqual(ledger.current_balance(user.pk), balance)
+
+
+class LedgerTests(LedgerAssertions, TestCase):
+    """Журнал операций как источник истины для баланса"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('ledger', password='password')
+
+    def test_every_balance_change_is_recorded(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('betting:deposit'), {'amount': '250'})
+        self.client.post(reverse('betting:withdraw'), {'amount': '5000', 'method': 'card'})
+        self.client.post(reverse('betting:withdraw'), {'amount': '150', 'method': 'card'})
+
+        race = Race.objects.create(name='Журнал', start_time=timezone.now() + timedelta(hours=1))
+        horse = Horse.objects.create(race=race, name='Буран', odds=Decimal('3.00'))
+        place_bet(self.user, race.id, horse.id, '100')
+        race.winner, race.status = horse, 'finished'
+        race.save()
+        settle_race(race)
+
+        self.assertEqual(
+            list(Transaction.objects.filter(user=self.user).order_by('created_at', 'id').values_list('transaction_type', 'amount')),
+            [('adjustment', Decimal('1000.00')), ('deposit', Decimal('250.00')), ('withdraw', Decimal('150.00')),
+             ('bet', Decimal('100.00')), ('win', Decimal('300.00'))],
+        )
+        self.assertLedgerConsistent(self.user)
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, Decimal('1300.00'))
+
+    def test_debit_cannot_overdraw(self):
+        with self.assertRaises(ledger.InsufficientFunds):
+            ledger.post(self.user.pk, 'withdraw', Decimal('1000.01'))
+        self.assertLedgerConsistent(self.user)
+
+    @mock.patch.object(ledger, 'CHECKPOINT_INTERVAL', 5)
+    def test_historical_balance_from_checkpoint(self):
+        entries = [ledger.post(self.user.pk, 'deposit', Decimal(i)) for i in range(1, 8)]
+        entries += ledger.post_many([
+            Transaction(user=self.user, transaction_type='bet', amount=Decimal('2')) for _ in range(4)
+        ])
+        self.assertLedgerConsistent(self.user)
+        # 12 операций с начальным балансом: точки после 5-й и 10-й
+        self.assertEqual(list(BalanceCheckpoint.objects.values_list('entries', flat=True).order_by('entries')), [5, 10])
+
+        for entry in entries:
+            with self.assertNumQueries(2):
+                self.assertEqual(ledger.balance_at(self.user.pk, entry.created_at), entry.balance_after)
+        before = Transaction.objects.filter(user=self.user).earliest('created_at').created_at - timedelta(seconds=1)
+        self.assertEqual(ledger.balance_at(self.user.pk, before), 0)
+
+    def test_reconcile_reports_and_repairs_drift(self):
+        other = User.objects.create_user('ledger2', password='password')
+        ledger.post(other.pk, 'deposit', Decimal('50'))
+        # Возврат мимо журнала и потерянный счетчик операций
+        UserProfile.objects.filter(user=self.user).update(balance=F('balance') + Decimal('75.50'))
+        UserProfile.objects.filter(user=other).update(ledger_entries=7)
+
+        output = io.StringIO()
+        call_command('reconcile_balances', '--chunk-size', '1', '--partitions', '2', stdout=output, stderr=io.StringIO())
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        report = {line['user_id']: line for line in lines[:-1]}
+        self.assertEqual(report[self.user.pk]['problems'], ['balance', 'balance_after'])
+        self.assertEqual(report[self.user.pk]['drift'], '75.50')
+        self.assertEqual(report[other.pk]['problems'], ['entries'])
+        self.assertEqual(lines[-1]['discrepancies'], 2)
+        self.assertEqual(lines[-1]['drift'], '75.50')
+
+        entries = Transaction.objects.count()
+        call_command('reconcile_balances', '--repair', stdout=io.StringIO(), stderr=io.StringIO())
+        # Журнал - источник истины: профиль приводится к нему, журнал не меняется
+        self.assertEqual(Transaction.objects.count(), entries)
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, Decimal('1000.00'))
+        self.assertEqual(UserProfile.objects.get(user=other).ledger_entries, 2)
+        self.assertLedgerConsistent(self.user)
+        self.assertLedgerConsistent(other)
+        self.assertEqual(reconcile_range(0, other.pk), {
+            'users': 2, 'discrepancies': 0, 'repaired': 0, 'drift': Decimal('0'),
+        })
+
+    def test_repair_leaves_broken_ledger_to_report(self):
+        # balance_after последней операции не сходится с суммой журнала
+        Transaction.objects.filter(user=self.user).update(balance_after=Decimal('900.00'))
+        summary = reconcile_range(self.user.pk, self.user.pk, fix=True)
+        self.assertEqual((summary['discrepancies'], summary['repaired']), (1, 0))
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, Decimal('1000.00'))
+
+
+
+class ParallelReconcileTests(LedgerAssertions, TransactionTestCase):
+    """Сверка диапазонов в отдельных процессах: данные должны быть зафиксированы"""
+
+    def test_partitions_reconciled_in_worker_processes(self):
+        users = [User.objects.create_user(f'reconcile{i}', password='password') for i in range(4)]
+        for user in users:
+            ledger.post(user.pk, 'deposit', Decimal('10'))
+        UserProfile.objects.filter(user=users[3]).update(balance=F('balance') - Decimal('5'))
+
+        output = io.StringIO()
+        call_command(
+            'reconcile_balances', '--partitions', '2', '--workers', '2', '--chunk-size', '1',
+            stdout=output, stderr=io.StringIO(),
+        )
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([line['user_id'] for line in lines[:-1]], [users[3].pk])
+        self.assertEqual(lines[-1]['drift'], '-5.00')
+        self.assertEqual((lines[-1]['users'], lines[-1]['partitions']), (4, 2))
+
+
+class PlacementTests(LedgerAssertions, TestCase):
+    """Размещение ставки с условным списанием баланса"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('placement', password='password')
+        self.race = Race.objects.create(name='Размещение', start_time=timezone.now() + timedelta(hours=1))
+        self.horse = Horse.objects.create(race=self.race, name='Буран', odds=Decimal('3.00'))
+
+    def test_insufficient_funds_never_overdraw(self):
+        place_bet(self.user, self.race.id, self.horse.id, '600')
+        with self.assertRaisesMessage(BetError, 'Недостаточно средств'):
+            place_bet(self.user, self.race.id, self.horse.id, '600')
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, Decimal('400.00'))
+        self.assertEqual(Bet.objects.filter(user=self.user).count(), 1)
+        self.assertLedgerConsistent(self.user)
+
+    def test_debit_checks_current_balance_not_a_stale_read(self):
+        # Профиль прочитан до того, как другой запрос потратил баланс
+        user = User.objects.select_related('betting_profile').get(pk=self.user.pk)
+        self.assertEqual(user.betting_profile.balance, Decimal('1000.00'))
+        ledger.post(self.user.pk, 'withdraw', Decimal('900'))
+
+        with CaptureQueriesContext(connection) as captured:
+            with self.assertRaisesMessage(BetError, 'Недостаточно средств'):
+                place_bet(user, self.race.id, self.horse.id, '500')
+        # Проверка и списание - один условный UPDATE без предварительного чтения
+        statements = [q['sql'] for q in captured.captured_queries if not q['sql'].startswith(('SAVEPOINT', 'ROLLBACK', 'RELEASE'))]
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('UPDATE "betting_userprofile"'))
+        self.assertIn('"balance" >=', statements[0])
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, Decimal('100.00'))
+        self.assertLedgerConsistent(self.user)
+
+    def test_rejected_horse_rolls_back_debit(self):
+        other = Race.objects.create(name='Другой', start_time=timezone.now() + timedelta(hours=1))
+        finished = Race.objects.create(name='Завершен', start_time=timezone.now(), status='finished')
+        horses = [
+            Horse.objects.create(race=other, name='Чужая', odds=Decimal('2.00')),
+            Horse.objects.create(race=finished, name='Поздно', odds=Decimal('2.00')),
+        ]
+        for horse in horses:
+            with self.assertRaisesMessage(BetError, 'Ставки на эту лошадь не принимаются'):
+                place_bet(self.user, self.race.id, horse.id, '100')
+        with self.assertRaises(BetError):
+            place_bet(self.user, finished.id, horses[1].id, '100')
+
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, Decimal('1000.00'))
+        self.assertFalse(Transaction.objects.filter(user=self.user, transaction_type='bet').exists())
+        self.assertFalse(Bet.objects.exists())
+        self.assertLedgerConsistent(self.user)
+
+
+class BetSlipTests(LedgerAssertions, TestCase):
+    """Купон ставок через JSON API: токен, CSRF и идемпотентность"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('slip', password='password')
+        self.race = Race.objects.create(name='Купон', start_time=timezone.now() + timedelta(hours=1))
+        self.horses = [Horse.objects.create(race=self.race, name=f'Лошадь {i}', odds=Decimal('4.00')) for i in range(2)]
+        self.items = [
+            {'race_id': self.race.id, 'horse_id': self.horses[0].id, 'amount': '100', 'bet_type': 'win'},
+            {'race_id': self.race.id, 'horse_id': self.horses[1].id, 'amount': '50', 'bet_type': 'place'},
+        ]
+
+    def post(self, client, payload, **headers):
+        return client.post(
+            reverse('betting:api_bet_slip'), json.dumps(payload), content_type='application/json', headers=headers,
+        )
+
+    def test_token_auth_without_csrf(self):
+        _, key = create_token(self.user, 'мобильное приложение')
+        client = Client(enforce_csrf_checks=True)
+        response = self.post(client, {'bets': self.items}, Authorization=f'Token {key}', Idempotency_Key='k1')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['balance'], '850.00')
+        self.assertEqual(len(response.json()['bets']), 2)
+
+        self.assertEqual(self.post(client, {'bets': self.items}, Authorization='Token неверный').status_code, 401)
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.post(client, {'bets': self.items}, Authorization=f'Bearer {key}').status_code, 401)
+
+    def test_session_auth_requires_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+        self.assertEqual(self.post(client, {'bets': self.items}).status_code, 401)
+        client.force_login(self.user)
+        response = self.post(client, {'bets': self.items})
+        self.assertEqual(response.status_code, 403)
+        self.assertIn('CSRF', response.json()['error'])
+        self.assertFalse(Bet.objects.exists())
+
+        client.get(reverse('betting:place_bet_race', args=[self.race.id]))
+        token = client.cookies['csrftoken'].value
+        self.assertEqual(self.post(client, {'bets': self.items}, X_CSRFToken=token).status_code, 201)
+
+    def test_idempotent_replay(self):
+        slip, replayed = place_bet_slip(self.user, self.items, 'replay')
+        self.assertFalse(replayed)
+        again, replayed = place_bet_slip(self.user, self.items, 'replay')
+        self.assertTrue(replayed)
+        self.assertEqual((again.pk, again.response), (slip.pk, slip.response))
+        self.assertEqual(Bet.objects.count(), 2)
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, Decimal('850.00'))
+        self.assertLedgerConsistent(self.user)
+
+        self.client.force_login(self.user)
+        response = self.post(self.client, {'bets': self.items, 'idempotency_key': 'replay'})
+        self.assertEqual((response.status_code, response['Idempotent-Replayed']), (200, 'true'))
+
+    def test_key_reused_for_other_slip_is_rejected(self):
+        place_bet_slip(self.user, self.items, 'reuse')
+        with self.assertRaisesMessage(BetError, 'Ключ идемпотентности уже использован'):
+            place_bet_slip(self.user, self.items[:1], 'reuse')
+        self.assertEqual(Bet.objects.count(), 2)
+
+    def test_concurrent_duplicate_returns_stored_slip(self):
+        slip, _ = place_bet_slip(self.user, self.items, 'race')
+        real_replay = placement._replay_slip
+        calls = []
+
+        def replay(*args):
+            # Первая проверка не видит купон параллельного запроса
+            calls.append(args)
+            return None if len(calls) == 1 else real_replay(*args)
+
+        with mock.patch.object(placement, '_replay_slip', side_effect=replay):
+            again, replayed = place_bet_slip(self.user, self.items, 'race')
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(replayed)
+        self.assertEqual(again.pk, slip.pk)
+        self.assertEqual(Bet.objects.count(), 2)
+        self.assertLedgerConsistent(self.user)
+
+    def test_slip_is_all_or_nothing(self):
+        closed = Race.objects.create(name='Закрыт', start_time=timezone.now(), status='finished')
+        horse = Horse.objects.create(race=closed, name='Поздно', odds=Decimal('2.00'))
+        with self.assertRaisesMessage(BetError, 'Ставка #3'):
+            place_bet_slip(self.user, self.items + [{'horse_id': horse.id, 'amount': '10'}])
+        with self.assertRaisesMessage(BetError, 'Недостаточно средств'):
+            place_bet_slip(self.user, self.items + [{'horse_id': self.horses[0].id, 'amount': '900'}])
+        self.assertFalse(Bet.objects.exists())
+        self.assertFalse(BetSlip.objects.exists())
+        self.assertLedgerConsistent(self.user)
+
+
+class AsyncApiTests(TestCase):
+    """Асинхронные эндпоинты чтения"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('async', password='password')
+        now = timezone.now()
+        cls.race = Race.objects.create(name='Ближайший', start_time=now + timedelta(hours=1))
+        cls.horses = [Horse.objects.create(race=cls.race, name=f'Лошадь {i}', odds=Decimal('2.50') + i) for i in range(2)]
+        Race.objects.create(name='Позже', start_time=now + timedelta(hours=2))
+        Race.objects.create(name='Прошел', start_time=now - timedelta(hours=1), status='finished')
+
+    async def test_races(self):
+        response = await self.async_client.get(reverse('betting:api_races'))
+        self.assertEqual(response.status_code, 200)
+        races = response.json()['races']
+        self.assertEqual([race['name'] for race in races], ['Ближайший', 'Позже'])
+        self.assertEqual(
+            set(races[0]), {'id', 'name', 'start_time', 'status', 'winner_id', 'horses'},
+        )
+        self.assertEqual(
+            races[0]['horses'][0],
+            {'id': self.horses[0].id, 'name': 'Лошадь 0', 'odds': '2.50', 'odds_version': 0,
+             'tote_odds': None, 'color': '', 'jockey': ''},
+        )
+
+        response = await self.async_client.get(reverse('betting:api_races'), {'limit': 1})
+        self.assertEqual(len(response.json()['races']), 1)
+        response = await self.async_client.get(reverse('betting:api_races'), {'limit': 'много'})
+        self.assertEqual(response.status_code, 400)
+
+    async def test_race_card(self):
+        response = await self.async_client.get(reverse('betting:api_race_card', args=[self.race.id]))
+        self.assertEqual(response.status_code, 200)
+        card = response.json()
+        self.assertEqual((card['id'], card['status']), (self.race.id, 'scheduled'))
+        self.assertEqual([horse['odds'] for horse in card['horses']], ['2.50', '3.50'])
+
+        response = await self.async_client.get(reverse('betting:api_race_card', args=[self.race.id + 1000]))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_balance_requires_login(self):
+        response = await self.async_client.get(reverse('betting:api_balance'))
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json(), {'error': 'Требуется авторизация'})
+
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('betting:api_balance'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'balance': '1000.00'})
+
+        response = await self.async_client.post(reverse('betting:api_balance'))
+        self.assertEqual(response.status_code, 405)
+
+        await UserProfile.objects.filter(user=self.user).adelete()
+        response = await self.async_client.get(reverse('betting:api_balance'))
+        self.assertEqual(response.status_code, 404)
+
+
+class SettlementTests(LedgerAssertions, TestCase):
+    """Массовый расчет ставок завершенного забега"""
+
+    def setUp(self):
+        self.users = [User.objects.create_user(f'settle{i}', password='password') for i in range(3)]
+
+    def finished_race(self, bets):
+        race = Race.objects.create(name=f'Расчет {bets}', start_time=timezone.now() + timedelta(hours=1))
+        horses = [Horse.objects.create(race=race, name=f'Лошадь {i}', odds=Decimal('3.00')) for i in range(2)]
+        for i in range(bets):
+            place_bet(self.users[i % 3], race.id, horses[i % 2].id, '10')
+        race.winner, race.status = horses[0], 'finished'
+        race.save()
+        return race
+
+    def settle_queries(self, bets):
+        race = self.finished_race(bets)
+        with CaptureQueriesContext(connection) as captured:
+            result = settle_race(race)
+        self.assertEqual(result['won'] + result['lost'], bets)
+        return len(captured.captured_queries)
+
+    def test_statements_do_not_depend_on_bet_count(self):
+        self.assertEqual(self.settle_queries(3), self.settle_queries(30))
+
+    def test_payouts_ledger_and_stats(self):
+        race = self.finished_race(6)
+        self.assertEqual(settle_race(race), {'won': 3, 'lost': 3, 'paid': Decimal('90.00')})
+        self.assertEqual(
+            list(Transaction.objects.filter(transaction_type='win').values_list('amount', flat=True)),
+            [Decimal('30.00')] * 3,
+        )
+        for user in self.users:
+            self.assertEqual(UserProfile.objects.get(user=user).balance, Decimal('1010.00'))
+            self.assertLedgerConsistent(user)
+            stats = get_user_stats(user)
+            self.assertEqual(
+                (stats.total_bets, stats.active_bets, stats.won_bets, stats.lost_bets, stats.total_won),
+                (2, 0, 1, 1, Decimal('30.00')),
+            )
+
+        # Повторный расчет читает ставки под блокировкой забега и ничего не платит
+        self.assertEqual(settle_race(race), {'won': 0, 'lost': 0, 'paid': 0})
+        self.assertEqual(Transaction.objects.filter(transaction_type='win').count(), 3)
+
+
+class UserStatsTests(TestCase):
+    """Статистика пользователей совпадает с агрегатами таблицы ставок"""
+
+    def setUp(self):
+        self.users = [User.objects.create_user(f'stats{i}', password='password') for i in range(3)]
+        self.races = [
+            Race.objects.create(name=f'Статистика {i}', start_time=timezone.now() + timedelta(hours=1))
+            for i in range(2)
+        ]
+        for race in self.races:
+            Horse.objects.bulk_create([Horse(race=race, name=f'Лошадь {i}', odds=Decimal('4.00')) for i in range(3)])
+
+    def bet_aggregates(self, user):
+        bets = Bet.objects.filter(user=user)
+        expected = {
+            'total_bets': bets.count(),
+            'active_bets': bets.filter(is_settled=False).count(),
+            'won_bets': bets.filter(is_winner=True).count(),
+            'lost_bets': bets.filter(is_settled=True, is_winner=False).count(),
+            'total_wagered': bets.aggregate(total=Sum('amount'))['total'] or 0,
+            'total_won': bets.filter(is_winner=True).aggregate(total=Sum('potential_win'))['total'] or 0,
+        }
+        for code, _ in Bet.BET_TYPES:
+            expected[f'{code}_bets'] = bets.filter(bet_type=code).count()
+            expected[f'{code}_won'] = bets.filter(bet_type=code, is_winner=True).count()
+        return expected
+
+    def assertStatsMatchBets(self):
+        for user in self.users:
+            stats = get_user_stats(user)
+            self.assertEqual({field: getattr(stats, field) for field in STATS_FIELDS}, self.bet_aggregates(user))
+
+    def test_placement_settlement_and_rebuild_keep_stats_in_step(self):
+        bet_types = [code for code, _ in Bet.BET_TYPES]
+        for i in range(12):
+            race = self.races[i % 2]
+            horse = race.horses.order_by('id')[i % 3]
+            place_bet(self.users[i % 3], race.id, horse.id, str(10 + i), bet_types[i % 3])
+        self.assertStatsMatchBets()
+
+        race = self.races[0]
+        record_results(race, list(race.horses.order_by('id')))
+        race.status = 'finished'
+        race.save()
+        settle_race(race)
+        self.assertStatsMatchBets()
+
+        # Пересборка командой восстанавливает испорченные строки
+        UserStats.objects.update(total_bets=0, active_bets=7, total_wagered=0, win_won=5)
+        call_command('rebuild_user_stats', '--batch-size', '2', stdout=io.StringIO())
+        self.assertStatsMatchBets()
+
+
+class FinishOrderSettlementTests(LedgerAssertions, TestCase):
+    """Расчет ставок на победу, место и показ по порядку прихода"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('finish', password='password')
+        self.race = Race.objects.create(name='Порядок прихода', start_time=timezone.now() + timedelta(hours=1))
+        self.horses = [Horse.objects.create(race=self.race, name=f'Лошадь {i}', odds=Decimal('5.00')) for i in range(4)]
+
+    def test_place_and_show_resolved_by_position(self):
+        # (позиция лошади на финише - 1, тип ставки, выиграла ли)
+        cases = [
+            (0, 'win', True), (1, 'win', False),
+            (1, 'place', True), (2, 'place', False),
+            (2, 'show', True), (3, 'show', False), (0, 'show', True),
+        ]
+        bets = [place_bet(self.user, self.race.id, self.horses[i].id, '100', bet_type) for i, bet_type, _ in cases]
+        record_results(self.race, self.horses)
+        self.race.status = 'finished'
+        self.race.save()
+        self.assertEqual(Race.objects.get(pk=self.race.pk).winner, self.horses[0])
+
+        with CaptureQueriesContext(connection) as captured:
+            result = settle_race(self.race)
+        grouped = [q for q in captured.captured_queries if 'GROUP BY' in q['sql'] and 'betting_bet' in q['sql']]
+        self.assertEqual(len(grouped), 1)
+
+        self.assertEqual(
+            [Bet.objects.get(pk=bet.pk).is_winner for bet in bets],
+            [expected for _, _, expected in cases],
+        )
+        # Коэффициент 5.00: на победу x5, на место x3, на показ x2
+        self.assertEqual(result, {'won': 4, 'lost': 3, 'paid': Decimal('1200.00')})
+        self.assertEqual(
+            sorted(Transaction.objects.filter(transaction_type='win').values_list('amount', flat=True)),
+            [Decimal('300.00'), Decimal('400.00'), Decimal('500.00')],
+        )
+        self.assertLedgerConsistent(self.user)
+        stats = get_user_stats(self.user)
+        self.assertEqual((stats.win_won, stats.place_won, stats.show_won, stats.won_bets), (1, 1, 2, 4))
+        rebuild_user_stats([self.user.pk])
+        self.assertEqual(get_user_stats(self.user).won_bets, 4)
+
+    def test_winner_without_results_settles_first_place(self):
+        win = place_bet(self.user, self.race.id, self.horses[0].id, '100', 'win')
+        place = place_bet(self.user, self.race.id, self.horses[0].id, '100', 'place')
+        other = place_bet(self.user, self.race.id, self.horses[1].id, '100', 'place')
+        self.race.winner, self.race.status = self.horses[0], 'finished'
+        self.race.save()
+        settle_race(self.race)
+        self.assertEqual(
+            [Bet.objects.get(pk=bet.pk).is_winner for bet in (win, place, other)], [True, True, False],
+        )
+
+
+class CancellationTests(LedgerAssertions, TestCase):
+    """Отмена забегов с возвратом ставок"""
+
+    def setUp(self):
+        self.users = [User.objects.create_user(f'refund{i}', password='password') for i in range(3)]
+        self.race = Race.objects.create(name='Отменяемый', start_time=timezone.now() + timedelta(hours=1))
+        self.horses = [Horse.objects.create(race=self.race, name=f'Лошадь {i}', odds=Decimal('2.00')) for i in range(2)]
+
+    def place(self, count):
+        for i in range(count):
+            place_bet(self.users[i % 3], self.race.id, self.horses[i % 2].id, '10', ['win', 'place'][i % 2])
+
+    def cancel_queries(self, bets):
+        self.place(bets)
+        with CaptureQueriesContext(connection) as captured:
+            result = cancel_races([self.race.id], 'дождь')
+        self.assertEqual(result['bets'], bets)
+        return len(captured.captured_queries)
+
+    def test_refund_statements_do_not_depend_on_bet_count(self):
+        few = self.cancel_queries(3)
+        self.race = Race.objects.create(name='Второй', start_time=timezone.now() + timedelta(hours=1))
+        self.horses = [Horse.objects.create(race=self.race, name=f'Лошадь {i}', odds=Decimal('2.00')) for i in range(2)]
+        self.assertEqual(self.cancel_queries(30), few)
+
+    def test_refunds_are_booked_in_ledger(self):
+        self.place(7)
+        other = Race.objects.create(name='Не отменен', start_time=timezone.now() + timedelta(hours=2))
+        horse = Horse.objects.create(race=other, name='Буран', odds=Decimal('2.00'))
+        place_bet(self.users[0], other.id, horse.id, '15')
+        result = cancel_races([self.race.id], 'дождь')
+        self.assertEqual(result, {'races': 1, 'bets': 7, 'users': 3, 'refunded': Decimal('70.00')})
+        self.assertEqual(Race.objects.get(pk=self.race.pk).status, 'cancelled')
+        self.assertFalse(Bet.objects.filter(race=self.race, is_settled=False).exists())
+
+        refunds = Transaction.objects.filter(transaction_type='refund').order_by('user_id')
+        self.assertEqual([entry.amount for entry in refunds], [Decimal('30.00'), Decimal('20.00'), Decimal('20.00')])
+        self.assertIn('дождь', refunds[0].description)
+        for user in self.users[1:]:
+            self.assertEqual(UserProfile.objects.get(user=user).balance, Decimal('1000.00'))
+            self.assertLedgerConsistent(user)
+        self.assertEqual(UserProfile.objects.get(user=self.users[0]).balance, Decimal('985.00'))
+        self.assertLedgerConsistent(self.users[0])
+        # Возврат - не проигрыш: в статистике остается только ставка на другой забег
+        fields = ['total_bets', 'active_bets', 'lost_bets', 'total_wagered', 'win_bets', 'place_bets']
+        stats = get_user_stats(self.users[0])
+        self.assertEqual([getattr(stats, field) for field in fields], [1, 1, 0, Decimal('15.00'), 1, 0])
+        self.assertEqual(stats.net_profit, Decimal('-15.00'))
+        rebuild_user_stats([self.users[0].pk])
+        stats.refresh_from_db()
+        self.assertEqual([getattr(stats, field) for field in fields], [1, 1, 0, Decimal('15.00'), 1, 0])
+
+        # Повторная отмена ничего не возвращает
+        self.assertEqual(cancel_races([self.race.id])['bets'], 0)
+
+    def test_feed_cancels_scratched_race(self):
+        self.place(2)
+        counts = ingest_races([
+            {'name': self.race.name, 'start_time': self.race.start_time, 'cancelled': True, 'horses': []},
+            {'name': 'Снят заранее', 'start_time': self.race.start_time, 'cancelled': True, 'horses': []},
+        ])
+        self.assertEqual(counts['cancelled'], 1)
+        self.assertEqual(Race.objects.get(name='Снят заранее').status, 'cancelled')
+        self.assertEqual(Transaction.objects.filter(transaction_type='refund').count(), 2)
+        races = list(iter_races(io.BytesIO(b'<races><race name="X" start_time="2030-01-01T12:00:00+00:00" status="Scratched"/></races>')))
+        self.assertTrue(races[0]['cancelled'])
+
+
+class DatabaseProfileTests(SimpleTestCase):
+    """Выбор профиля базы данных по переменным окружения"""
+
+    def test_sqlite_profile_is_tuned_for_concurrent_writes(self):
+        database = database_from_env({}, '/tmp/ippodrom.sqlite3')
+        self.assertEqual(database['NAME'], '/tmp/ippodrom.sqlite3')
+        self.assertEqual(database['OPTIONS']['transaction_mode'], 'IMMEDIATE')
+        for pragma in ('journal_mode=WAL', 'synchronous=NORMAL', 'busy_timeout=', 'mmap_size='):
+            self.assertIn(f'PRAGMA {pragma}', database['OPTIONS']['init_command'])
+        self.assertNotIn('OPTIONS', database_from_env({'IPPODROM_DB': 'sqlite-legacy'}, 'db.sqlite3'))
+
+    def test_postgres_profile_pools_or_keeps_connections(self):
+        pooled = database_from_env({'IPPODROM_DB': 'postgres', 'IPPODROM_DB_POOL_MAX': '50'}, 'db.sqlite3')
+        self.assertEqual(pooled['ENGINE'], 'django.db.backends.postgresql')
+        self.assertEqual(pooled['OPTIONS']['pool']['max_size'], 50)
+        self.assertEqual(pooled['CONN_MAX_AGE'], 0)
+
+        persistent = database_from_env({'IPPODROM_DB': 'postgres', 'IPPODROM_DB_POOL': '0'}, 'db.sqlite3')
+        self.assertNotIn('OPTIONS', persistent)
+        self.assertEqual(persistent['CONN_MAX_AGE'], 600)
+
+        with self.assertRaises(ValueError):
+            database_from_env({'IPPODROM_DB': 'mysql'}, 'db.sqlite3')
+
+
+@override_settings(BETTING_REPLICA_DATABASE='replica')
+class ReplicaRoutingTests(TransactionTestCase):
+    """
+    Чтение истории с реплики. В тестах реплика - зеркало основной базы
+    (TEST MIRROR): данные те же, поэтому проверяется, какое соединение
+    выполнило запрос. Зеркало видит только зафиксированные данные
+    """
+
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        replicas._lag_checks.clear()
+        self.user = User.objects.create_user('reader', password='password')
+        self.race = Race.objects.create(name='Только на основной', start_time=timezone.now())
+
+    def test_reads_go_to_replica_until_first_write(self):
+        with replica_reads():
+            self.assertEqual(Race.objects.all().db, 'replica')
+            Race.objects.create(name='Запись', start_time=timezone.now())
+            # После записи - чтение своих данных с основной базы
+            self.assertEqual(Race.objects.all().db, 'default')
+        self.assertEqual(Race.objects.all().db, 'default')
+
+        with replica_reads():
+            race = Race.objects.get(pk=self.race.pk)
+            self.assertEqual(race._state.db, 'replica')
+        with replica_reads(), CaptureQueriesContext(connections['replica']) as replica_queries:
+            race.status = 'finished'
+            race.save()
+        # Объект, прочитанный с реплики, сохраняется в основную базу
+        self.assertFalse(replica_queries.captured_queries)
+        self.assertEqual(Race.objects.get(pk=race.pk).status, 'finished')
+
+    def test_lagging_replica_is_skipped(self):
+        with mock.patch.object(replicas, 'replica_lag', return_value=30), self.assertLogs('betting.replicas', 'WARNING'):
+            with replica_reads():
+                self.assertEqual(Race.objects.all().db, 'default')
+
+    def test_history_views_read_after_write(self):
+        self.client.force_login(self.user)
+        url = reverse('betting:transaction_history')
+        with CaptureQueriesContext(connections['replica']) as replica_queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertTrue(replica_queries.captured_queries)
+
+        response = self.client.post(reverse('betting:deposit'), {'amount': '100'})
+        self.assertEqual(response.cookies[replicas.PRIMARY_COOKIE]['max-age'], 5)
+        with CaptureQueriesContext(connections['replica']) as replica_queries:
+            response = self.client.get(url)
+        self.assertFalse(replica_queries.captured_queries)
+        self.assertEqual(response.context['deposit_total'], Decimal('100.00'))
+
+
+# Общий кэш пользователей; в тестах - локальный, процесс один
+USER_CACHE = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'ippodrom'},
+    'users': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'users'},
+}
+
+
+@skipIf('users' in settings.CACHES, 'Настроен общий кэш (IPPODROM_REDIS_URL)')
+class SessionRevocationTests(TestCase):
+    """Без общего кэша сессии хранятся только в базе"""
+
+    def test_deleted_session_is_rejected(self):
+        self.assertEqual(settings.SESSION_ENGINE, 'django.contrib.sessions.backends.db')
+        User.objects.create_user('revoked', password='password')
+        self.client.login(username='revoked', password='password')
+        url = reverse('betting:user_profile')
+        self.assertEqual(self.client.get(url).status_code, 200)
+        # Выход в другом процессе удаляет строку сессии
+        Session.objects.all().delete()
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+
+@override_settings(
+    CACHES=USER_CACHE, BETTING_USER_CACHE='users',
+    SESSION_ENGINE='django.contrib.sessions.backends.cached_db', SESSION_CACHE_ALIAS='users',
+)
+class CachedSessionTests(TestCase):
+    """Сессия, пользователь и профиль авторизованного запроса из кэша"""
+
+    def setUp(self):
+        cache.clear()
+        caches['users'].clear()
+        self.user = User.objects.create_user('cached', password='password')
+        self.client.login(username='cached', password='password')
+
+    def auth_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [
+            query['sql'] for query in queries.captured_queries
+            if any(table in query['sql'] for table in ('django_session', 'auth_user', 'betting_userprofile'))
+        ]
+
+    def test_user_and_profile_in_one_query_then_from_cache(self):
+        url = reverse('betting:user_profile')
+        caches['users'].delete(f'betting:user:{self.user.pk}')
+        queries = self.auth_queries(url)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('betting_userprofile', queries[0])
+        self.assertEqual(self.auth_queries(url), [])
+
+    def test_deactivated_user_is_rejected(self):
+        url = reverse('betting:user_profile')
+        self.auth_queries(url)
+        # Сохранение в другом процессе сбрасывает запись общего кэша
+        user = User.objects.get(pk=self.user.pk)
+        user.is_active = False
+        user.save()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('login', response.url)
+
+    def test_logout_in_another_worker_ends_session(self):
+        url = reverse('betting:user_profile')
+        self.auth_queries(url)
+        # Тот же cookie в другом клиенте: выход сбрасывает сессию в общем кэше
+        other = Client()
+        other.cookies = self.client.cookies
+        other.get(reverse('betting:logout'))
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+    def test_password_change_ends_other_sessions(self):
+        url = reverse('betting:user_profile')
+        self.auth_queries(url)
+        user = User.objects.get(pk=self.user.pk)
+        user.set_password('changed-password')
+        user.save()
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+    @override_settings(BETTING_USER_CACHE=None)
+    def test_without_shared_cache_user_is_read_every_request(self):
+        url = reverse('betting:user_profile')
+        self.assertEqual(len(self.auth_queries(url)), 1)
+        # Изменение в обход моделей тоже видно сразу
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+    def test_balance_change_invalidates_cached_profile(self):
+        url = reverse('betting:user_profile')
+        self.client.get(url)
+        ledger.post(self.user.pk, 'deposit', Decimal('250'))
+        self.assertEqual(self.client.get(url).context['user_profile'].balance, Decimal('1250.00'))
+
+    def test_saving_user_does_not_touch_profile(self):
+        with self.assertNumQueries(1):
+            self.user.save(update_fields=['last_login'])
+        self.assertEqual(UserProfile.objects.filter(user=self.user).count(), 1)
@@ -0,0 +1,43 @@
+import hashlib
+import secrets
+from django.middleware.csrf import CsrfViewMiddleware
+from .models import ApiToken
+
+# Схемы заголовка Authorization, принимаемые JSON API
+AUTH_SCHEMES = ('token', 'bearer')
+
+
+def _hash(key):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def create_token(user, name=''):
+    """Выпустить токен API. Возвращает (токен, ключ); ключ больше нигде не хранится"""
+    key = secrets.token_hex(20)
+    return ApiToken.objects.create(user=user, name=name, key_hash=_hash(key)), key
+
+
+def authenticate_header(header):
+    """
+    Пользователь по заголовку "Authorization: Token <ключ>" (или Bearer).
+    None - заголовок некорректен, ключ неизвестен или пользователь отключен
+    """
+    scheme, _, key = header.strip().partition(' ')
+    if scheme.lower() not in AUTH_SCHEMES or not key.strip():
+        return None
+    token = ApiToken.objects.select_related('user').filter(key_hash=_hash(key.strip())).first()
+    if token is None or not token.user.is_active:
+        return None
+    return token.user
+
+
+class _CsrfCheck(CsrfViewMiddleware):
+    def _reject(self, request, reason):
+        return reason
+
+
+def csrf_failure(request):
+    """Причина отказа проверки CSRF для запроса с cookie сессии или None"""
+    check = _CsrfCheck(lambda request: None)
+    check.process_request(request)
+    return check.process_view(request, None, (), {})
@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import api, views
 
 app_name = 'betting'
 
@@ -17,4 +17,10 @@ urlpatterns = [
     path('stats/', views.user_stats, name='user_stats'),
     path('profile/', views.user_profile, name='user_profile'),
     path('transactions/', views.transaction_history, name='transaction_history'),
+    path('api/bet-slip/', api.bet_slip, name='api_bet_slip'),
+    path('api/races/', api.races, name='api_races'),
+    path('api/races/<int:race_id>/', api.race_card, name='api_race_card'),
+    path('api/races/events/', api.race_events, name='api_race_events'),
+    path('api/balance/', api.balance, name='api_balance'),
+    path('api/cache-stats/', api.cache_stats, name='api_cache_stats'),
 ]
\ No newline at end of file
@@ -0,0 +1,40 @@
+from django.db import connections, router
+from django.db.models import Case, F, Value, When
+
+
+def bulk_increment(model, key_field, deltas, **values):
+    """
+    Увеличить поля многих строк модели на разные величины.
+
+    deltas - словарь {значение key_field: {поле: приращение}}.
+    Каждая пачка строк обновляется одним запросом
+    UPDATE ... SET поле = поле + CASE key_field WHEN ... END,
+    размер пачки подбирается под лимит параметров запроса СУБД.
+    values - дополнительные поля, одинаковые для всех строк.
+    """
+    if not deltas:
+        return 0
+
+    fields = sorted({field for row in deltas.values() for field in row})
+    connection = connections[router.db_for_write(model)]
+    # На каждую строку: ключ в IN и по паре (ключ, значение) на поле
+    max_params = connection.features.max_query_params or 999
+    batch_size = max(1, (max_params - len(values) - 1) // (2 * len(fields) + 1))
+
+    keys = list(deltas)
+    updated = 0
+    for start in range(0, len(keys), batch_size):
+        chunk = keys[start:start + batch_size]
+        updates = {}
+        for field in fields:
+            whens = [
+                When(**{key_field: key}, then=Value(deltas[key][field]))
+                for key in chunk if deltas[key].get(field)
+            ]
+            if whens:
+                updates[field] = F(field) + Case(
+                    *whens, default=Value(0), output_field=model._meta.get_field(field)
+                )
+        if updates:
+            updated += model.objects.filter(**{f'{key_field}__in': chunk}).update(**updates, **values)
+    return updated
@@ -4,110 +4,104 @@ from django.contrib.auth.models import User
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.utils import timezone
-from django.db.models import Sum, Count, Q
-from .models import UserProfile, Race, Horse, Bet
-from decimal import Decimal
-from .models import UserProfile, Race, Horse, Bet, Transaction 
-
+from django.db.models import Sum
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from .models import Race, Horse, Bet
+from decimal import Decimal, InvalidOperation
+from .models import Race, Horse, Bet, Transaction 
+from .caching import cache_anonymous_page, cached_fragment
+from .pagination import keyset_page
+from .profiles import get_profile
+from .replicas import use_replica
+from . import ledger, placement
+from .stats import get_user_stats
+
+def _upcoming_races_html(show_bet_button):
+    def render_fragment():
+        upcoming_races = Race.objects.filter(
+            status='scheduled',
+            start_time__gte=timezone.now()
+        ).prefetch_related('horses').order_by('start_time')[:5]
+        return render_to_string('betting/fragments/upcoming_races.html', {
+            'upcoming_races': upcoming_races,
+            'show_bet_button': show_bet_button,
+        })
+    return mark_safe(cached_fragment('upcoming_races', render_fragment, show_bet_button))
+
+def _recent_results_html():
+    def render_fragment():
+        recent_races = Race.objects.filter(
+            status='finished'
+        ).select_related('winner').order_by('-start_time')[:3]
+        return render_to_string('betting/fragments/recent_results.html', {'recent_races': recent_races})
+    return mark_safe(cached_fragment('recent_results', render_fragment))
+
+@cache_anonymous_page('home')
 def home(request):
-    # Автоматически рассчитываем завершенные забеги
-    from .tasks import auto_settle_races
-    try:
-        settlement_results = auto_settle_races()
-        if settlement_results:
-            messages.info(request, 'Некоторые забеги были автоматически завершены')
-    except Exception as e:
-        # Игнорируем ошибки в автоматическом расчете
-        pass
-
-    # Проверяем, есть ли запланированные забеги
-    scheduled_races = Race.objects.filter(status='scheduled')
-    if not scheduled_races.exists():
-        from .parsers import RaceDataParser
-        try:
-            RaceDataParser.update_races_from_real_sources()
-            messages.info(request, 'Данные о забегах обновлены!')
-        except Exception as e:
-            messages.warning(request, 'Не удалось обновить данные о забегах')
-
+    # Расчет забегов и обновление данных выполняет фоновый процесс
+    # (manage.py race_daemon), главная страница только читает данные
     context = {}
     if request.user.is_authenticated:
-        try:
-            user_profile = request.user.betting_profile
-            context['user_profile'] = user_profile
-            
-            # Мотивационная статистика пользователя
-            user_bets = Bet.objects.filter(user=request.user)
-            total_bets = user_bets.count()
-            won_bets = user_bets.filter(is_winner=True).count()
-            active_bets = user_bets.filter(is_settled=False).count()
-            total_won = user_bets.filter(is_winner=True).aggregate(Sum('potential_win'))['potential_win__sum'] or 0
-            total_wagered = user_bets.aggregate(Sum('amount'))['amount__sum'] or 0
-            
-            # Рассчитываем мотивационные показатели
-            if total_bets > 0:
-                win_rate = (won_bets / total_bets) * 100
-            else:
-                win_rate = 0
-            
-            # Определяем уровень игрока
-            if total_bets == 0:
-                player_level = "Новичок"
-                level_description = "Сделайте первую ставку чтобы начать!"
-            elif win_rate >= 50:
-                player_level = "Эксперт"
-                level_description = "Отличные результаты! Продолжайте в том же духе!"
-            elif win_rate >= 30:
-                player_level = "Опытный"
-                level_description = "Хорошая игра! Вы на верном пути!"
-            elif win_rate >= 15:
-                player_level = "Любитель" 
-                level_description = "Неплохо! Удача на вашей стороне!"
-            else:
-                player_level = "Новичок"
-                level_description = "Практика ведет к совершенству!"
-            
-            # Следующая цель
-            if total_bets < 5:
-                next_goal = "Сделать 5 ставок"
-            elif won_bets == 0:
-                next_goal = "Одержать первую победу"
-            elif total_won < 1000:
-                next_goal = "Выиграть 1000 ₽"
-            elif win_rate < 20:
-                next_goal = "Достичь 20% побед"
-            else:
-                next_goal = "Увеличить баланс на 50%"
-            
-            context.update({
-                'total_bets': total_bets,
-                'won_bets': won_bets,
-                'active_bets': active_bets,
-                'total_won': total_won,
-                'total_wagered': total_wagered,
-                'win_rate': round(win_rate, 1),
-                'player_level': player_level,
-                'level_description': level_description,
-                'next_goal': next_goal,
-            })
-        except UserProfile.DoesNotExist:
-            user_profile = UserProfile.objects.create(user=request.user)
-            context['user_profile'] = user_profile
-
-    # Ближайшие забеги
-    upcoming_races = Race.objects.filter(
-        status='scheduled',
-        start_time__gte=timezone.now()
-    ).order_by('start_time')[:5]
-    
-    # Недавно завершенные забеги
-    recent_races = Race.objects.filter(
-        status='finished'
-    ).order_by('-start_time')[:3]
-
+        user_profile = get_profile(request.user)
+        context['user_profile'] = user_profile
+        
+        # Мотивационная статистика пользователя (одна строка UserStats)
+        stats = get_user_stats(request.user)
+        total_bets = stats.total_bets
+        won_bets = stats.won_bets
+        active_bets = stats.active_bets
+        total_won = stats.total_won
+        total_wagered = stats.total_wagered
+        
+        # Рассчитываем мотивационные показатели
+        win_rate = stats.win_rate
+        
+        # Определяем уровень игрока
+        if total_bets == 0:
+            player_level = "Новичок"
+            level_description = "Сделайте первую ставку чтобы начать!"
+        elif win_rate >= 50:
+            player_level = "Эксперт"
+            level_description = "Отличные результаты! Продолжайте в том же духе!"
+        elif win_rate >= 30:
+            player_level = "Опытный"
+            level_description = "Хорошая игра! Вы на верном пути!"
+        elif win_rate >= 15:
+            player_level = "Любитель" 
+            level_description = "Неплохо! Удача на вашей стороне!"
+        else:
+            player_level = "Новичок"
+            level_description = "Практика ведет к совершенству!"
+        
+        # Следующая цель
+        if total_bets < 5:
+            next_goal = "Сделать 5 ставок"
+        elif won_bets == 0:
+            next_goal = "Одержать первую победу"
+        elif total_won < 1000:
+            next_goal = "Выиграть 1000 ₽"
+        elif win_rate < 20:
+            next_goal = "Достичь 20% побед"
+        else:
+            next_goal = "Увеличить баланс на 50%"
+        
+        context.update({
+            'total_bets': total_bets,
+            'won_bets': won_bets,
+            'active_bets': active_bets,
+            'total_won': total_won,
+            'total_wagered': total_wagered,
+            'win_rate': round(win_rate, 1),
+            'player_level': player_level,
+            'level_description': level_description,
+            'next_goal': next_goal,
+        })
+
+    # Ближайшие забеги и недавние результаты - из кэша фрагментов
     context.update({
-        'upcoming_races': upcoming_races,
-        'recent_races': recent_races
+        'upcoming_races_html': _upcoming_races_html(request.user.is_authenticated),
+        'recent_results_html': _recent_results_html(),
     })
 
     return render(request, 'betting/home.html', context)
@@ -170,11 +164,14 @@ def terms(request):
 
 @login_required
 def place_bet(request):
-    races = Race.objects.filter(status='scheduled').order_by('start_time')
-    user_profile = request.user.betting_profile
+    def render_fragment():
+        races = Race.objects.filter(status='scheduled').prefetch_related('horses').order_by('start_time')
+        return render_to_string('betting/fragments/race_cards.html', {'races': races})
+
+    user_profile = get_profile(request.user)
 
     context = {
-        'races': races,
+        'race_cards_html': mark_safe(cached_fragment('race_cards', render_fragment)),
         'user_profile': user_profile
     }
     return render(request, 'betting/place_bet.html', context)
@@ -183,60 +180,23 @@ def place_bet(request):
 def place_bet_race(request, race_id):
     race = get_object_or_404(Race, id=race_id)
     horses = Horse.objects.filter(race=race)
-    user_profile = request.user.betting_profile
+    user_profile = get_profile(request.user)
 
     if request.method == 'POST':
-        horse_id = request.POST.get('horse_id')
-        amount = request.POST.get('amount')
-        bet_type = request.POST.get('bet_type', 'win')
-
         try:
-            horse = Horse.objects.get(id=horse_id)
-            amount = Decimal(amount)
-
-            # Корректируем коэффициенты в зависимости от типа ставки
-            base_odds = horse.odds
-            if bet_type == 'place':
-                adjusted_odds = base_odds * Decimal('0.6')
-                bet_type_display = 'место'
-            elif bet_type == 'show':
-                adjusted_odds = base_odds * Decimal('0.4')
-                bet_type_display = 'показ'
-            else:
-                adjusted_odds = base_odds
-                bet_type_display = 'победу'
-
-            if amount < Decimal('10'):
-                messages.error(request, 'Минимальная сумма ставки - 10 ₽')
-            elif amount > user_profile.balance:
-                messages.error(request, 'Недостаточно средств')
-            else:
-                # Создаем ставку
-                bet = Bet.objects.create(
-                    user=request.user,
-                    race=race,
-                    horse=horse,
-                    bet_type=bet_type,
-                    amount=amount,
-                    odds=adjusted_odds
-                )
-                # Списываем средства
-                user_profile.balance -= amount
-                user_profile.save()
-                
-                # Записываем транзакцию ставки
-                Transaction.objects.create(
-                    user=request.user,
-                    transaction_type='bet',
-                    amount=amount,
-                    description=f'Ставка на {bet_type_display} - {horse.name}'
-                )
-
-                messages.success(request, f'Ставка на {bet_type_display} ({horse.name}) принята! Сумма: {amount} ₽, Коэффициент: {adjusted_odds}')
-                return redirect('betting:home')
-
-        except (Horse.DoesNotExist, ValueError) as e:
-            messages.error(request, 'Ошибка при размещении ставки')
+            bet = placement.place_bet(
+                request.user,
+                race_id=race.id,
+                horse_id=request.POST.get('horse_id'),
+                amount=request.POST.get('amount'),
+                bet_type=request.POST.get('bet_type', 'win'),
+            )
+        except placement.BetError as e:
+            messages.error(request, str(e))
+        else:
+            bet_type_display = placement.BET_TYPE_ODDS[bet.bet_type][1]
+            messages.success(request, f'Ставка на {bet_type_display} ({bet.horse.name}) принята! Сумма: {bet.amount} ₽, Коэффициент: {bet.odds}')
+            return redirect('betting:home')
 
     context = {
         'race': race,
@@ -246,55 +206,48 @@ def place_bet_race(request, race_id):
     return render(request, 'betting/place_bet_race.html', context)
 
 @login_required
+@use_replica
 def bet_history(request):
-    bets = Bet.objects.filter(user=request.user).order_by('-created_at')
-    user_profile = request.user.betting_profile
+    # Постраничный вывод по курсору (created_at, id)
+    bets = keyset_page(
+        Bet.objects.filter(user=request.user).select_related('race', 'horse'),
+        before=request.GET.get('before'),
+        after=request.GET.get('after'),
+    )
+    user_profile = get_profile(request.user)
+    stats = get_user_stats(request.user)
     
     context = {
         'bets': bets,
-        'user_profile': user_profile
+        'user_profile': user_profile,
+        'total_bets': stats.total_bets,
+        'won_bets_count': stats.won_bets,
     }
     return render(request, 'betting/bet_history.html', context)
 
 @login_required
 def deposit(request):
-    try:
-        user_profile = request.user.betting_profile
-    except UserProfile.DoesNotExist:
-        user_profile = UserProfile.objects.create(user=request.user)
+    user_profile = get_profile(request.user)
 
     if request.method == 'POST':
         amount = request.POST.get('amount')
         try:
             amount = Decimal(amount)
             if amount >= 10:
-                # Пополняем баланс
-                user_profile.balance += amount
-                user_profile.save()
-                
-                # Записываем транзакцию
-                Transaction.objects.create(
-                    user=request.user,
-                    transaction_type='deposit',
-                    amount=amount,
-                    description=f'Пополнение счета'
-                )
-                
+                # Пополняем баланс записью в журнал
+                ledger.post(request.user.pk, 'deposit', amount, 'Пополнение счета')
                 messages.success(request, f'Баланс пополнен на {amount} ₽')
                 return redirect('betting:home')
             else:
                 messages.error(request, 'Минимальная сумма пополнения - 10 ₽')
-        except (ValueError, TypeError):
+        except (ValueError, TypeError, InvalidOperation):
             messages.error(request, 'Введите корректную сумму')
 
     return render(request, 'betting/deposit.html', {'user_profile': user_profile})
 
 @login_required
 def withdraw(request):
-    try:
-        user_profile = request.user.betting_profile
-    except UserProfile.DoesNotExist:
-        user_profile = UserProfile.objects.create(user=request.user)
+    user_profile = get_profile(request.user)
 
     if request.method == 'POST':
         amount = request.POST.get('amount')
@@ -304,69 +257,33 @@ def withdraw(request):
         try:
             amount = Decimal(amount)
             if amount >= 100:
-                if amount <= user_profile.balance:
-                    # Списываем средства
-                    user_profile.balance -= amount
-                    user_profile.save()
-                    
-                    # Записываем транзакцию
-                    Transaction.objects.create(
-                        user=request.user,
-                        transaction_type='withdraw',
-                        amount=amount,
-                        description=f'Вывод средств ({method})'
-                    )
-                    
-                    messages.success(request, f'Запрос на вывод {amount} ₽ отправлен')
-                    return redirect('betting:home')
-                else:
-                    messages.error(request, 'Недостаточно средств')
+                # Условное списание: баланс не уйдет в минус при параллельных запросах
+                ledger.post(request.user.pk, 'withdraw', amount, f'Вывод средств ({method})')
+                messages.success(request, f'Запрос на вывод {amount} ₽ отправлен')
+                return redirect('betting:home')
             else:
                 messages.error(request, 'Минимальная сумма вывода - 100 ₽')
-        except (ValueError, TypeError):
+        except ledger.InsufficientFunds:
+            messages.error(request, 'Недостаточно средств')
+        except (ValueError, TypeError, InvalidOperation):
             messages.error(request, 'Введите корректную сумму')
 
     return render(request, 'betting/withdraw.html', {'user_profile': user_profile})
 
 @login_required
+@use_replica
 def user_stats(request):
-    user_profile = request.user.betting_profile
-    user_bets = Bet.objects.filter(user=request.user)
+    user_profile = get_profile(request.user)
     
-    # Общая статистика
-    total_bets = user_bets.count()
-    active_bets = user_bets.filter(is_settled=False).count()
-    won_bets = user_bets.filter(is_winner=True).count()
-    lost_bets = user_bets.filter(is_settled=True, is_winner=False).count()
-    
-    # Финансовая статистика
-    total_wagered = user_bets.aggregate(Sum('amount'))['amount__sum'] or 0
-    total_won = user_bets.filter(is_winner=True).aggregate(Sum('potential_win'))['potential_win__sum'] or 0
-    net_profit = total_won - total_wagered
-    
-    # Статистика по типам ставок (ИСПРАВЛЕНО: убираем models.)
-    bet_types = user_bets.values('bet_type').annotate(
-        count=Count('id'),
-        won=Count('id', filter=Q(is_winner=True))  # Убрали models.
-    )
-    
-    context = {
-        'user_profile': user_profile,
-        'total_bets': total_bets,
-        'active_bets': active_bets,
-        'won_bets': won_bets,
-        'lost_bets': lost_bets,
-        'total_wagered': total_wagered,
-        'total_won': total_won,
-        'net_profit': net_profit,
-        'bet_types': bet_types,
-    }
+    # Статистика читается из денормализованной строки UserStats
+    context = get_user_stats(request.user).as_dict()
+    context['user_profile'] = user_profile
     return render(request, 'betting/user_stats.html', context)
 
 @login_required
 def user_profile(request):
-    user_profile = request.user.betting_profile
-    user_bets = Bet.objects.filter(user=request.user).order_by('-created_at')[:5]
+    user_profile = get_profile(request.user)
+    user_bets = Bet.objects.filter(user=request.user).select_related('race', 'horse').order_by('-created_at')[:5]
     
     context = {
         'user_profile': user_profile,
@@ -375,23 +292,31 @@ def user_profile(request):
     return render(request, 'betting/user_profile.html', context)
 
 @login_required
+@use_replica
 def transaction_history(request):
     """История транзакций пользователя"""
-    transactions = Transaction.objects.filter(user=request.user)
-    user_profile = request.user.betting_profile
+    transactions = keyset_page(
+        Transaction.objects.filter(user=request.user),
+        before=request.GET.get('before'),
+        after=request.GET.get('after'),
+    )
+    user_profile = get_profile(request.user)
     
-    # Статистика по типам транзакций
-    deposit_total = transactions.filter(transaction_type='deposit').aggregate(Sum('amount'))['amount__sum'] or 0
-    withdraw_total = transactions.filter(transaction_type='withdraw').aggregate(Sum('amount'))['amount__sum'] or 0
-    win_total = transactions.filter(transaction_type='win').aggregate(Sum('amount'))['amount__sum'] or 0
-    bet_total = transactions.filter(transaction_type='bet').aggregate(Sum('amount'))['amount__sum'] or 0
+    # Статистика по типам транзакций одним сгруппированным запросом
+    totals = dict(
+        Transaction.objects.filter(user=request.user)
+        .values('transaction_type')
+        .annotate(total=Sum('amount'))
+        .order_by()
+        .values_list('transaction_type', 'total')
+    )
     
     context = {
         'transactions': transactions,
         'user_profile': user_profile,
-        'deposit_total': deposit_total,
-        'withdraw_total': withdraw_total,
-        'win_total': win_total,
-        'bet_total': bet_total,
+        'deposit_total': totals.get('deposit') or 0,
+        'withdraw_total': totals.get('withdraw') or 0,
+        'win_total': totals.get('win') or 0,
+        'bet_total': totals.get('bet') or 0,
     }
-    return render(request, 'betting/transaction_history.html', context)
\ No newline at end of file
+    return render(request, 'betting/transaction_history.html', context)
@@ -0,0 +1,101 @@
+"""
+Профили базы данных. Профиль выбирается переменной окружения
+IPPODROM_DB (см. database_from_env):
+
+sqlite (по умолчанию)
+    файл IPPODROM_DB_PATH (db.sqlite3 в корне проекта) в режиме WAL:
+    читатели не блокируют писателя, ожидание блокировки вместо ошибки
+    "database is locked", транзакции сразу берут блокировку записи.
+sqlite-legacy
+    SQLite без настроек, только для сравнения в бенчмарке.
+postgres
+    PostgreSQL (IPPODROM_DB_NAME, _USER, _PASSWORD, _HOST, _PORT) с
+    пулом соединений Django (нужен psycopg[pool]); с IPPODROM_DB_POOL=0 -
+    постоянные соединения на CONN_MAX_AGE секунд.
+
+Реплика для чтения (псевдоним replica, см. betting/replicas.py)
+задается IPPODROM_DB_REPLICA_PATH для SQLite или
+IPPODROM_DB_REPLICA_HOST (и IPPODROM_DB_REPLICA_PORT) для PostgreSQL.
+Без них псевдоним replica указывает на основную базу, а чтение
+с реплики выключено; в тестах реплика - зеркало основной базы.
+"""
+PROFILES = ('sqlite', 'sqlite-legacy', 'postgres')
+
+# Сколько ждать освобождения блокировки записи SQLite, секунд
+SQLITE_BUSY_TIMEOUT = 20
+# Размер файла базы, отображаемого в память
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+
+POOL_MIN_SIZE = 2
+POOL_MAX_SIZE = 20
+# Время ожидания свободного соединения из пула, секунд
+POOL_TIMEOUT = 10
+CONN_MAX_AGE = 600
+
+
+def sqlite_database(path, tuned=True):
+    database = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': path}
+    if not tuned:
+        return database
+    database['OPTIONS'] = {
+        # BEGIN IMMEDIATE: транзакция, начатая с чтения, не упирается
+        # в повышение блокировки до записи, а ждет ее busy_timeout
+        'transaction_mode': 'IMMEDIATE',
+        'timeout': SQLITE_BUSY_TIMEOUT,
+        'init_command': ';'.join([
+            'PRAGMA journal_mode=WAL',
+            f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT * 1000}',
+            # В режиме WAL NORMAL не теряет целостность, только последние
+            # транзакции при отключении питания
+            'PRAGMA synchronous=NORMAL',
+            f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}',
+        ]),
+    }
+    return database
+
+
+def postgres_database(environ):
+    database = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': environ.get('IPPODROM_DB_NAME', 'ippodrom'),
+        'USER': environ.get('IPPODROM_DB_USER', 'ippodrom'),
+        'PASSWORD': environ.get('IPPODROM_DB_PASSWORD', ''),
+        'HOST': environ.get('IPPODROM_DB_HOST', 'localhost'),
+        'PORT': environ.get('IPPODROM_DB_PORT', '5432'),
+        'CONN_HEALTH_CHECKS': True,
+    }
+    if environ.get('IPPODROM_DB_POOL', '1') == '1':
+        # Django не допускает пул вместе с CONN_MAX_AGE: соединения
+        # живут в пуле, а не в потоке запроса
+        database['CONN_MAX_AGE'] = 0
+        database['OPTIONS'] = {'pool': {
+            'min_size': int(environ.get('IPPODROM_DB_POOL_MIN', POOL_MIN_SIZE)),
+            'max_size': int(environ.get('IPPODROM_DB_POOL_MAX', POOL_MAX_SIZE)),
+            'timeout': POOL_TIMEOUT,
+        }}
+    else:
+        database['CONN_MAX_AGE'] = int(environ.get('IPPODROM_DB_CONN_MAX_AGE', CONN_MAX_AGE))
+    return database
+
+
+def database_from_env(environ, default_path):
+    """Настройка DATABASES['default'] для профиля из IPPODROM_DB"""
+    profile = environ.get('IPPODROM_DB', 'sqlite')
+    if profile not in PROFILES:
+        raise ValueError(f'Неизвестный профиль базы данных IPPODROM_DB={profile!r}, допустимы: {", ".join(PROFILES)}')
+    if profile == 'postgres':
+        return postgres_database(environ)
+    return sqlite_database(environ.get('IPPODROM_DB_PATH', default_path), tuned=profile == 'sqlite')
+
+
+def replica_from_env(environ):
+    """Настройка реплики для чтения или None, если она не задана"""
+    profile = environ.get('IPPODROM_DB', 'sqlite')
+    if profile == 'postgres' and environ.get('IPPODROM_DB_REPLICA_HOST'):
+        replica = postgres_database(environ)
+        replica['HOST'] = environ['IPPODROM_DB_REPLICA_HOST']
+        replica['PORT'] = environ.get('IPPODROM_DB_REPLICA_PORT', replica['PORT'])
+        return replica
+    if profile != 'postgres' and environ.get('IPPODROM_DB_REPLICA_PATH'):
+        return sqlite_database(environ['IPPODROM_DB_REPLICA_PATH'], tuned=profile == 'sqlite')
+    return None
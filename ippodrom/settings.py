@@ -10,7 +10,9 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
+from .databases import database_from_env, replica_from_env
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -46,6 +48,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'betting.replicas.ReplicaPinningMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -67,19 +70,30 @@ TEMPLATES = [
     },
 ]
 
+# Поток событий /api/races/events/ (SSE) работает только под ASGI:
+# в продакшене сервер - uvicorn ippodrom.asgi:application (например,
+# uvicorn --workers 4); runserver и WSGI-серверы отвечают на него 501
 WSGI_APPLICATION = 'ippodrom.wsgi.application'
 
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Профиль выбирается переменной окружения IPPODROM_DB, см. ippodrom/databases.py
+
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    'default': database_from_env(os.environ, BASE_DIR / 'db.sqlite3'),
 }
 
+# Реплика для чтения истории и статистики, см. betting/replicas.py.
+# Псевдоним replica настроен всегда: без реплики это та же основная
+# база, и чтение с нее выключено (BETTING_REPLICA_DATABASE). В тестах
+# реплика - зеркало тестовой основной базы
+REPLICA = replica_from_env(os.environ)
+DATABASES['replica'] = {**(REPLICA or DATABASES['default']), 'TEST': {'MIRROR': 'default'}}
+
+DATABASE_ROUTERS = ['betting.replicas.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -121,7 +135,104 @@ STATICFILES_DIRS = [
 ]
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 
+# Cache
+# Локальный кэш процесса, внешний сервис не нужен
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ippodrom',
+    }
+}
+
+# Общий для всех процессов кэш пользователей с профилями (Redis,
+# IPPODROM_REDIS_URL). Без него пользователь читается из базы
+# на каждый запрос, см. betting/profiles.py
+if os.environ.get('IPPODROM_REDIS_URL'):
+    CACHES['users'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['IPPODROM_REDIS_URL'],
+        'KEY_PREFIX': 'ippodrom',
+    }
+
+# Версия данных о забегах (betting/caching.py) - общая для веб-процессов
+# и race_daemon: Redis, если он настроен, иначе файловый кэш на этой
+# машине (IPPODROM_CACHE_DIR). Процессы на разных машинах без Redis
+# видят изменения забегов только через BETTING_CACHE_TIMEOUT
+CACHES['versions'] = CACHES.get('users') or {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': os.environ.get('IPPODROM_CACHE_DIR', BASE_DIR / 'cache'),
+}
+
+# Sessions
+# С общим кэшем сессия читается из него, база - только при промахе
+# и при изменении. Локальный кэш процесса для сессий не подходит:
+# после выхода или сброса сессии остальные процессы принимали бы ее
+# cookie до истечения срока сессии
+
+if 'users' in CACHES:
+    SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+    SESSION_CACHE_ALIAS = 'users'
+else:
+    SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+
+# Пользователь сессии загружается вместе с профилем одним запросом или
+# из общего кэша (betting/profiles.py). ModelBackend оставлен для сессий, открытых до
+# его подключения
+
+AUTHENTICATION_BACKENDS = [
+    'betting.profiles.CachedProfileBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
-DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
\ No newline at end of file
+DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Betting
+# Доля тотализатора, удерживаемая из пула при расчете коэффициентов
+
+BETTING_TAKEOUT = 0.15
+
+# Порог публикации коэффициентов тотализатора: сумма пула забега и доля
+# лошадей, на которых есть ставки
+BETTING_TOTE_MIN_POOL = 1000
+BETTING_TOTE_MIN_COVERAGE = 1.0
+
+# Источники данных о забегах: список словарей с ключами name, url
+# и необязательными timeout (секунд) и retries. Пустой список -
+# тестовые данные вместо внешних источников
+BETTING_FEED_SOURCES = []
+
+# Сколько источников опрашивается одновременно
+BETTING_FEED_WORKERS = 8
+
+# Время жизни кэша страниц и фрагментов с забегами, секунд, и кэш
+# версии данных о забегах: изменение забега сбрасывает записи всех
+# процессов, без общего кэша - только через это время
+BETTING_CACHE_TIMEOUT = 60
+BETTING_RACES_VERSION_CACHE = 'versions'
+
+# Период опроса базы лентой изменений для потока SSE, секунд
+BETTING_LIVE_POLL_INTERVAL = 1.0
+
+# Очередь уведомлений (см. betting/notifications.py и send_notifications):
+# размер пачки отправки и число попыток до статуса "не доставлено"
+BETTING_NOTIFICATION_BATCH_SIZE = 100
+BETTING_NOTIFICATION_MAX_ATTEMPTS = 5
+
+# Потоков рассылки результатов завершенного забега
+BETTING_NOTIFICATION_WORKERS = 4
+
+# Реплика для чтения истории ставок, операций и статистики
+# (None - все запросы к основной базе) и ее допустимое отставание, секунд:
+# столько после записи клиент читает с основной базы
+BETTING_REPLICA_DATABASE = 'replica' if REPLICA is not None else None
+BETTING_REPLICA_MAX_LAG = 5
+
+# Кэш пользователей с профилями (None - не кэшировать) и время жизни
+# записи, секунд
+BETTING_USER_CACHE = 'users' if 'users' in CACHES else None
+BETTING_USER_CACHE_TIMEOUT = 60